@@ -18,6 +18,7 @@ import numpy as np
 import os
 import dill
 import time
+from copy import copy
 
 from pymor.core.base import ImmutableObject
 from pymor.algorithms.projection import project
@@ -33,7 +34,9 @@ from pymor.parallel.dummy import DummyPool
 from gridlod import fem
 
 from pdeopt.discretize_gridlod import GridlodModel
-from pdeopt.reductor import NonAssembledRBReductor
+from pdeopt.gridlod_model import load_aPatches, reduced_patch_system
+from pdeopt.patch_store import PatchStore
+from pdeopt.reductor import NonAssembledRBReductor, snapshot_reductor
 
 from rblod.parameterized_stage_1 import CorrectorProblem_for_all_rhs
 from rblod.optimized_rom import OptimizedNumpyModelStage1
@@ -49,7 +52,7 @@ class QuadraticPdeoptStationaryCoerciveLODReductor(CoerciveRBReductor):
                  greedy_for_two_scale=False, pool=None, optional_enrichment=False,
                  store_in_tmp=False, use_fine_mesh=True,
                  two_scale_estimator_for_RBLOD=True,
-                 print_on_ranks=True, add_error_residual=True):
+                 print_on_ranks=True, add_error_residual=True, enrichment_tolerance=1e-3):
         tic = time.perf_counter()
         # lod setting
         self.gridlod_model = fom.optional_forward_model
@@ -141,15 +144,23 @@ class QuadraticPdeoptStationaryCoerciveLODReductor(CoerciveRBReductor):
         print('initializing roms ...')
         min_alpha = self.min_alpha
         coercivity_estimator = lambda mu: min_alpha
-        self.romT, self.reductorT, self.KijT, self.rom_sizeT = \
-            zip(*self.pool.map(build_reduced_patch_model, self.patchT, self.aPatchT,
-                               aFineCoefficients=self.aFineCoefficients,
-                               coercivity_estimator=coercivity_estimator,
-                               store_in_tmp=self.store_in_tmp,
-                               reductor_type=self.reductor_type,
-                               print_on_ranks=self.print_on_ranks)) # aFine_Constructor=None)
+        self.romT, self.reductorT, self.rom_systemT, self.KijT, self.rom_sizeT = \
+            zip(*self.gridlod_model.scheduler.map(self.pool, 'build_reduced_patch_model',
+                                                  build_reduced_patch_model, self.patchT, self.aPatchT,
+                                                  aFineCoefficients=self.aFineCoefficients,
+                                                  coercivity_estimator=coercivity_estimator,
+                                                  store_in_tmp=self.store_in_tmp,
+                                                  reductor_type=self.reductor_type,
+                                                  print_on_ranks=self.print_on_ranks)) # aFine_Constructor=None)
         print('') if self.print_on_ranks else 0
 
+    def snapshot(self):
+        # new version of the reductor that can be extended without changing this one. The patch data are
+        # shared, extend_bases replaces the tuples and only copies the patch reductors that are extended.
+        new_reductor = copy(self)
+        new_reductor.mus_for_enrichment = list(self.mus_for_enrichment)
+        return new_reductor
+
     def reduce(self):
         # NOTE: never use super().reduce() for this since the dims are not correctly computed here !
         return self._reduce()
@@ -318,6 +329,7 @@ class QuadraticPdeoptStationaryCoerciveLODReductor(CoerciveRBReductor):
                                                   evaluation_counter = evaluation_counter,
                                                   romT = self.romT,
                                                   reductorT = parsed_reductors,
+                                                  rom_systemT = self.rom_systemT,
                                                   is_rom = True,
                                                   save_correctors= self.gridlod_model.save_correctors,
                                                   coarse_pymor_rhs=self.gridlod_model.coarse_pymor_rhs,
@@ -327,13 +339,20 @@ class QuadraticPdeoptStationaryCoerciveLODReductor(CoerciveRBReductor):
                                                   aFineCoefficients=self.gridlod_model.aFineCoefficients,
                                                   store_in_tmp=self.gridlod_model.store_in_tmp,
                                                   patchT=self.patchT,
-                                                  construct_patches=False
+                                                  construct_patches=False,
+                                                  cache_size=self.gridlod_model.cache_size,
+                                                  cache_memory=self.gridlod_model.cache_memory,
+                                                  free_stiffness_pattern=self.gridlod_model.free_stiffness_pattern,
+                                                  vectorized_online=self.gridlod_model.vectorized_online
                                                   )
             print(f' ... enrichment completed... length of bases are {self.rom_sizeT}')
             return self.fom.with_(estimators=estimator, optional_forward_model=reduced_optional_forward_model,
                                   fom=self.fom)
 
-    def extend_bases(self, mu, U = None, P = None, corT = None, pool=None):
+    def extend_bases(self, mu, U = None, P = None, corT = None, KmsijT = None, pool=None):
+        # corT and KmsijT: FOM correctors at mu if they are already known (e.g. from a global termination check)
+        assert corT is None or any(cors is not None for cors in corT), \
+            'corT does not contain correctors, use solve_for_correctors(mu, compute_correctors=True)'
         print('extending bases...', end='', flush=True)
         tic = time.perf_counter()
         if self.two_scale:
@@ -341,44 +360,65 @@ class QuadraticPdeoptStationaryCoerciveLODReductor(CoerciveRBReductor):
         if pool is None:
             print('WARNING: You are not using a parallel pool')
         pool = pool or DummyPool()
-        self.gridlod_model.evaluation_counter.count(is_rom=False)
+        if corT is None or any(cors is None for cors in corT):
+            self.gridlod_model.evaluation_counter.count(is_rom=False)
         self.gridlod_model.evaluation_counter.count(is_rom=False, coarse=True)
-        corT = [None for i in range(len(self.romT))]
-
-        if self.store_in_tmp:
-            if self.optional_enrichment:
-                KmsijT, self.rom_sizeT = zip(*pool.map(
-                    extend_patch_adaptively_cached_reductor, self.patchT, list(self.romT), list(corT), mu=mu,
-                    store_in_tmp=self.store_in_tmp, gridlod_model=self.gridlod_model,
-                    print_on_ranks=self.print_on_ranks, add_error_residual=self.add_error_residual
-                ))
-            else:
-                KmsijT, self.rom_sizeT = zip(*pool.map(
-                    extend_patch_cached_reductor, self.patchT, list(corT), mu=mu, store_in_tmp=self.store_in_tmp,
-                    gridlod_model=self.gridlod_model, print_on_ranks=self.print_on_ranks,
-                    add_error_residual=self.add_error_residual
-                ))
-            self.romT = []
+        if corT is None:
+            corT = [None for i in range(len(self.romT))]
+
+        if self.optional_enrichment:
+            # first pass: only the cheap patch ROM estimators. The FOM correctors are only computed for patches
+            # with at least one directional estimate above the tolerance
+            directionsT = self.gridlod_model.scheduler.map(pool, 'estimate_patch_directions',
+                                                           estimate_patch_directions, list(self.romT), self.patchT,
+                                                           mu=mu, tolerance=self.enrichment_tolerance,
+                                                           store_in_tmp=self.store_in_tmp)
+        else:
+            directionsT = [None for i in range(len(self.romT))]
+        patches = [T for T, directions in enumerate(directionsT) if directions is None or any(directions)]
+        if self.optional_enrichment:
+            print(f' {len(patches)} of {len(self.patchT)} patches need enrichment ', end='', flush=True)
+
+        # second pass: FOM correctors and enrichment
+        KmsijT = [None for i in range(len(self.romT))] if KmsijT is None else list(KmsijT)
+        correctorsT = list(corT)
+        romT, reductorT, rom_sizeT = list(self.romT), list(self.reductorT), list(self.rom_sizeT)
+        rom_systemT = list(self.rom_systemT)
+        if not patches:
+            pass
+        elif self.store_in_tmp:
+            results = self.gridlod_model.scheduler.map(pool, 'extend_patch', extend_patch_cached_reductor,
+                               [self.patchT[T] for T in patches], [corT[T] for T in patches],
+                               [directionsT[T] for T in patches], patches=patches, mu=mu,
+                               store_in_tmp=self.store_in_tmp, gridlod_model=self.gridlod_model,
+                               print_on_ranks=self.print_on_ranks, add_error_residual=self.add_error_residual)
+            # only reload the ROMs that have been changed or are not loaded yet
             dir = self.store_in_tmp if isinstance(self.store_in_tmp, str) else 'tmp'
-            for T in range(len(self.patchT)):
-                dbfile = open(f'{dir}/rom_{T}', "rb")
-                rom = dill.load(dbfile)
-                self.romT.append(rom)
+            store = PatchStore(dir)
+            changedT = [False for i in range(len(self.romT))]
+            for T, (Kmsij, cors, rom_size, changed) in zip(patches, results):
+                KmsijT[T] = KmsijT[T] if Kmsij is None else Kmsij
+                correctorsT[T], rom_sizeT[T], changedT[T] = cors, rom_size, changed
+            for T in range(len(romT)):
+                if changedT[T] or romT[T] is None:
+                    romT[T], rom_systemT[T] = store.load_rom(T), store.load_rom_system(T)
         else:
-            if self.optional_enrichment:
-                KmsijT, self.romT, self.reductorT, self.rom_sizeT = zip(*pool.map(
-                    extend_patch_adaptively, list(self.romT), list(self.reductorT), list(corT), mu=mu,
-                    print_on_ranks=self.print_on_ranks, add_error_residual=self.add_error_residual
-                ))
-            else:
-                KmsijT, self.romT, self.reductorT, self.rom_sizeT = zip(*pool.map(
-                    extend_patch, list(self.reductorT), list(corT), mu=mu, print_on_ranks=self.print_on_ranks,
-                    add_error_residual=self.add_error_residual
-                ))
+            results = self.gridlod_model.scheduler.map(pool, 'extend_patch', extend_patch,
+                               [snapshot_reductor(reductorT[T]) for T in patches], [corT[T] for T in patches],
+                               [directionsT[T] for T in patches], patches=patches, mu=mu,
+                               gridlod_model=self.gridlod_model,
+                               print_on_ranks=self.print_on_ranks, add_error_residual=self.add_error_residual)
+            for T, (Kmsij, cors, rom, system, reductor, rom_size, _) in zip(patches, results):
+                KmsijT[T] = KmsijT[T] if Kmsij is None else Kmsij
+                correctorsT[T], romT[T], rom_systemT[T] = cors, rom, system
+                reductorT[T], rom_sizeT[T] = reductor, rom_size
+        self.romT, self.reductorT, self.rom_sizeT = tuple(romT), tuple(reductorT), tuple(rom_sizeT)
+        self.rom_systemT = tuple(rom_systemT)
         print(f' ... Stage 1 enrichment took {time.perf_counter() - tic:.4f}s')
         self.total_stage_1_time += time.perf_counter() - tic
         print(f' ... total stage 1 time is currently {self.total_stage_1_time:.5f}')
-        return KmsijT, corT
+        # entries of patches that have not been enriched are None, GridlodModel.solve computes them if needed
+        return KmsijT, correctorsT
 
     def build_two_scale_model(self, f, As=None, BTss=None, CTss=None, DTss=None, source_spaces=None,
                               res_op=None, res_prod=None):
@@ -606,7 +646,7 @@ class QuadraticPdeoptStationaryCoerciveLODReductor(CoerciveRBReductor):
            'bilinear_part' : project(bi_part, RB_primal, RB_primal),
            'd_u_linear_part' : project(d_u_li_part, RB_coarse, None),
            'd_u_bilinear_part' : project(d_u_bi_part, RB_primal, RB_primal),
-           'dual_projected_d_u_bilinear_part' : project(d_u_bi_part, RB_primal, RB_dual),
+           'dual_projected_d_u_bilinear_part' : project(d_u_bi_part, RB_dual, RB_primal),
            'dual_primal_projected_op': project(self.fom.primal_model.operator, RB_dual, RB_primal),
            'dual_projected_rhs': project(self.fom.primal_model.rhs, RB_dual, None),
         }
@@ -639,9 +679,7 @@ def build_reduced_patch_model(patch, aPatch, aFineCoefficients, coercivity_estim
 
     if aPatch is None:
         if store_in_tmp:
-            dbfile = open(f'{dir}/apatch_{patch.TInd}', "rb")
-            aPatch = dill.load(dbfile)
-            dbfile.close()
+            aPatch = load_aPatches(dir, patch.TInd)
         else:
             assert aFine_Constructor is not None
             aPatch = aFine_Constructor(patch)
@@ -658,61 +696,36 @@ def build_reduced_patch_model(patch, aPatch, aFineCoefficients, coercivity_estim
 
     rom = reductor.reduce()
     optimized_rom, _ = OptimizedNumpyModelStage1(rom, m.Kij, patch.TInd).minimal_object()
+    system = reduced_patch_system(rom)
     rom_size = rom.solution_space.dim
 
     if store_in_tmp is not False:
         dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
-        if os.path.exists(f'{dir}/red_{patch.TInd}'):
-            os.remove(f'{dir}/red_{patch.TInd}')
-        dbfile = open(f'{dir}/red_{patch.TInd}', "ab")
-        dill.dump(reductor, dbfile)
-        if os.path.exists(f'{dir}/rom_{patch.TInd}'):
-            os.remove(f'{dir}/rom_{patch.TInd}')
-        dbfile = open(f'{dir}/rom_{patch.TInd}', "ab")
-        dill.dump(optimized_rom, dbfile)
+        store = PatchStore(dir)
+        store.remove(patch.TInd)
+        store.write(patch.TInd, reductor, optimized_rom, system=system)
         del reductor, rom
-        return None, None, m.Kij, rom_size
+        return None, None, None, m.Kij, rom_size
     else:
-        return optimized_rom, reductor, m.Kij, rom_size
+        return optimized_rom, reductor, system, m.Kij, rom_size
 
 
 from rblod.parameterized_stage_1 import _build_directional_mus
-def extend_patch(reductor, cors, mu, gridlod_model, print_on_ranks=True, add_error_residual=True):
-    sol_space = reductor.fom.solution_space
-    if cors is None:
-        Kmsij, cors = gridlod_model.compute_FOM_corrector(reductor.fom.patch, None, True, mu)
-    else:
-        Kmsij = None
-
-    cors = [sol_space.from_numpy(cor) for cor in cors]
-    for cor, mu_dir in zip(cors, _build_directional_mus(mu)):
-        try:
-            reductor.extend_basis(cor)
-            if print_on_ranks:
-                print("e", end="", flush=True)
-        except:
-            if print_on_ranks:
-                print("E", end="", flush=True)
-            pass
-
-    rom = reductor.reduce()
-    optimized_rom = OptimizedNumpyModelStage1(rom, reductor.fom.Kij, reductor.fom.patch.TInd)
-    optimized_rom, error_residual = optimized_rom.minimal_object(add_error_residual=add_error_residual)
-    rom_size = rom.solution_space.dim
-    return Kmsij, optimized_rom, reductor, rom_size, error_residual
-
-def extend_patch_adaptively(rom, reductor, cors, mu, gridlod_model, print_on_ranks=True, add_error_residual=True):
+def extend_patch(reductor, cors, mu, gridlod_model, directions=None, print_on_ranks=True, add_error_residual=True):
+    # directions: which directional correctors are added to the basis (default: all)
     sol_space = reductor.fom.solution_space
     if cors is None:
         Kmsij, cors = gridlod_model.compute_FOM_corrector(reductor.fom.patch, None, True, mu)
     else:
         Kmsij = None
 
-    cors = [sol_space.from_numpy(cor) for cor in cors]
-    for cor, mu_dir in zip(cors, _build_directional_mus(mu)):
-        if rom.estimate_error(mu_dir) > 0.001:
+    mus_dir = _build_directional_mus(mu)
+    if directions is None:
+        directions = [True for _ in mus_dir]
+    for cor, extend in zip(cors, directions):
+        if extend:
             try:
-                reductor.extend_basis(cor)
+                reductor.extend_basis(sol_space.from_numpy(cor))
                 if print_on_ranks:
                     print("e", end="", flush=True)
             except:
@@ -727,59 +740,29 @@ def extend_patch_adaptively(rom, reductor, cors, mu, gridlod_model, print_on_ran
     optimized_rom = OptimizedNumpyModelStage1(rom, reductor.fom.Kij, reductor.fom.patch.TInd)
     optimized_rom, error_residual = optimized_rom.minimal_object(add_error_residual=add_error_residual)
     rom_size = rom.solution_space.dim
-    return Kmsij, optimized_rom, reductor, rom_size, error_residual
+    return Kmsij, cors, optimized_rom, reduced_patch_system(rom), reductor, rom_size, error_residual
+
+def estimate_patch_directions(rom, patch, mu, tolerance, store_in_tmp=False):
+    # which directional correctors are not approximated well enough by the patch ROM
+    if rom is None:
+        # rom is locally in storage
+        dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
+        rom = PatchStore(dir).load_rom(patch.TInd)
+    return [error > tolerance for error in compute_patch_errors(rom, mu)]
 
 
-def extend_patch_cached_reductor(patch, cors, mu, store_in_tmp, gridlod_model, print_on_ranks=True,
+def extend_patch_cached_reductor(patch, cors, directions, mu, store_in_tmp, gridlod_model, print_on_ranks=True,
                                  add_error_residual=True):
     dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
     assert os.path.exists(f'{dir}/')
     T = patch.TInd
-    dbfile = open(f'{dir}/red_{T}', "rb")
-    reductor = dill.load(dbfile)
-    dbfile.close()
-    Kmsij, rom, reductor, rom_size, error_residual = extend_patch(
-        reductor, cors, mu, gridlod_model, print_on_ranks, add_error_residual)
-    if error_residual is not None:
-        if os.path.exists(f'{dir}/err_res_{T}'):
-            os.remove(f'{dir}/err_res_{T}')
-        dbfile = open(f'{dir}/err_res_{T}', "ab")
-        dill.dump(error_residual, dbfile)
-    os.remove(f'{dir}/red_{patch.TInd}')
-    dbfile = open(f'{dir}/red_{T}', "ab")
-    dill.dump(reductor, dbfile)
-    if os.path.exists(f'{dir}/rom_{T}'):
-        os.remove(f'{dir}/rom_{T}')
-    dbfile = open(f'{dir}/rom_{T}', "ab")
-    dill.dump(rom, dbfile)
-    return Kmsij, rom_size
-
-
-def extend_patch_adaptively_cached_reductor(patch, rom, cors, mu, store_in_tmp, gridlod_model, print_on_ranks=True,
-                                            add_error_residual=True):
-    dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
-    assert os.path.exists(f'{dir}/')
-    T = patch.TInd
-    dbfile = open(f'{dir}/red_{T}', "rb")
-    reductor = dill.load(dbfile)
-    dbfile.close()
-    dbfile = open(f'{dir}/rom_{T}', "rb")
-    rom = dill.load(dbfile)
-    dbfile.close()
-    Kmsij, rom, reductor, rom_size, error_residual = extend_patch_adaptively(
-        rom, reductor, cors, mu, gridlod_model, print_on_ranks, add_error_residual)
-    if error_residual is not None:
-        if os.path.exists(f'{dir}/err_res_{T}'):
-            os.remove(f'{dir}/err_res_{T}')
-        dbfile = open(f'{dir}/err_res_{T}', "ab")
-        dill.dump(error_residual, dbfile)
-    os.remove(f'{dir}/red_{T}')
-    dbfile = open(f'{dir}/red_{T}', "ab")
-    dill.dump(reductor, dbfile)
-    os.remove(f'{dir}/rom_{T}')
-    dbfile = open(f'{dir}/rom_{T}', "ab")
-    dill.dump(rom, dbfile)
-    return Kmsij, rom_size
+    store = PatchStore(dir)
+    reductor = store.load_reductor(T)
+    Kmsij, cors, rom, system, reductor, rom_size, error_residual = extend_patch(
+        reductor, cors, mu, gridlod_model, directions, print_on_ranks, add_error_residual)
+    # only the new basis vectors are written
+    changed = store.write(T, reductor, rom, error_residual, system)
+    return Kmsij, cors, rom_size, changed
 
 
 def compute_patch_errors(rom, mu, **kwargs):
@@ -791,9 +774,7 @@ def compute_contrast_for_all_patches(aPatches, T, aFineCoefficients, training_se
     if aPatches is None:
         assert store_in_tmp
         dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
-        dbfile = open(f'{dir}/apatch_{T}', "rb")
-        aPatches = dill.load(dbfile)
-        dbfile.close()
+        aPatches = load_aPatches(dir, T)
 
     contrast, min_alpha = compute_constrast(aPatches, aFineCoefficients, training_set)
     return contrast, min_alpha
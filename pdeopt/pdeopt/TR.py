@@ -16,9 +16,13 @@
 
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from pdeopt.RBLOD_reductor import QuadraticPdeoptStationaryCoerciveLODReductor
+from pdeopt.checkpoint import save_checkpoint, load_checkpoint, checkpoint_exists, _patch_store
+from pdeopt.pool import SerializedPool
+from pdeopt.tools import SpeculativeCounts
 from pdeopt.tools import truncated_conj_grad as TruncCG
 from pdeopt.tools import truncated_conj_grad_Steihaug as TruncCGSteihaug
 
@@ -38,6 +42,21 @@ def projection_onto_range(parameter_space, mu):
                 new_mu.append(mu[key][j])
     return parameter_space.parameters.parse(new_mu)
 
+
+# state of the outer TR iteration that is stored in a checkpoint after every accepted iterate
+TR_CHECKPOINT_STATE = ('k', 'mu_k', 'J_k', 'Js', 'FOCs', 'times', 'j_list', 'times_est_evaluations', 'J_estimator',
+                       'mu_est', 'all_mus', 'mu_list', 'JFE_list', 'total_subproblem_time', 'normgrad',
+                       'estimate_gradient', 'old_gradient', 'additional_criteria', 'u', 'p', 'j')
+
+
+def store_TR_checkpoint(checkpoint, state, TR_parameters, tic, reductor, opt_rom, fom, pool=None):
+    # state: the variables of TR_CHECKPOINT_STATE (and the additional state of the method) by name
+    assert set(TR_CHECKPOINT_STATE) <= set(state), 'missing state for the checkpoint'
+    state = dict(state, TR_parameters=dict(TR_parameters), elapsed=time.time() - tic)
+    tic_ = time.perf_counter()
+    save_checkpoint(checkpoint, state, reductor, opt_rom, fom, pool)
+    print(f'checkpoint took {time.perf_counter()-tic_:.4f}s')
+
 def active_and_inactive_sets(parameter_space, mu, epsilon):
 
     Act = []
@@ -282,12 +301,16 @@ def solve_optimization_subproblem_BFGS(opt_model, parameter_space, mu_k_dict, TR
         return mu_ip1_dict, Jcp, i, Jip1, FOCs, mus
 
 
-def modified_hessian_action(mu,Active,Inactive,opt_model,eta):
+def modified_hessian_action(mu,Active,Inactive,opt_model,eta,hessian=None):
+    # hessian: dense hessian at mu (see output_functional_hessian), otherwise the hessian operator is applied
 
     etaA = np.multiply(Active,eta)
     etaI = np.multiply(Inactive,eta)
 
-    Action_on_I = opt_model.output_functional_hessian_operator(mu, etaI)
+    if hessian is not None:
+        Action_on_I = hessian @ etaI
+    else:
+        Action_on_I = opt_model.output_functional_hessian_operator(mu, etaI)
 
     Action_of_modified_operator = etaA + np.multiply(Inactive,Action_on_I)
 
@@ -304,6 +327,10 @@ def solve_optimization_subproblem_NewtonMethod(opt_model, parameter_space, mu_k_
     if 'iterative_solver' not in TR_parameters:
         TR_parameters['iterative_solver'] = 'CG'
 
+    if 'dense_hessian' not in TR_parameters:
+        # assemble the full hessian once per iterate instead of applying it in every CG iteration
+        TR_parameters['dense_hessian'] = False
+
     tic_toc = time.time()
     times = []
     mus = []
@@ -354,9 +381,10 @@ def solve_optimization_subproblem_NewtonMethod(opt_model, parameter_space, mu_k_
                 deltamu = gradient
             else:
                 print("Using CG for the linear system")
+                hessian = opt_model.output_functional_hessian(mu_i_dict) if TR_parameters['dense_hessian'] else None
                 deltamu, itcg,rescg, infocg = TruncCG(A_func=lambda v: modified_hessian_action(
-                    mu=mu_i_dict, Active= Active_i, Inactive= Inactive_i, opt_model=opt_model, eta=v),
-                                                      b= gradient, tol = 1.e-10)
+                    mu=mu_i_dict, Active= Active_i, Inactive= Inactive_i, opt_model=opt_model, eta=v,
+                    hessian=hessian), b= gradient, tol = 1.e-10)
                 if infocg > 0:
                     print("Choosing the gradient as direction")
                     deltamu = gradient
@@ -406,32 +434,77 @@ def solve_optimization_subproblem_NewtonMethod(opt_model, parameter_space, mu_k_
         return mu_ip1_dict, Jcp, i, Jip1, FOCs, mus
 
 
-def enrichment_step(mu, reductor, adaptive_taylor=False, U = None, P = None, pool=None):
+def enrichment_step(mu, reductor, adaptive_taylor=False, U = None, P = None, pool=None, corT=None, KmsijT=None):
     print(f"enriching for mu: {mu}")
+    # the snapshot shares the fom (and thus the counter and the gridlod_model) with the old reductor
+    new_reductor = reductor.snapshot()
     if adaptive_taylor:
-        new_reductor = deepcopy(reductor)
         out_1, out_2 = new_reductor.extend_adaptive_taylor(mu, U = U, P = P)
         opt_rom = new_reductor.reduce()
     else:
-        new_reductor = deepcopy(reductor)
-        # counter, pool and gridlod_model must stay the same !!
+        # out_1 and out_2 are either u and p or data from the LOD
         if isinstance(reductor, QuadraticPdeoptStationaryCoerciveLODReductor):
-            optional_forward_model = reductor.fom.optional_forward_model
-            new_reductor.fom = new_reductor.fom.with_(optional_forward_model=optional_forward_model)
-            new_reductor.gridlod_model = reductor.gridlod_model
+            out_1, out_2 = new_reductor.extend_bases(mu, U = U, P = P, corT=corT, KmsijT=KmsijT, pool=pool)
         else:
-            new_reductor.fom = new_reductor.fom.with_(evaluation_counter=reductor.fom.evaluation_counter)
-
-        # out_1 and out_2 are either u and p or data from the LOD
-        out_1, out_2 = new_reductor.extend_bases(mu, U = U, P = P, pool=pool)
+            out_1, out_2 = new_reductor.extend_bases(mu, U = U, P = P, pool=pool)
         opt_rom = new_reductor.reduce()
         if new_reductor.reductor_type != 'non_assembled':
             print(f"estimate is: {opt_rom.estimate_error(opt_rom.solve(mu, pool=pool), mu)}")
     return opt_rom, new_reductor, out_1, out_2
 
 
+class SpeculativeEnrichment:
+    """
+    Runs enrichment_step in a background thread. While the patch enrichment and the reduction run on the pool,
+    the master can do the coarse work of the global termination check. The result is either used (`result`) or
+    dropped (`discard`). The evaluations and the output of the thread are only counted and printed if the result is
+    used. Both threads use the pool, thus it has to be a SerializedPool. With store_in_tmp, the current PatchStore
+    versions of all patches are held and the patches are rolled back if it is dropped.
+    """
+    def __init__(self, mu, reductor, pool=None, corT=None, KmsijT=None):
+        assert pool is None or isinstance(pool, SerializedPool)
+        self.store = _patch_store(reductor)
+        self.versions = None
+        if self.store is not None:
+            self.versions = [self.store.hold(T) for T in range(len(reductor.romT))]
+        self.counts = SpeculativeCounts()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.future = executor.submit(self._run, mu, reductor, pool=pool, corT=corT, KmsijT=KmsijT)
+        executor.shutdown(wait=False)
+
+    def _run(self, *args, **kwargs):
+        with self.counts:
+            return enrichment_step(*args, **kwargs)
+
+    def result(self):
+        result = self.future.result()
+        self.counts.apply()
+        self._release()
+        return result
+
+    def discard(self):
+        self.future.result()  # the pool has to be free again
+        if self.store is not None:
+            for T, version in enumerate(self.versions):
+                if version < 0:
+                    self.store.remove(T)
+                else:
+                    self.store.rollback(T, version)
+        self._release()
+
+    def _release(self):
+        if self.store is not None:
+            for T in range(len(self.versions)):
+                self.store.release(T)
+
+
 def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extension_params=None, opt_fom=None,
-                 return_opt_rom=False, pool=None, mesh_adaptive=False):
+                 return_opt_rom=False, pool=None, mesh_adaptive=False, checkpoint=None, resume=False,
+                 checkpoint_fom=None):
+    # checkpoint: path of the checkpoint file that is written after every accepted iterate
+    # resume: continue from the checkpoint if it exists, opt_rom and reductor are then taken from the checkpoint
+    # checkpoint_fom: model that the reductor has been built for (default: reductor.fom), needed for resuming
+    #                 without a reductor
     if TR_parameters is None:
         mu_k = parameter_space.sample_randomly(1)[0]
         TR_parameters = {'radius': 0.1, 'sub_tolerance': 1e-8, 'max_iterations': 40, 'max_iterations_subproblem': 400,
@@ -491,10 +564,25 @@ def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extensi
             extension_params['store_subproblem_iterations'] = True
         if 'return_data_dict' not in extension_params:
             extension_params['return_data_dict'] = False
+    if 'overlap_enrichment' not in extension_params:
+        # start the LOD enrichment before the global termination check has finished
+        extension_params['overlap_enrichment'] = False
+    if extension_params['overlap_enrichment'] and pool is not None:
+        # the speculative enrichment uses the pool from a second thread
+        pool = SerializedPool(pool)
 
     if opt_fom is None:
         opt_fom = extension_params['opt_fom']
 
+    if checkpoint is not None and checkpoint_fom is None:
+        assert reductor is not None, 'checkpoint_fom is needed for checkpoints without a reductor'
+        checkpoint_fom = reductor.fom
+    resuming = resume and checkpoint_exists(checkpoint)
+    if resuming:
+        state, reductor, opt_rom = load_checkpoint(checkpoint, checkpoint_fom, pool)
+        TR_parameters.update(state['TR_parameters'])
+        mu_k = state['mu_k']
+
     if 'FOC_tolerance' not in TR_parameters:
         TR_parameters['FOC_tolerance'] = TR_parameters['sub_tolerance']
 
@@ -540,16 +628,23 @@ def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extensi
     point_rejected = False
     additional_criteria = 0
     model_has_been_enriched = False
-    J_k = opt_rom.output_functional_hat(mu_k, pool=pool)
-    print("Starting value of the cost rom: {}".format(J_k))
-    # J_k_fom = reductor.fom.output_functional_hat(mu_k)
-    # print("Starting value of the cost fom: {}".format(J_k_fom))
-    if mesh_adaptive:
-        gradient = opt_rom.output_functional_hat_gradient(mu_k)
-        mu_box = opt_rom.primal_model.parameters.parse(mu_k.to_numpy() - gradient)
-        first_order_criticity = mu_k.to_numpy() - projection_onto_range(parameter_space, mu_box).to_numpy()
-        normgrad = np.linalg.norm(first_order_criticity)
-        print("Starting First order critical condition: {}".format(normgrad))
+    if resuming:
+        (k, mu_k, J_k, Js, FOCs, times, j_list, times_est_evaluations, J_estimator, mu_est, all_mus, mu_list,
+         JFE_list, total_subproblem_time, normgrad, estimate_gradient, old_gradient, additional_criteria, u, p, j) = \
+            [state[name] for name in TR_CHECKPOINT_STATE]
+        tic = time.time() - state['elapsed']
+        print(f'resuming from checkpoint at iteration {k} with cost {J_k}')
+    else:
+        J_k = opt_rom.output_functional_hat(mu_k, pool=pool)
+        print("Starting value of the cost rom: {}".format(J_k))
+        # J_k_fom = reductor.fom.output_functional_hat(mu_k)
+        # print("Starting value of the cost fom: {}".format(J_k_fom))
+        if mesh_adaptive:
+            gradient = opt_rom.output_functional_hat_gradient(mu_k)
+            mu_box = opt_rom.primal_model.parameters.parse(mu_k.to_numpy() - gradient)
+            first_order_criticity = mu_k.to_numpy() - projection_onto_range(parameter_space, mu_box).to_numpy()
+            normgrad = np.linalg.norm(first_order_criticity)
+            print("Starting First order critical condition: {}".format(normgrad))
     print("******************************* \n")
     while k < TR_parameters['max_iterations']:
         if point_rejected:
@@ -622,16 +717,27 @@ def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extensi
             print('checked sufficient condition, starting enrichment')
             if isinstance(reductor, QuadraticPdeoptStationaryCoerciveLODReductor):
                 print('checking global termination before expensive local enrichment')
-                u = reductor.fom.optional_forward_model.solve(mu_kp1, pool=pool)
+                # the correctors are reused for the enrichment
+                KmsijT, corT = reductor.fom.optional_forward_model.solve_for_correctors(mu_kp1, pool=pool,
+                                                                                        compute_correctors=True)
+                enrichment = None
+                if extension_params['overlap_enrichment']:
+                    # speculative, the result is dropped if the global check is fulfilled
+                    enrichment = SpeculativeEnrichment(mu_kp1, reductor, pool=pool, corT=corT, KmsijT=KmsijT)
+                u = reductor.fom.optional_forward_model.solve(mu_kp1, KmsijT=KmsijT, correctorsListT=corT, pool=pool)
                 p = reductor.fom.solve_dual(mu_kp1, U=u, pool=pool)
                 gradient = reductor.fom.output_functional_hat_gradient(mu_kp1, U=u, P=p)
                 mu_box = opt_rom.primal_model.parameters.parse(mu_kp1.to_numpy() - gradient)
                 first_order_criticity = mu_kp1.to_numpy() - projection_onto_range(parameter_space, mu_box).to_numpy()
                 normgrad = np.linalg.norm(first_order_criticity)
                 if normgrad <= TR_parameters['FOC_tolerance']:
-                    pass
+                    if enrichment is not None:
+                        enrichment.discard()
+                elif enrichment is not None:
+                    opt_rom, reductor, out_1, out_2 = enrichment.result()
                 else:
-                    opt_rom, reductor, out_1, out_2 = enrichment_step(mu_kp1, reductor, pool=pool)
+                    opt_rom, reductor, out_1, out_2 = enrichment_step(mu_kp1, reductor, pool=pool, corT=corT,
+                                                                      KmsijT=KmsijT)
             else:
                 if TR_parameters['opt_method'] == 'AdaptiveTaylor_Newton':
                     opt_rom, reductor, u, p = enrichment_step(mu_kp1, reductor, adaptive_taylor=adaptive_taylor)
@@ -677,16 +783,27 @@ def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extensi
             print('enriching to check the sufficient decrease condition')
             if isinstance(reductor, QuadraticPdeoptStationaryCoerciveLODReductor):
                 print('checking global termination before expensive local enrichment')
-                u = reductor.fom.optional_forward_model.solve(mu_kp1, pool=pool)
+                # the correctors are reused for the enrichment
+                KmsijT, corT = reductor.fom.optional_forward_model.solve_for_correctors(mu_kp1, pool=pool,
+                                                                                        compute_correctors=True)
+                enrichment = None
+                if extension_params['overlap_enrichment']:
+                    # speculative, the result is dropped if the global check is fulfilled
+                    enrichment = SpeculativeEnrichment(mu_kp1, reductor, pool=pool, corT=corT, KmsijT=KmsijT)
+                u = reductor.fom.optional_forward_model.solve(mu_kp1, KmsijT=KmsijT, correctorsListT=corT, pool=pool)
                 p = reductor.fom.solve_dual(mu_kp1, U=u, pool=pool)
                 gradient = reductor.fom.output_functional_hat_gradient(mu_kp1, U=u, P=p)
                 mu_box = opt_rom.primal_model.parameters.parse(mu_kp1.to_numpy() - gradient)
                 first_order_criticity = mu_kp1.to_numpy() - projection_onto_range(parameter_space, mu_box).to_numpy()
                 normgrad = np.linalg.norm(first_order_criticity)
                 if normgrad <= TR_parameters['FOC_tolerance']:
-                    pass
+                    if enrichment is not None:
+                        enrichment.discard()
+                elif enrichment is not None:
+                    new_rom, new_reductor, _, _ = enrichment.result()
                 else:
-                    new_rom, new_reductor, _, _ = enrichment_step(mu_kp1, reductor, pool=pool)
+                    new_rom, new_reductor, _, _ = enrichment_step(mu_kp1, reductor, pool=pool, corT=corT,
+                                                                  KmsijT=KmsijT)
             else:
                 if TR_parameters['opt_method'] == 'AdaptiveTaylor_Newton':
                     new_rom, new_reductor, u, p = enrichment_step(mu_kp1, reductor, adaptive_taylor=adaptive_taylor)
@@ -759,6 +876,14 @@ def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extensi
             print("First order critical condition: {}".format(normgrad))
 
             k = k + 1
+            if checkpoint is not None:
+                state = dict(k=k, mu_k=mu_k, J_k=J_k, Js=Js, FOCs=FOCs, times=times, j_list=j_list,
+                             times_est_evaluations=times_est_evaluations, J_estimator=J_estimator, mu_est=mu_est,
+                             all_mus=all_mus, mu_list=mu_list, JFE_list=JFE_list,
+                             total_subproblem_time=total_subproblem_time, normgrad=normgrad,
+                             estimate_gradient=estimate_gradient, old_gradient=old_gradient,
+                             additional_criteria=additional_criteria, u=u, p=p, j=j)
+                store_TR_checkpoint(checkpoint, state, TR_parameters, tic, reductor, opt_rom, checkpoint_fom, pool)
         print("******************************* \n")
 
 
@@ -797,7 +922,7 @@ def TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extensi
 
     return mu_list
 
-def search_Cauchy_Steihaug(opt_model,parameter_space,x_nocedal,mu,direction,gradient, TR_radius):
+def search_Cauchy_Steihaug(opt_model,parameter_space,x_nocedal,mu,direction,gradient, TR_radius, hessian=None):
     # This function follows Section 16.7 of Nocedal and Wright 2006
     ranges = parameter_space.ranges
     dir_dict =  opt_model.primal_model.parameters.parse(direction)
@@ -825,7 +950,7 @@ def search_Cauchy_Steihaug(opt_model,parameter_space,x_nocedal,mu,direction,grad
         t_jm1 = t_array_breakpoints[j - 1]
         t_j = t_array_breakpoints[j]
         if np.linalg.norm(p_j) != 0.0:
-            Hpj = opt_model.output_functional_hessian_operator(mu, p_j)
+            Hpj = hessian @ p_j if hessian is not None else opt_model.output_functional_hessian_operator(mu, p_j)
             f_jm1_prime = gradient.dot(p_j) + x_t_jm1.dot(Hpj)
             if f_jm1_prime > 0:
                 return x_t_jm1
@@ -865,6 +990,8 @@ def TR_Steihaug(opt_model, parameter_space, TR_parameters=None):
             TR_parameters['max_radius'] = 100
         if 'control_mu' not in TR_parameters:
             TR_parameters['control_mu'] = None
+        if 'dense_hessian' not in TR_parameters:
+            TR_parameters['dense_hessian'] = False
 
         mu_k = TR_parameters['starting_parameter']
 
@@ -924,9 +1051,14 @@ def TR_Steihaug(opt_model, parameter_space, TR_parameters=None):
             if additional_criteria:
                 break
 
+            # the hessian at mu_k is either assembled once or applied to every direction
+            hessian = opt_model.output_functional_hessian(mu_k) if TR_parameters['dense_hessian'] else None
+            hessian_action = (lambda eta: hessian @ eta) if hessian is not None else \
+                (lambda eta: opt_model.output_functional_hessian_operator(mu_k, eta))
+
             # We compute the Cauchy point doing one step of projected gradient
             print("Computing at first the Cauchy point")
-            delta_mu_k_c = search_Cauchy_Steihaug(opt_model,parameter_space,opt_model.primal_model.parameters.parse(0.0*mu_k.to_numpy()),mu_k,-gradient,gradient,TR_parameters['radius'])
+            delta_mu_k_c = search_Cauchy_Steihaug(opt_model,parameter_space,opt_model.primal_model.parameters.parse(0.0*mu_k.to_numpy()),mu_k,-gradient,gradient,TR_parameters['radius'],hessian=hessian)
 
             mu_k_c = opt_model.primal_model.parameters.parse(mu_k.to_numpy()+delta_mu_k_c)
 
@@ -940,7 +1072,7 @@ def TR_Steihaug(opt_model, parameter_space, TR_parameters=None):
                 print("Using CG-Steihaug for the linear system")
                 deltamu, itcg, rescg, infocg = TruncCGSteihaug(
                     A_func=lambda v: modified_hessian_action(mu=mu_k, Active=Active_i, Inactive=Inactive_i,
-                                                             opt_model=opt_model, eta=v), b= -np.multiply(gradient,Inactive_i), x_0 = delta_mu_k_c,
+                                                             opt_model=opt_model, eta=v, hessian=hessian), b= -np.multiply(gradient,Inactive_i), x_0 = delta_mu_k_c,
                     TR_radius=TR_parameters['radius'], tol=1.e-10)
 
 
@@ -953,11 +1085,11 @@ def TR_Steihaug(opt_model, parameter_space, TR_parameters=None):
                     mu_k_c_not_used = False
                 else:
                     deltamu = search_Cauchy_Steihaug(opt_model, parameter_space, opt_model.primal_model.parameters.parse(delta_mu_k_c),
-                                                     mu_k, deltamu, gradient,TR_parameters['radius'])
+                                                     mu_k, deltamu, gradient,TR_parameters['radius'], hessian=hessian)
                     mu_k_next = opt_model.primal_model.parameters.parse(mu_k.to_numpy()+deltamu)
             J_k_next = opt_model.output_functional_hat(mu_k_next)
             proj_dir = mu_k_next.to_numpy()-mu_k.to_numpy()
-            den = -gradient.dot(proj_dir)-0.5*proj_dir.dot(opt_model.output_functional_hessian_operator(mu_k, proj_dir))
+            den = -gradient.dot(proj_dir)-0.5*proj_dir.dot(hessian_action(proj_dir))
             rho_k = (J_k-J_k_next)/den
 
             if rho_k<= 0.25:
@@ -965,7 +1097,7 @@ def TR_Steihaug(opt_model, parameter_space, TR_parameters=None):
                     mu_k_next = mu_k_c
                     J_k_next = opt_model.output_functional_hat(mu_k_next)
                     proj_dir = mu_k_next.to_numpy() - mu_k.to_numpy()
-                    den = -gradient.dot(proj_dir) - 0.5 * proj_dir.dot(opt_model.output_functional_hessian_operator(mu_k, proj_dir))
+                    den = -gradient.dot(proj_dir) - 0.5 * proj_dir.dot(hessian_action(proj_dir))
                     rho_k = (J_k - J_k_next) / den
             if rho_k<= 0.25:
                 TR_parameters['radius'] *= 0.5
@@ -0,0 +1,107 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+"""
+Checkpoints for the TR algorithms.
+
+A checkpoint holds the state of the outer TR iteration together with the current reductor and ROM. Everything
+that is part of the full order model (the discretization, the gridlod model, the pool, ...) is only stored as a
+reference and is taken from the models of the resumed run. For an RBLOD reductor with store_in_tmp, the patch
+ROMs are also only stored as a reference to a pinned version of the PatchStore.
+"""
+
+import dill
+import os
+from numbers import Number
+
+from pdeopt.patch_store import PatchStore, _StorePickler, _StoreUnpickler
+
+
+def save_checkpoint(path, state, reductor, opt_rom, fom, pool=None):
+    references = {id(obj): tag for tag, obj in _shared_objects(fom, pool).items()}
+    state = dict(state, counters=[vars(counter).copy() for counter in _counters(fom)])
+    store, patch_versions = _patch_store(reductor), None
+    if store is not None:
+        patch_versions = [store.pin(T) for T in range(len(reductor.romT))]
+        references.update({id(rom): f'rom:{T}' for T, rom in enumerate(reductor.romT)})
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        dill.dump((store.dir if store is not None else None, patch_versions), f)
+        _StorePickler(f, references).dump((state, reductor, opt_rom))
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, fom, pool=None):
+    """
+    Returns the state dict, the reductor and the ROM of the checkpoint. The evaluation counters of `fom` are set
+    back to the state of the checkpoint.
+    """
+    objects = _shared_objects(fom, pool)
+    with open(path, 'rb') as f:
+        store_dir, patch_versions = dill.load(f)
+        state, reductor, opt_rom = _CheckpointUnpickler(f, objects, store_dir, patch_versions).load()
+    for counter, counter_state in zip(_counters(fom), state.pop('counters')):
+        vars(counter).update(counter_state)
+    return state, reductor, opt_rom
+
+
+def checkpoint_exists(path):
+    return path is not None and os.path.exists(path)
+
+
+class _CheckpointUnpickler(_StoreUnpickler):
+    # the patch ROMs are loaded from the PatchStore, which is rolled back to the pinned versions
+    def __init__(self, file, objects, store_dir, patch_versions):
+        super().__init__(file, objects)
+        self.store_dir = store_dir
+        self.patch_versions = patch_versions
+
+    def persistent_load(self, tag):
+        if tag.startswith('rom:') and tag not in self.objects:
+            T = int(tag[len('rom:'):])
+            store = PatchStore(self.store_dir)
+            store.rollback(T, self.patch_versions[T])
+            self.objects[tag] = store.load_rom(T)
+        return self.objects[tag]
+
+
+def _shared_objects(fom, pool):
+    objects = {'fom': fom}
+    _add_attributes(objects, 'fom', fom)
+    gridlod_model = getattr(fom, 'optional_forward_model', None)
+    if gridlod_model is not None:
+        _add_attributes(objects, 'fom.optional_forward_model', gridlod_model)
+    if pool is not None:
+        objects['pool'] = pool
+    return objects
+
+def _add_attributes(objects, prefix, obj):
+    for name, value in vars(obj).items():
+        if value is None or isinstance(value, (Number, str)) or (isinstance(value, tuple) and len(value) == 0):
+            continue
+        objects[f'{prefix}.{name}'] = value
+
+def _counters(fom):
+    counters = [getattr(fom, 'evaluation_counter', None),
+                getattr(getattr(fom, 'optional_forward_model', None), 'evaluation_counter', None)]
+    return [counter for counter in counters if counter is not None]
+
+def _patch_store(reductor):
+    store_in_tmp = getattr(reductor, 'store_in_tmp', False)
+    if store_in_tmp is False or getattr(reductor, 'romT', None) is None:
+        return None
+    return PatchStore(store_in_tmp if isinstance(store_in_tmp, str) else 'tmp')
@@ -32,6 +32,7 @@ from pymor.discretizers.builtin.grids.rect import RectGrid
 
 from pdeopt.model import QuadraticPdeoptStationaryModel
 from pdeopt.gridlod_model import FEMGridlodModel, GridlodModel
+from pdeopt.solvers import build_solver_backend
 
 from gridlod import util
 from gridlod.world import World
@@ -49,7 +50,7 @@ def _construct_mu_bar(problem):
             mu_bar.append(value)
     return problem.parameters.parse(mu_bar)
 
-def discretize_gridlod_fem(problem, fine_diameter):
+def discretize_gridlod_fem(problem, fine_diameter, solver_backend=None):
     n = int(1/fine_diameter * np.sqrt(2))
     assert n % 2 == 0
     N = 2
@@ -106,14 +107,17 @@ def discretize_gridlod_fem(problem, fine_diameter):
     data[0] = data[0].assemble()
     rhs_data = LincombOperator(data, coefficients)
 
-    fem_with_gridlod = FEMGridlodModel(lhs_data, rhs_data, boundaryConditions, world, g)
+    fem_with_gridlod = FEMGridlodModel(lhs_data, rhs_data, boundaryConditions, world, g,
+                                      solver_backend=build_solver_backend(solver_backend, _construct_mu_bar(problem)))
 
     return fem_with_gridlod
 
 
 def discretize_gridlod(problem, fine_diameter, coarse_elements, pool=None, counter=None, save_correctors=True,
                        store_in_tmp=False, mu_energy_product=None, use_fine_mesh=True, aFine_constructor=None,
-                       print_on_ranks=True, construct_aFine_globally=False):
+                       print_on_ranks=True, construct_aFine_globally=False, cache_size=10, cache_memory=2**30,
+                       vectorized_online=False, iterative_correctors=False, affine_patch_matrices=False,
+                       affine_cache_memory=2**30):
     n = int(1/fine_diameter * np.sqrt(2))
     assert n % coarse_elements == 0
     N = coarse_elements
@@ -202,7 +206,12 @@ def discretize_gridlod(problem, fine_diameter, coarse_elements, pool=None, count
                                  aFine_local_constructor=aFine_constructor,
                                  parameters=problem.parameters,
                                  aFineCoefficients=problem.diffusion.coefficients,
-                                 print_on_ranks=print_on_ranks)
+                                 print_on_ranks=print_on_ranks,
+                                 cache_size=cache_size, cache_memory=cache_memory,
+                                 vectorized_online=vectorized_online,
+                                 iterative_correctors=iterative_correctors,
+                                 affine_patch_matrices=affine_patch_matrices,
+                                 affine_cache_memory=affine_cache_memory)
 
     if mu_energy_product:
         # we have to do this one more time with preassemble=True. it is not too expensive since it is a coarse discretizer
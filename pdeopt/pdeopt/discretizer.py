@@ -28,6 +28,7 @@ from pymor.parameters.base import ParametricObject
 from pymor.vectorarrays.numpy import NumpyVectorSpace
 
 from pdeopt.model import QuadraticPdeoptStationaryModel
+from pdeopt.solvers import build_solver_backend, solve_model
 from pymor.discretizers.builtin.grids.rect import RectGrid
 
 def _construct_mu_bar(problem):
@@ -46,13 +47,14 @@ def discretize_quadratic_pdeopt_stationary_cg_EXC(problem, diameter=np.sqrt(2)/2
                                               domain_of_interest=None, desired_temperature=None, mu_for_u_d=None,
                                               mu_for_tikhonov=False, parameters_in_q=True, product='h1_l2_boundary',
                                               solver_options=None, use_corrected_functional=True,
-                                              adjoint_approach=True):
+                                              adjoint_approach=True, evaluation_cache_size=None, solver_backend=None):
     if use_corrected_functional and adjoint_approach:
         print('I am using the NCD corrected functional!!')
     else:
         print('I am using the non corrected functional!!')
 
     mu_bar = _construct_mu_bar(problem)
+    solver_backend = build_solver_backend(solver_backend, mu_bar)
     primal_fom, data = discretize_stationary_cg(problem, diameter=diameter, grid_type=RectGrid, mu_energy_product=mu_bar)
     if solver_options == 'pyamg':
         from pymor.bindings.pyamg import solver_options as pyamg_solver_options
@@ -113,7 +115,7 @@ def discretize_quadratic_pdeopt_stationary_cg_EXC(problem, diameter=np.sqrt(2)/2
         for key in mu_for_u_d.keys():
             if len(mu_for_u_d[key]) == 0:
                 modifified_mu.pop(key)
-        u_d = primal_fom.solve(modifified_mu)
+        u_d = solve_model(primal_fom, modifified_mu, solver_backend)
     else:
         assert desired_temperature is not None
         u_d = InterpolationOperator(grid, u_desired).as_vector()
@@ -186,14 +188,18 @@ def discretize_quadratic_pdeopt_stationary_cg_EXC(problem, diameter=np.sqrt(2)/2
                                                 **primal_fom.products))
     pde_opt_fom = QuadraticPdeoptStationaryModel(primal_fom, output_functional, opt_product=opt_product,
                                                  use_corrected_functional=use_corrected_functional,
-                                                 adjoint_approach=adjoint_approach)
+                                                 adjoint_approach=adjoint_approach,
+                                                 evaluation_cache_size=evaluation_cache_size,
+                                                 solver_backend=solver_backend)
 
     return pde_opt_fom, data, mu_bar
 
 def discretize_quadratic_NCD_pdeopt_stationary_cg(problem, diameter=np.sqrt(2)/200., weights=None,
                                                   domain_of_interest=None, desired_temperature=None, mu_for_u_d=None,
-                                                  mu_for_tikhonov=None, coarse_functional_grid_size=None, u_d=None):
+                                                  mu_for_tikhonov=None, coarse_functional_grid_size=None, u_d=None,
+                                                  solver_backend=None):
     mu_bar = _construct_mu_bar(problem)
+    solver_backend = build_solver_backend(solver_backend, mu_bar)
 
     # fine grid
     primal_fom, data = discretize_stationary_cg(problem, diameter=diameter,
@@ -215,7 +221,7 @@ def discretize_quadratic_NCD_pdeopt_stationary_cg(problem, diameter=np.sqrt(2)/2
             for key in mu_for_u_d.keys():
                 if len(mu_for_u_d[key]) == 0:
                     modifified_mu.pop(key)
-            u_d = primal_fom.solve(modifified_mu)
+            u_d = solve_model(primal_fom, modifified_mu, solver_backend)
         else:
             assert desired_temperature is not None
             u_d = InterpolationOperator(grid, u_desired).as_vector()
@@ -337,7 +343,8 @@ def discretize_quadratic_NCD_pdeopt_stationary_cg(problem, diameter=np.sqrt(2)/2
     pde_opt_fom = QuadraticPdeoptStationaryModel(primal_fom, output_functional, opt_product=opt_product,
                                                  use_corrected_functional=True, adjoint_approach=True,
                                                  coarse_projection=coarse_proj,
-                                                 fine_prolongation=fine_prolongation)
+                                                 fine_prolongation=fine_prolongation,
+                                                 solver_backend=solver_backend)
     return pde_opt_fom, data, mu_bar
 
 class FineCoarseFineOperator(L2ProductQ1):
@@ -16,20 +16,29 @@
 
 import dill
 import os
+import uuid
+from functools import partial
 import numpy as np
 import scipy.sparse as sparse
 
+from pymor.algorithms.to_matrix import to_matrix
 from pymor.core.base import ImmutableObject, BasicObject
-from pymor.operators.constructions import ZeroOperator
+from pymor.operators.constructions import LincombOperator, ZeroOperator
 from pymor.vectorarrays.numpy import NumpyVectorSpace, NumpyVectorArray
 from pymor.parallel.dummy import DummyPool
 
 from gridlod import pglod, util, fem, linalg, lod, interp, coef
 from gridlod.world import Patch
 
+from pdeopt.patch_solvers import PatchSaddleSolver, IterativePatchSolver
+from pdeopt.patch_store import PatchStore
+from pdeopt.scheduler import PatchScheduler
+from pdeopt.tools import ParameterCache
+
 
 class FEMGridlodModel(ImmutableObject):
-    def __init__(self, operator, rhs, boundaryConditions, world, g=None):
+    def __init__(self, operator, rhs, boundaryConditions, world, g=None, solver_backend=None):
+        # solver_backend: backend for the fine system on the free DoFs (see pdeopt.solvers), None: gridlod's linSolve
         self.__auto_init(locals())
         boundaryMap = boundaryConditions == 0
         self.solution_space = NumpyVectorSpace(world.NpFine, id='STATE')
@@ -64,19 +73,31 @@ class FEMGridlodModel(ImmutableObject):
         AFineFree = AFine[self.freeFine][:, self.freeFine]
         FFineFree = F[self.freeFine]
 
-        uFineFree = linalg.linSolve(AFineFree, FFineFree)
+        if self.solver_backend is None:
+            uFineFree = linalg.linSolve(AFineFree, FFineFree)
+        else:
+            assemble = lambda mu_: AFineFree if mu_ is mu else self._assemble_free_matrix(mu_)
+            uFineFree = self.solver_backend.solve(assemble, FFineFree[:, np.newaxis], mu)[:, 0]
         uFineFull = np.zeros(self.world.NpFine)
         uFineFull[self.freeFine] += uFineFree
         uFineFull += g
         return self.solution_space.from_numpy(uFineFull)
 
+    def _assemble_free_matrix(self, mu):
+        aFine_mu = self.operator.assemble(mu).matrix[0]
+        AFine = fem.assemblePatchMatrix(self.world.NWorldFine, self.world.ALocFine, aFine_mu)
+        return AFine[self.freeFine][:, self.freeFine]
+
 
 class GridlodModel(BasicObject):
     def __init__(self, operator, rhs, boundaryConditions, world, g, pool=None, evaluation_counter=None,
-                 romT=None, reductorT=None, is_rom=False, save_correctors=True,
+                 romT=None, reductorT=None, is_rom=False, save_correctors=True, rom_systemT=None,
                  coarse_pymor_rhs=None, store_in_tmp=False, use_fine_mesh=True,
                  aFine_local_constructor=None, parameters=None,
-                 aFineCoefficients=None, print_on_ranks=True, construct_patches=True, patchT=None):
+                 aFineCoefficients=None, print_on_ranks=True, construct_patches=True, patchT=None,
+                 cache_size=10, cache_memory=2**30, free_stiffness_pattern=None, vectorized_online=False,
+                 affine_patch_matrices=False, affine_cache_memory=2**30, iterative_correctors=False,
+                 iterative_tolerance=1e-2, iterative_cache_size=100):
         self.__auto_init(locals())
         if use_fine_mesh:
             self.solution_space = NumpyVectorSpace(world.NpFine, id='STATE')
@@ -94,6 +115,7 @@ class GridlodModel(BasicObject):
         self.free = np.setdiff1d(np.arange(0, world.NpCoarse), fixed)
 
         if romT:
+            assert rom_systemT is not None and len(rom_systemT) == len(romT)
             if self.save_correctors:
                 assert reductorT is not None # we need the reductor for reconstruction
             else:
@@ -141,19 +163,44 @@ class GridlodModel(BasicObject):
         else:
             self.patchT = patchT
 
+        # load balancing of all pool.map calls over patches
+        self.scheduler = PatchScheduler(self.patchT, evict=evict_patch_caches)
+
+        # sparsity pattern of the coarse stiffness matrix restricted to the free DoFs
+        if free_stiffness_pattern is None:
+            self.free_stiffness_pattern = prepare_free_stiffness_pattern(world, self.patchT, self.free)
+
         if use_fine_mesh or store_in_tmp:
             if construct_patches:
                 # this can exceed communicated memory so this should be done serialized: resolved by store_in_tmp variable
-                self.aPatchT = self.pool.map(construct_aPatches, self.patchT, operator=operator, store_in_tmp=store_in_tmp,
-                                             aFine_constructor=aFine_local_constructor)
+                self.aPatchT = self.scheduler.map(self.pool, 'construct_aPatches', construct_aPatches, self.patchT,
+                                                  operator=operator, store_in_tmp=store_in_tmp,
+                                                  aFine_constructor=aFine_local_constructor)
 
         # do not store the pool here
         del self.pool
 
-        if operator is not None:
-            self.mu_for_storage = operator.parameters.parse(np.zeros(operator.parameters.dim))
+        # the stiffness matrices of the affine components on each patch are assembled once per worker and cached
+        # there under this key, at most affine_cache_memory bytes per worker (LRU over the patches)
+        # (construct_aPatches drops ZeroOperators, so the components would not match aFineCoefficients)
+        if affine_patch_matrices and aFineCoefficients is not None and hasattr(self, 'aPatchT') and \
+                (operator is None or not any(isinstance(op, ZeroOperator) for op in operator.operators)):
+            self.affine_key = uuid.uuid4().hex
         else:
-            self.mu_for_storage = parameters.parse(np.zeros(parameters.dim))
+            self.affine_key = None
+
+        # warm started iterative corrector solves for optimization paths, the state of each patch stays on the
+        # worker under this key (for at most iterative_cache_size patches per worker, LRU). The tolerance is
+        # relative to the LOD error level O(H).
+        self.iterative_key = uuid.uuid4().hex if iterative_correctors else None
+        self.iterative_tolerance = iterative_tolerance * np.max(1. / world.NWorldCoarse)
+
+        # stacked patch ROMs, only built on the first ROM evaluation
+        self.batched_roms = None
+
+        # KmsijT, correctorsListT, KFree and its factorization for the last cache_size parameters. The correctors
+        # are large, so the cache is also bounded by cache_memory bytes (None: no bound)
+        self.cache = ParameterCache(max_entries=cache_size, max_bytes=cache_memory)
 
         if evaluation_counter:
             evaluation_counter.set_world(world)
@@ -165,26 +212,55 @@ class GridlodModel(BasicObject):
         # else:
             # self.gV_H = np.zeros(world.NpCoarse)
 
-    def solve_for_correctors(self, mu, compute_correctors=False, pool=None):
+    def solve_for_correctors(self, mu, compute_correctors=False, pool=None, patches=None):
+        # patches: indices of the patches to compute (default: all)
         if self.evaluation_counter:
             self.evaluation_counter.count(is_rom=self.is_rom, coarse=False)
         save_correctors = compute_correctors or self.save_correctors
+        if self.romT and self.vectorized_online:
+            # all patch ROMs are evaluated at once in this process, no pool needed
+            if self.batched_roms is None:
+                self.batched_roms = BatchedPatchROMs(self.romT, self.rom_systemT, self.patchT, self.parameters,
+                                                     self.store_in_tmp)
+            KmsijT, correctorsListT = self.batched_roms.solve(mu)
+            if patches is not None:
+                KmsijT, correctorsListT = [KmsijT[T] for T in patches], [correctorsListT[T] for T in patches]
+            return KmsijT, correctorsListT
         if pool is None:
             print('WARNING: You are not using a parallel pool')
         pool = pool or DummyPool()
+        patches = range(len(self.patchT)) if patches is None else patches
         if not self.romT:
-            if self.operator is not None:
+            if self.operator is not None and self.affine_key is None:
                 aFine_mu = self.operator.assemble(mu).matrix[0]
             else:
                 aFine_mu = None
-            KmsijT, correctorsListT = zip(*pool.map(self.compute_FOM_corrector, self.patchT,
-                                                    aFine_mu=aFine_mu,
-                                                    save_correctors=save_correctors,
-                                                    mu = mu))
+            KmsijT, correctorsListT = zip(*self.scheduler.map(pool, 'FOM_correctors', self.compute_FOM_corrector,
+                                                              [self.patchT[T] for T in patches], patches=patches,
+                                                              aFine_mu=aFine_mu,
+                                                              save_correctors=save_correctors,
+                                                              mu = mu))
         else:
-            def compute_ROM_correctors_(rom):
-                return compute_ROM_correctors(rom, mu=mu)
-            KmsijT, correctorsListT = zip(*pool.map(compute_ROM_correctors_, list(self.romT)))
+            KmsijT, correctorsListT = zip(*self.scheduler.map(pool, 'ROM_correctors', compute_ROM_correctors,
+                                                              [self.romT[T] for T in patches],
+                                                              [self.rom_systemT[T] for T in patches],
+                                                              [self.patchT[T] for T in patches], patches=patches,
+                                                              mu=mu))
+        return KmsijT, correctorsListT
+
+    def complete_correctors(self, mu, KmsijT, correctorsListT=None, pool=None):
+        """
+        Compute the patches that are missing in KmsijT (or in correctorsListT if the correctors are needed),
+        e.g. after an enrichment that has only touched some of the patches.
+        """
+        KmsijT = list(KmsijT)
+        correctorsListT = [None for _ in KmsijT] if correctorsListT is None else list(correctorsListT)
+        missing = [T for T, (Kmsij, cors) in enumerate(zip(KmsijT, correctorsListT))
+                   if Kmsij is None or (self.save_correctors and cors is None)]
+        if missing:
+            KmsijT_, correctorsListT_ = self.solve_for_correctors(mu, pool=pool, patches=missing)
+            for T, Kmsij, cors in zip(missing, KmsijT_, correctorsListT_):
+                KmsijT[T], correctorsListT[T] = Kmsij, cors
         return KmsijT, correctorsListT
 
     def compute_FOM_corrector(self, patch, aFine_mu, save_correctors, mu):
@@ -196,37 +272,52 @@ class GridlodModel(BasicObject):
                                                 mu=mu,
                                                 aFine_constructor=self.aFine_local_constructor,
                                                 store_in_tmp=self.store_in_tmp,
-                                                print_on_ranks=self.print_on_ranks)
+                                                print_on_ranks=self.print_on_ranks,
+                                                aPatches=self.aPatchT[patch.TInd] if self.affine_key else None,
+                                                affine_key=self.affine_key,
+                                                affine_cache_memory=self.affine_cache_memory,
+                                                iterative_key=self.iterative_key,
+                                                iterative_cache_size=self.iterative_cache_size,
+                                                iterative_tolerance=self.iterative_tolerance)
         return Kmsij, correctorsList
 
     def solve(self, mu, F=None, verbose=False, KmsijT=None, correctorsListT=None, pool=None, rhs_cor=False,
               return_coarse=False):
         # note: rhs is variable. Makes sense because we may save the computation of the correctors
-        #       for the same mu. To reuse these, we store it for only the last instance of mu
+        #       for the same mu. To reuse these, we store them in an LRU cache for the last parameters.
+        #       F can also be a list of right hand sides (or a 2D array with one rhs per row), which are
+        #       all solved with the same factorization of the coarse system. Then a list is returned.
         if F is None:
             if self.rhs is not None:
                 rhs = self.rhs
                 if rhs.parametric:
                     assert 0, "not implemented"
 
+        batched = isinstance(F, (list, tuple)) or (isinstance(F, np.ndarray) and F.ndim == 2)
+
         # boundary conditions only apply if self.rhs is used as rhs
         if F is not None:
             # g = np.zeros(self.world.NpCoarse)
-            bCoarseFull = F.copy()
+            bCoarseFull = np.array(F, dtype=float) if batched else F.copy()
         else:
             # g = self.gV_H
             f_fine = None
             bCoarseFull = self.bCoarseFull.copy()
+        bCoarseFull = np.atleast_2d(bCoarseFull)
 
-        if mu == self.mu_for_storage:
-            KmsijT, correctorsListT, KFull = self.KmsijT, self.correctorsListT, self.KFull
-        else:
+        stored = self.cache.get(mu)
+        if stored is None:
             if not KmsijT:
                 KmsijT, correctorsListT = self.solve_for_correctors(mu, pool=pool)
-            KFull = pglod.assembleMsStiffnessMatrix(self.world, self.patchT, KmsijT)
+            else:
+                KmsijT, correctorsListT = self.complete_correctors(mu, KmsijT, correctorsListT, pool=pool)
+            KFree = assemble_free_stiffness_matrix(self.free_stiffness_pattern, KmsijT)
+            # the PG-LOD system is not symmetric, so we use a sparse LU decomposition
+            factorization = sparse.linalg.splu(KFree)
             # store this
-            self.mu_for_storage = mu
-            self.KmsijT, self.correctorsListT, self.KFull = KmsijT, correctorsListT, KFull
+            stored = self.cache.put(mu, dict(KmsijT=KmsijT, correctorsListT=correctorsListT, KFree=KFree,
+                                             factorization=factorization))
+        KmsijT, correctorsListT, factorization = stored['KmsijT'], stored['correctorsListT'], stored['factorization']
 
         if rhs_cor:
             aFine_mu = self.operator.assemble(mu).matrix[0]
@@ -243,27 +334,50 @@ class GridlodModel(BasicObject):
             Rf = 0
 
         if self.evaluation_counter:
-            self.evaluation_counter.count(is_rom=self.is_rom, coarse=True)
+            for _ in range(len(bCoarseFull)):
+                self.evaluation_counter.count(is_rom=self.is_rom, coarse=True)
 
-        KFree = KFull[self.free][:, self.free]
         # bCoarseFull -= KFull * g
-        bCoarseFree = bCoarseFull[self.free]
-        xFree = sparse.linalg.spsolve(KFree, bCoarseFree)
+        bCoarseFree = bCoarseFull[:, self.free]
+        xFree = factorization.solve(bCoarseFree.T).T
 
-        xFull = np.zeros(self.world.NpCoarse)
-        xFull[self.free] = xFree
+        xFull = np.zeros((len(bCoarseFull), self.world.NpCoarse))
+        xFull[:, self.free] = xFree
 
         # store correctors
         if self.save_correctors:
-            if self.romT:
-                # we have to reconstruct the correctors for the reduced case
-                # no parallel version here
-                correctorsListT_ = list(map(reconstruct_correctors, list(correctorsListT),
-                                        list(self.reductorT), list(self.romT), self.patchT))
-            else:
-                correctorsListT_ = correctorsListT
-            basisCorrectors = pglod.assembleBasisCorrectors(self.world, self.patchT, correctorsListT_)
-            modifiedBasis = self.basis - basisCorrectors
+            modifiedBasis = self._modified_basis(correctorsListT)
+        else:
+            modifiedBasis = None
+
+        solutions = [self._lift_coarse_solution(x, modifiedBasis, Rf, F is not None, verbose, return_coarse)
+                     for x in xFull]
+        return solutions if batched else solutions[0]
+
+    def _modified_basis(self, correctorsListT):
+        if self.romT:
+            # we have to reconstruct the correctors for the reduced case
+            # no parallel version here
+            correctorsListT = list(map(partial(reconstruct_correctors, store_in_tmp=self.store_in_tmp),
+                                       list(correctorsListT), list(self.reductorT), list(self.romT), self.patchT))
+        basisCorrectors = pglod.assembleBasisCorrectors(self.world, self.patchT, correctorsListT)
+        return self.basis - basisCorrectors
+
+    def multiscale_basis(self, mu, pool=None):
+        """
+        The LOD basis at mu (coarse basis minus basis correctors) as sparse matrix with one column per coarse DoF.
+        The correctors are computed for this call, also if save_correctors is False.
+        """
+        assert self.use_fine_mesh
+        _, correctorsListT = self.solve_for_correctors(mu, compute_correctors=True, pool=pool)
+        return sparse.csc_matrix(self._modified_basis(correctorsListT))
+
+    def patch_fine_indices(self):
+        # fine DoFs of every patch without the nodes on the patch boundary that are inside of the domain
+        return [patch_fine_indices(patch, patch_geometry(patch, self.boundaryConditions)) for patch in self.patchT]
+
+    def _lift_coarse_solution(self, xFull, modifiedBasis, Rf, custom_rhs, verbose, return_coarse):
+        if self.save_correctors:
             # uLodFine = modifiedBasis * (xFull + g) + Rf
             uLodFine = modifiedBasis * (xFull) + Rf
             u_H_ms = self.solution_space.from_numpy(uLodFine)
@@ -271,7 +385,7 @@ class GridlodModel(BasicObject):
             return u_H_ms
         else:
             if self.use_fine_mesh:
-                if return_coarse and F is not None:
+                if return_coarse and custom_rhs:
                     # return xFull + g
                     return xFull
                 # uLodCoarse = self.basis * (xFull + g)
@@ -288,6 +402,40 @@ class GridlodModel(BasicObject):
 def prepare_patches(T, world, k):
     return Patch(world, k, T)
 
+def prepare_free_stiffness_pattern(world, patchT, free):
+    # this is the index map of pglod.assembleMsStiffnessMatrix, restricted to the free coarse DoFs
+    NWorldCoarse = world.NWorldCoarse
+    NpCoarse = np.prod(NWorldCoarse + 1)
+    NFree = np.size(free)
+    TpIndexMap = util.lowerLeftpIndexMap(np.ones_like(NWorldCoarse), NWorldCoarse)
+    TpStartIndices = util.lowerLeftpIndexMap(NWorldCoarse - 1, NWorldCoarse)
+
+    rows, cols = [], []
+    for patch in patchT:
+        patchpIndexMap = util.lowerLeftpIndexMap(patch.NPatchCoarse, NWorldCoarse)
+        patchpStartIndex = util.convertpCoordIndexToLinearIndex(NWorldCoarse, patch.iPatchWorldCoarse)
+        colsT = TpStartIndices[patch.TInd] + TpIndexMap
+        rowsT = patchpStartIndex + patchpIndexMap
+        cols.append(np.tile(colsT, np.size(rowsT)))
+        rows.append(np.repeat(rowsT, np.size(colsT)))
+
+    global_to_free = -np.ones(NpCoarse, dtype=np.int64)
+    global_to_free[free] = np.arange(NFree)
+    rows = global_to_free[np.concatenate(rows)]
+    cols = global_to_free[np.concatenate(cols)]
+    entries = np.flatnonzero((rows >= 0) & (cols >= 0))
+
+    # sorting by (col, row) gives the canonical csc ordering, duplicates are summed up in the scatter
+    keys, scatter = np.unique(cols[entries] * NFree + rows[entries], return_inverse=True)
+    indptr = np.zeros(NFree + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // NFree, minlength=NFree), out=indptr[1:])
+    return dict(shape=(NFree, NFree), indices=keys % NFree, indptr=indptr, entries=entries, scatter=scatter)
+
+def assemble_free_stiffness_matrix(pattern, KmsijT):
+    data = np.concatenate([np.ravel(Kmsij) for Kmsij in KmsijT])
+    values = np.bincount(pattern['scatter'], weights=data[pattern['entries']], minlength=len(pattern['indices']))
+    return sparse.csc_matrix((values, pattern['indices'], pattern['indptr']), shape=pattern['shape'])
+
 def construct_aPatches(patch, operator, store_in_tmp=False, aFine_constructor=None):
     if operator is None:
         aPatches = aFine_constructor(patch)
@@ -297,15 +445,29 @@ def construct_aPatches(patch, operator, store_in_tmp=False, aFine_constructor=No
     if store_in_tmp is not False:
         dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
         assert os.path.exists(f'{dir}/')
-        if os.path.exists(f'{dir}/apatch_{patch.TInd}'):
-            os.remove(f'{dir}/apatch_{patch.TInd}')
-        dbfile = open(f'{dir}/apatch_{patch.TInd}', "ab")
-        dill.dump(aPatches, dbfile)
+        store_aPatches(dir, patch.TInd, aPatches)
         return None
     return aPatches
 
+def store_aPatches(dir, T, aPatches):
+    # one raw .npy file per patch that can be opened as a memory map
+    tmp_path = f'{dir}/apatch_{T}.tmp.npy'
+    np.save(tmp_path, np.stack(aPatches))
+    os.replace(tmp_path, f'{dir}/apatch_{T}.npy')
+
+def load_aPatches(dir, T):
+    # read-only view, the pages are shared by all ranks on a node
+    if os.path.exists(f'{dir}/apatch_{T}.npy'):
+        return np.load(f'{dir}/apatch_{T}.npy', mmap_mode='r')
+    # dill files from older runs
+    with open(f'{dir}/apatch_{T}', "rb") as dbfile:
+        return dill.load(dbfile)
+
+def evaluate_aFine_coefficients(aFinesCoefficients, mu):
+    return [c(mu) if not isinstance(c, float) else c for c in aFinesCoefficients]
+
 def construct_aFine_from_mu(aFines, aFinesCoefficients, mu):
-    coefs = [c(mu) if not isinstance(c, float) else c for c in aFinesCoefficients]
+    coefs = evaluate_aFine_coefficients(aFinesCoefficients, mu)
     dim_array = aFines[0].ndim
     if dim_array == 3:
         a = np.einsum('ijkl,i', aFines, coefs)
@@ -315,60 +477,330 @@ def construct_aFine_from_mu(aFines, aFinesCoefficients, mu):
 
 def compute_FOM_correctors(patch, aFine_mu, boundaryConditions, save_correctors,
                            aFineCoefficients, mu, aFine_constructor,
-                           store_in_tmp=False, print_on_ranks=True):
+                           store_in_tmp=False, print_on_ranks=True, aPatches=None, affine_key=None,
+                           affine_cache_memory=None, iterative_key=None, iterative_tolerance=None,
+                           iterative_cache_size=None):
     """
     classic LOD patch computation on an element
     """
     if print_on_ranks:
         print('s', end='', flush=True)
-    IPatch = lambda: interp.L2ProjectionPatchMatrix(patch, boundaryConditions)
-
-    if aFine_mu is None:
-        if store_in_tmp:
-            dbfile = open(f'{store_in_tmp}/apatch_{patch.TInd}', "rb")
-            aPatches = dill.load(dbfile)
-            dbfile.close()
-        else:
-            aPatches = aFine_constructor(patch)
-        aPatch = construct_aFine_from_mu(aPatches, aFineCoefficients, mu)
+    geometry = patch_geometry(patch, boundaryConditions)
+    if iterative_key is not None:
+        if iterative_key not in _iterative_patch_solvers:
+            _iterative_patch_solvers[iterative_key] = ParameterCache(max_entries=iterative_cache_size)
+        solver = _iterative_patch_solvers[iterative_key].get(patch.TInd)
+        if solver is None:
+            solver = _iterative_patch_solvers[iterative_key].put(
+                patch.TInd, IterativePatchSolver(geometry.saddle_solver, iterative_tolerance))
+    else:
+        solver = geometry.saddle_solver
+
+    if aFine_mu is None and affine_key is not None:
+        # the patch matrices are a linear combination of the cached component matrices
+        if affine_key not in _affine_patch_matrices:
+            _affine_patch_matrices[affine_key] = ParameterCache(max_entries=None, max_bytes=affine_cache_memory)
+        affine_matrices = _affine_patch_matrices[affine_key].get(patch.TInd)
+        if affine_matrices is None:
+            if aPatches is None:
+                aPatches = _load_or_construct_aPatches(patch, aFine_constructor, store_in_tmp)
+            affine_matrices = _affine_patch_matrices[affine_key].put(patch.TInd,
+                                                                     AffinePatchMatrices(patch, geometry, aPatches))
+        APatchFull, AElementFull = affine_matrices.assemble(evaluate_aFine_coefficients(aFineCoefficients, mu))
+        correctorsList, Kmsij = compute_basis_correctors_from_matrices(patch, geometry, APatchFull, AElementFull,
+                                                                       solver)
     else:
-        aPatch = lambda: coef.localizeCoefficient(patch, aFine_mu)
-    correctorsList = lod.computeBasisCorrectors(patch, IPatch, aPatch)
-    csi = lod.computeBasisCoarseQuantities(patch, correctorsList, aPatch)
+        if aFine_mu is None:
+            aPatches = _load_or_construct_aPatches(patch, aFine_constructor, store_in_tmp)
+            aPatch = construct_aFine_from_mu(aPatches, aFineCoefficients, mu)
+        else:
+            aPatch = coef.localizeCoefficient(patch, aFine_mu)
+        correctorsList, Kmsij = compute_basis_correctors(patch, geometry, aPatch, solver)
     if not save_correctors:
         correctorsList = None
-    return csi.Kmsij, correctorsList
+    return Kmsij, correctorsList
+
+def _load_or_construct_aPatches(patch, aFine_constructor, store_in_tmp):
+    if store_in_tmp:
+        dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
+        return load_aPatches(dir, patch.TInd)
+    return aFine_constructor(patch)
+
+class PatchGeometry:
+    """
+    Interpolation matrix, index maps, prolongation and saddle point solver of a patch. All of them only depend on
+    the geometry class of the patch, i.e. its shape, the position of its element and the world boundaries that it
+    touches.
+    """
+    def __init__(self, patch, boundaryConditions):
+        world = patch.world
+        NPatchCoarse, NCoarseElement = patch.NPatchCoarse, world.NCoarseElement
+        self.NPatchFine = NPatchCoarse * NCoarseElement
+        self.IPatch = interp.L2ProjectionPatchMatrix(patch, boundaryConditions)
+
+        # boundary conditions are inherited from the world on the common faces, all other faces are Dirichlet
+        # (as in lod.ritzProjectionToFinePatch)
+        d = np.size(NPatchCoarse)
+        boundaryMapWorld = np.asarray(boundaryConditions) == 0
+        inherit0 = patch.iPatchWorldCoarse == 0
+        inherit1 = (patch.iPatchWorldCoarse + NPatchCoarse) == world.NWorldCoarse
+        boundaryMap = np.ones([d, 2], dtype='bool')
+        boundaryMap[inherit0, 0] = boundaryMapWorld[inherit0, 0]
+        boundaryMap[inherit1, 1] = boundaryMapWorld[inherit1, 1]
+        assert np.any(boundaryMap)
+        fixed = util.boundarypIndexMap(self.NPatchFine, boundaryMap)
+        self.free = np.setdiff1d(np.arange(np.prod(self.NPatchFine + 1)), fixed)
+        self.saddle_solver = PatchSaddleSolver(self.IPatch, self.free)
+        self.elementFinetIndexMap = util.extractElementFine(NPatchCoarse, NCoarseElement,
+                                                            patch.iElementPatchCoarse, extractElements=True)
+        self.elementFinepIndexMap = util.extractElementFine(NPatchCoarse, NCoarseElement,
+                                                            patch.iElementPatchCoarse, extractElements=False)
+        self.prolongation = fem.assembleProlongationMatrix(NPatchCoarse, NCoarseElement)
+
+# one cache per process, i.e. the geometries are built once per worker and reused for all parameters
+_patch_geometries = {}
+
+def patch_geometry(patch, boundaryConditions):
+    world = patch.world
+    inherit0 = patch.iPatchWorldCoarse == 0
+    inherit1 = (patch.iPatchWorldCoarse + patch.NPatchCoarse) == world.NWorldCoarse
+    key = (tuple(patch.NPatchCoarse), tuple(patch.iElementPatchCoarse), tuple(inherit0), tuple(inherit1),
+           tuple(world.NWorldFine), tuple(world.NCoarseElement), np.asarray(boundaryConditions).tobytes())
+    if key not in _patch_geometries:
+        _patch_geometries[key] = PatchGeometry(patch, boundaryConditions)
+    return _patch_geometries[key]
+
+def patch_fine_indices(patch, geometry):
+    world = patch.world
+    patchpStartIndex = util.convertpCoordIndexToLinearIndex(world.NWorldFine,
+                                                             patch.iPatchWorldCoarse * world.NCoarseElement)
+    return (patchpStartIndex + util.lowerLeftpIndexMap(geometry.NPatchFine, world.NWorldFine))[geometry.free]
+
+def compute_basis_correctors(patch, geometry, aPatch, solver=None):
+    """
+    Same as lod.computeBasisCorrectors and the Kmsij of lod.computeBasisCoarseQuantities, but with the cached
+    geometry of the patch. Kmsij is computed as B^T (b_j - A Q_j), where B is the prolongation on the patch.
+    """
+    world = patch.world
+    ALocFine = world.ALocFine if aPatch.ndim == 1 else world.ALocMatrixFine
+    APatchFull = fem.assemblePatchMatrix(geometry.NPatchFine, ALocFine, aPatch)
+    AElementFull = fem.assemblePatchMatrix(world.NCoarseElement, ALocFine, aPatch[geometry.elementFinetIndexMap])
+    return compute_basis_correctors_from_matrices(patch, geometry, APatchFull, AElementFull, solver)
+
+def compute_basis_correctors_from_matrices(patch, geometry, APatchFull, AElementFull, solver=None):
+    solver = solver or geometry.saddle_solver
+    world = patch.world
+    bPatchFull = np.zeros((APatchFull.shape[0], world.localBasis.shape[1]))
+    bPatchFull[geometry.elementFinepIndexMap] = AElementFull * world.localBasis
+    correctorsList = solver.solve(APatchFull, list(bPatchFull.T))
+    Kmsij = geometry.prolongation.T * (bPatchFull - APatchFull * np.column_stack(correctorsList))
+    return correctorsList, Kmsij
+
+class AffinePatchMatrices:
+    """
+    Fine stiffness matrices of the affine components of the coefficient on a patch and on its element. The
+    components share one sparsity pattern, such that the matrices for a parameter are a weighted sum of the
+    data arrays. Only the components that do not vanish on the patch are stored.
+    """
+    def __init__(self, patch, geometry, aPatches):
+        world = patch.world
+        ALocFine = world.ALocFine if aPatches[0].ndim == 1 else world.ALocMatrixFine
+        self.components = [q for q, aPatch in enumerate(aPatches) if np.any(aPatch)] or [0]
+        aPatches = [np.asarray(aPatches[q]) for q in self.components]
+        self.APatch = _common_sparsity_pattern(
+            [fem.assemblePatchMatrix(geometry.NPatchFine, ALocFine, aPatch) for aPatch in aPatches])
+        self.AElement = _common_sparsity_pattern(
+            [fem.assemblePatchMatrix(world.NCoarseElement, ALocFine, aPatch[geometry.elementFinetIndexMap])
+             for aPatch in aPatches])
+
+    @property
+    def nbytes(self):
+        return sum(A['data'].nbytes + A['indices'].nbytes + A['indptr'].nbytes for A in (self.APatch, self.AElement))
+
+    def assemble(self, coefficients):
+        coefficients = np.asarray(coefficients, dtype=float)[self.components]
+        return [sparse.csc_matrix((coefficients @ A['data'], A['indices'], A['indptr']), shape=A['shape'])
+                for A in (self.APatch, self.AElement)]
+
+# per process: affine_key -> ParameterCache of T -> AffinePatchMatrices
+_affine_patch_matrices = {}
+
+# per process: iterative_key -> ParameterCache of T -> IterativePatchSolver
+_iterative_patch_solvers = {}
+
+def evict_patch_caches(patches):
+    # called by the PatchScheduler on the previous worker of patches that have moved to another worker
+    for cache in list(_affine_patch_matrices.values()) + list(_iterative_patch_solvers.values()):
+        for T in patches:
+            cache.pop(T)
+
+def _common_sparsity_pattern(matrices):
+    matrices = [sparse.csc_matrix(A) for A in matrices]
+    shape = matrices[0].shape
+    keys = []
+    for A in matrices:
+        A.sum_duplicates()
+        keys.append(np.repeat(np.arange(shape[1]), np.diff(A.indptr)) * shape[0] + A.indices)
+    pattern = np.unique(np.concatenate(keys))
+    data = np.zeros((len(matrices), len(pattern)))
+    for i, (A, key) in enumerate(zip(matrices, keys)):
+        data[i, np.searchsorted(pattern, key)] = A.data
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(pattern // shape[0], minlength=shape[1]))))
+    return dict(shape=shape, indices=(pattern % shape[0]).astype(np.int32), indptr=indptr.astype(np.int32),
+                data=data)
 
 from rblod.parameterized_stage_1 import _build_directional_mus
-def compute_ROM_correctors(rom, mu):
-    Kmsij, u_roms = [], []
-    for dof, mu_ in enumerate(_build_directional_mus(mu)):
-        # the output is globalized which is bad for us, so we need to but it back
-        Kmsij_from_rom_opt, u_rom = rom.output(mu_, return_solution=True)
-        Kmsij_from_rom_opt = sparse.csc_matrix(Kmsij_from_rom_opt).data
-        Kmsij.append(Kmsij_from_rom_opt)
-        u_roms.append(u_rom.to_numpy())
-    Kij_constant = rom.Kij_constant(mu)
-    full_Kmsij = np.column_stack(Kmsij).flatten() + Kij_constant
-    return full_Kmsij, u_roms
-
-def reconstruct_correctors(u_roms, reductor, rom, patch):
+def compute_ROM_correctors(rom, system, patch, mu):
+    # system: reduced_patch_system of the patch model that the stage 1 ROM has been built from
+    outputs, U = solve_directional_roms(system, _build_directional_mus(mu))
+    # Kmsij has one column per direction
+    full_Kmsij = outputs[:, patch_coarse_indices(patch, outputs.shape[1])].T.ravel() + rom.Kij_constant(mu)
+    return full_Kmsij, [u[np.newaxis, :] for u in U]
+
+def solve_directional_roms(system, mus):
+    # all directional problems share the same reduced operator, so we solve them as one block. Returns the outputs
+    # and the reduced solutions with one row per direction
+    theta_a = _evaluate_coefficients(system['operator_coefficients'], mus[0])
+    theta_f = np.array([_evaluate_coefficients(system['rhs_coefficients'], mu_) for mu_ in mus])
+    theta_o = np.array([_evaluate_coefficients(system['output_coefficients'], mu_) for mu_ in mus])
+    A = np.einsum('q,qij->ij', theta_a, system['operator'])
+    U = np.linalg.solve(A, (theta_f @ system['rhs']).T).T
+    outputs = np.einsum('dq,qmi,di->dm', theta_o, system['output'], U)
+    return outputs, U
+
+def patch_coarse_indices(patch, dim):
+    # coarse DoFs of the patch in the ordering of Kmsij, in the world (dim == NpCoarse) or in the patch
+    NpPatch = int(np.prod(patch.NPatchCoarse + 1))
+    if dim == NpPatch:
+        return np.arange(NpPatch)
+    NWorldCoarse = patch.world.NWorldCoarse
+    return util.convertpCoordIndexToLinearIndex(NWorldCoarse, patch.iPatchWorldCoarse) + \
+        util.lowerLeftpIndexMap(patch.NPatchCoarse, NWorldCoarse)
+
+class BatchedPatchROMs:
+    """
+    Online phase of all patch ROMs in one process. The affine components of the reduced patch systems are
+    stacked into padded arrays (grouped by the shape of the patch problem) such that all patches are solved
+    with one batched np.linalg.solve. This requires that the patch ROMs share their parameter functionals,
+    which is checked on random parameters; ROMs that do not fit get their own group. With store_in_tmp, the
+    ROMs that are only in storage (None in romT) are loaded from the PatchStore.
+    """
+    def __init__(self, romT, rom_systemT, patchT, parameters, store_in_tmp=False, number_of_checks=2):
+        self.romT, self.patchT = list(romT), list(patchT)
+        rom_systemT = list(rom_systemT)
+        if store_in_tmp:
+            store = PatchStore(store_in_tmp if isinstance(store_in_tmp, str) else 'tmp')
+            for T, rom in enumerate(self.romT):
+                if rom is None:
+                    self.romT[T], rom_systemT[T] = store.load_rom(T), store.load_rom_system(T)
+        assert all(rom is not None for rom in self.romT), 'the patch ROMs are not available in this process'
+        random_state = np.random.RandomState(0)
+        self.check_mus = [_build_directional_mus(parameters.parse(random_state.uniform(size=parameters.dim)))
+                          for _ in range(number_of_checks)]
+        groups = {}
+        for T, decomposition in enumerate(rom_systemT):
+            NpPatch = int(np.prod(self.patchT[T].NPatchCoarse + 1))
+            signature = self._coefficient_signature(decomposition)
+            key = (NpPatch, decomposition['output'].shape[1]) + tuple(len(c) for c in signature)
+            for group in groups.setdefault(key, []):
+                if all(np.allclose(c, c_) for c, c_ in zip(signature, group['signature'])):
+                    group['indices'].append(T)
+                    group['decompositions'].append(decomposition)
+                    break
+            else:
+                groups[key].append(dict(NpPatch=NpPatch, signature=signature, indices=[T],
+                                        decompositions=[decomposition]))
+        self.groups = [self._stack(group) for group_list in groups.values() for group in group_list]
+        for group in self.groups:
+            # coarse DoFs of the patches in the (globalized) outputs
+            group['output_indices'] = np.array([patch_coarse_indices(self.patchT[T], group['O'].shape[2])
+                                                for T in group['indices']])
+
+    def _coefficient_signature(self, decomposition):
+        return [np.concatenate([_evaluate_coefficients(decomposition[f'{name}_coefficients'], mu_)
+                                for mus in self.check_mus for mu_ in mus])
+                for name in ('operator', 'rhs', 'output')]
+
+    def _stack(self, group):
+        decompositions = group.pop('decompositions')
+        P, n_max = len(decompositions), max(d['operator'].shape[-1] for d in decompositions)
+        Qa, Qf, Qo = (len(decompositions[0][f'{name}_coefficients']) for name in ('operator', 'rhs', 'output'))
+        M = decompositions[0]['output'].shape[1]
+        # zero padding of the reduced spaces, the padded block of the system matrix is the identity
+        A, F, O = np.zeros((P, Qa, n_max, n_max)), np.zeros((P, Qf, n_max)), np.zeros((P, Qo, M, n_max))
+        padding = np.zeros((P, n_max, n_max))
+        sizes = np.empty(P, dtype=int)
+        for p, d in enumerate(decompositions):
+            n = d['operator'].shape[-1]
+            A[p, :, :n, :n], F[p, :, :n], O[p, :, :, :n] = d['operator'], d['rhs'], d['output']
+            padding[p, np.arange(n, n_max), np.arange(n, n_max)] = 1.
+            sizes[p] = n
+        representative = decompositions[0]
+        group.update(A=A, F=F, O=O, padding=padding, sizes=sizes,
+                     coefficients={name: representative[f'{name}_coefficients']
+                                   for name in ('operator', 'rhs', 'output')})
+        return group
+
+    def solve(self, mu):
+        mus = _build_directional_mus(mu)
+        KmsijT, correctorsListT = [None] * len(self.romT), [None] * len(self.romT)
+        for group in self.groups:
+            coefficients = group['coefficients']
+            theta_a = _evaluate_coefficients(coefficients['operator'], mus[0])
+            theta_f = np.array([_evaluate_coefficients(coefficients['rhs'], mu_) for mu_ in mus])
+            theta_o = np.array([_evaluate_coefficients(coefficients['output'], mu_) for mu_ in mus])
+            A = np.einsum('q,pqij->pij', theta_a, group['A']) + group['padding']
+            B = np.einsum('dq,pqi->pid', theta_f, group['F'])
+            U = np.linalg.solve(A, B)
+            outputs = np.einsum('dq,pqmi,pid->pdm', theta_o, group['O'], U)
+            outputs = np.take_along_axis(outputs, group['output_indices'][:, np.newaxis, :], axis=2)
+            Kmsij = outputs.transpose(0, 2, 1).reshape(len(group['indices']), -1)
+            for p, T in enumerate(group['indices']):
+                n = group['sizes'][p]
+                KmsijT[T] = Kmsij[p] + self.romT[T].Kij_constant(mu)
+                correctorsListT[T] = [U[p, :n, dof][np.newaxis, :] for dof in range(len(mus))]
+        return tuple(KmsijT), tuple(correctorsListT)
+
+def reduced_patch_system(rom):
+    """
+    Dense affine components of a reduced patch model (as returned by the reduce of the patch reductor). The stage 1
+    ROMs (OptimizedNumpyModelStage1) only solve one direction at a time, so this is kept next to the ROM (rom_systemT)
+    to solve all directional problems as one block.
+    """
+    decomposition = {}
+    for name, attribute in (('operator', 'operator'), ('rhs', 'rhs'), ('output', 'output_functional')):
+        op = getattr(rom, attribute)
+        if isinstance(op, LincombOperator):
+            operators, coefficients = op.operators, op.coefficients
+        else:
+            operators, coefficients = [op], [1.]
+        matrices = np.array([to_matrix(o, format='dense') for o in operators])
+        if name == 'rhs':
+            matrices = matrices[:, :, 0]
+        decomposition[name] = matrices
+        decomposition[f'{name}_coefficients'] = list(coefficients)
+    return decomposition
+
+def _evaluate_coefficients(coefficients, mu):
+    return np.array([c.evaluate(mu) if hasattr(c, 'evaluate') else c for c in coefficients], dtype=float)
+
+def reconstruct_correctors(u_roms, reductor, rom, patch, store_in_tmp=False):
     u_foms = []
     for u_rom in u_roms:
         if not isinstance(u_rom, NumpyVectorArray):
             u_rom = rom.solution_space.from_numpy(u_rom)
         if reductor is None:
             # reductor is locally in storage
-            T = patch.TInd
-            dbfile = open(f'tmp/red_{T}', "rb")
-            reductor = dill.load(dbfile)
+            dir = store_in_tmp if isinstance(store_in_tmp, str) else 'tmp'
+            reductor = PatchStore(dir).load_reductor(patch.TInd)
         u_foms.append(reductor.reconstruct(u_rom).to_numpy()[0])
     return u_foms
 
-def compute_rhs_correctors(patch, aFine_mu, boundaryConditions, f_fine):
-    print('r', end='', flush=True)
+def compute_rhs_correctors(patch, aFine_mu, boundaryConditions, f_fine, print_on_ranks=True):
+    if print_on_ranks:
+        print('r', end='', flush=True)
     world = patch.world
-    IPatch = lambda: interp.L2ProjectionPatchMatrix(patch, boundaryConditions)
+    IPatch = patch_geometry(patch, boundaryConditions).IPatch
     aPatch = lambda: coef.localizeCoefficient(patch, aFine_mu)
 
     MRhsList = [f_fine[util.extractElementFine(world.NWorldCoarse,
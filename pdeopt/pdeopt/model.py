@@ -25,6 +25,9 @@ from pymor.operators.constructions import VectorOperator, LincombOperator
 from pymor.operators.constructions import IdentityOperator
 from pymor.operators.interface import Operator
 
+from pdeopt.solvers import DirectSolver
+from pdeopt.tools import ParameterCache
+
 class QuadraticPdeoptStationaryModel(StationaryModel):
 
     def __init__(self, primal_model, output_functional_dict, opt_product=None,
@@ -35,7 +38,15 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
                  optional_forward_model=None, fom=None, is_rom=False,
                  evaluation_counter=None,
                  coarse_projection=None,
-                 fine_prolongation=None):
+                 fine_prolongation=None,
+                 evaluation_cache_size=None, evaluation_cache_memory=None,
+                 hessian_cache_size=5, gradient_tensors=None,
+                 factorization_cache_size=1, factorization_cache_memory=None, solver_backend=None):
+        # evaluation_cache_size: number of parameters for which U, P, Z, W, J, the gradient and the estimates are
+        #                        cached (None: no caching). evaluation_cache_memory bounds the cache in bytes.
+        # factorization_cache_size: number of parameters for which the sparse LU decomposition of the FOM operator
+        #                           is kept (None: no caching). factorization_cache_memory bounds it in bytes.
+        # solver_backend: backend for the FOM systems (see pdeopt.solvers), replaces the cached LU decomposition.
         super().__init__(primal_model.operator, primal_model.rhs, primal_model.output_functional,
                          primal_model.products, primal_model.error_estimator, primal_model.visualizer,  name)
         self.__auto_init(locals())
@@ -54,7 +65,20 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         if fine_prolongation is None:
             self.fine_prolongation = IdentityOperator(self.solution_space)
 
-        self.hessian_parts = {}
+        self.hessian_parts = ParameterCache(max_entries=hessian_cache_size)
+        if evaluation_cache_size is not None or evaluation_cache_memory is not None:
+            self.evaluation_cache = ParameterCache(max_entries=evaluation_cache_size,
+                                                   max_bytes=evaluation_cache_memory)
+        else:
+            self.evaluation_cache = None
+        if is_rom:
+            self.solver = None
+        elif solver_backend is not None:
+            self.solver = solver_backend
+        elif factorization_cache_size is not None or factorization_cache_memory is not None:
+            self.solver = DirectSolver(cache_size=factorization_cache_size, cache_memory=factorization_cache_memory)
+        else:
+            self.solver = None
         self.local_index_to_global_index = {}
         k = 0
         for (key, size) in sorted(self.primal_model.parameters.items()):
@@ -66,6 +90,12 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         self.number_of_parameters = k
 
     def solve(self, mu, **kwargs):
+        U = self._cached(mu, 'U', kwargs=kwargs)
+        if U is not None:
+            return U
+        return self._cache(mu, 'U', self._solve(mu, **kwargs), kwargs=kwargs)
+
+    def _solve(self, mu, **kwargs):
         if self.optional_forward_model is not None:
             if isinstance(self.optional_forward_model, StationaryModel):
                 self.evaluation_counter.count(two_scale=True)
@@ -75,9 +105,19 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         else:
             if self.evaluation_counter:
                 self.evaluation_counter.count(self.is_rom)
-            return self.primal_model.solve(mu)
+            return self._solve_model(self.primal_model, mu)
 
     def solve_dual(self, mu, U=None, **kwargs):
+        P = self._cached(mu, 'P', U=U, kwargs=kwargs)
+        if P is not None:
+            return P
+        if U is None:
+            U = self.solve(mu, **kwargs)
+            if isinstance(U, tuple):
+                U = U[0] #<-- for the verbose case
+        return self._cache(mu, 'P', self._solve_dual(mu, U, **kwargs), U=U, kwargs=kwargs)
+
+    def _solve_dual(self, mu, U=None, **kwargs):
         if self.evaluation_counter and not self.optional_forward_model:
             self.evaluation_counter.count(self.is_rom)
         if U is None:
@@ -110,7 +150,7 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
                 dual_fom = self._build_dual_model(U, mu, fine_coarse_fine=True)
             else:
                 dual_fom = self._build_dual_model(U, mu)
-            return dual_fom.solve(mu)
+            return self._solve_model(dual_fom, mu)
 
     def solve_for_u_d_mu(self, component, index, mu, U=None):
         if U is None:
@@ -118,7 +158,7 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         residual_dmu_lhs = self.primal_model.operator.d_mu(component, index).apply(U, mu=mu)
         residual_dmu_rhs = self.primal_model.rhs.d_mu(component, index).as_range_array(mu)
         rhs_operator = residual_dmu_rhs-residual_dmu_lhs
-        u_d_mu = self.primal_model.operator.apply_inverse(rhs_operator, mu=mu)
+        u_d_mu = self._apply_inverse(self.primal_model.operator, rhs_operator, mu)
         return u_d_mu
 
     def solve_for_u_d_eta(self, mu, eta, U=None):
@@ -135,7 +175,7 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
                     new_rhs -= self.primal_model.operator.d_mu(key, l).apply(U, mu=mu) * eta[k]
                     new_rhs += self.primal_model.rhs.d_mu(key, l).as_range_array(mu) * eta[k]
                 k +=1
-        u_d_mu = self.primal_model.operator.apply_inverse(new_rhs, mu=mu)
+        u_d_mu = self._apply_inverse(self.primal_model.operator, new_rhs, mu)
         return u_d_mu
 
     def solve_for_p_d_mu(self, component, index, mu, U=None, P=None, u_d_mu=None):
@@ -149,9 +189,9 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
             mu = self._add_primal_to_parameter(mu, U)
             residual_dmu_lhs = self.dual_model.operator.d_mu(component, index).apply(P, mu=mu)
             residual_dmu_rhs = self.dual_model.rhs.d_mu(component, index).as_range_array(mu)
-            k_term = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply_adjoint(u_d_mu, mu)
+            k_term = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply(u_d_mu, mu)
         else:
-            dual_fom = self._build_dual_model(U, mu, forward_model=False)
+            dual_fom = self._build_dual_model(U, mu)
             residual_dmu_lhs = dual_fom.operator.d_mu(component, index).apply(P, mu=mu)
             residual_dmu_rhs = dual_fom.rhs.d_mu(component, index).as_range_array(mu)
             k_term = self.output_functional_dict['d_u_bilinear_part'].apply(u_d_mu, mu)
@@ -159,7 +199,7 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         if self.dual_model is not None:
             p_d_mu = self.dual_model.operator.apply_inverse(rhs_operator, mu=mu)
         else:
-            p_d_mu = self.primal_model.operator.apply_inverse(rhs_operator, mu=mu)
+            p_d_mu = self._apply_inverse(self.primal_model.operator, rhs_operator, mu)
         return p_d_mu
 
     def solve_for_p_d_eta(self, mu, eta, U=None, P=None, u_d_eta=None):
@@ -172,7 +212,7 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         if self.dual_model is not None:
             mu = self._add_primal_to_parameter(mu, U)
         if self.dual_model is None:
-            dual_model = self._build_dual_model(U, mu, forward_model=False)
+            dual_model = self._build_dual_model(U, mu)
             new_rhs = self.primal_model.rhs.range.zeros()
         else:
             dual_model = self.dual_model
@@ -187,45 +227,117 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
                     new_rhs += dual_model.rhs.d_mu(key, l).as_range_array(mu) * eta[k]
                 k +=1
         if self.dual_model is not None:
-            k_term = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply_adjoint(u_d_eta, mu)
+            k_term = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply(u_d_eta, mu)
         else:
             k_term = self.output_functional_dict['d_u_bilinear_part'].apply(u_d_eta, mu)
         new_rhs += k_term
-        p_d_eta = dual_model.operator.apply_inverse(new_rhs, mu=mu)
+        p_d_eta = self._apply_inverse(dual_model.operator, new_rhs, mu)
         return p_d_eta
 
+    def solve_sensitivities(self, mu, U=None, P=None, pool=None):
+        """
+        solve_for_u_d_mu and solve_for_p_d_mu for all parameter components at once. The right hand sides are
+        assembled as one block and solved with one factorization of the operator at mu. With a pool, the blocks are
+        split among the workers. Returns two VectorArrays with the sensitivities in the order of
+        local_index_to_global_index.
+        """
+        sensitivities = self._cached(mu, 'sensitivities', U=U, P=P)
+        if sensitivities is not None:
+            return sensitivities
+        if U is None:
+            U = self.solve(mu)
+        if P is None:
+            P = self.solve_dual(mu, U)
+        components = [(key, l) for (key, size) in sorted(self.primal_model.parameters.items()) for l in range(size)]
+
+        operator = self.primal_model.operator
+        rhs = operator.range.empty()
+        for key, l in components:
+            rhs.append(self.primal_model.rhs.d_mu(key, l).as_range_array(mu) - operator.d_mu(key, l).apply(U, mu=mu))
+        U_d_mu = self._solve_block(operator, rhs, mu, pool)
+
+        if self.dual_model is not None:
+            mu_dual = self._add_primal_to_parameter(mu, U)
+            dual_operator, dual_rhs = self.dual_model.operator, self.dual_model.rhs
+            k_term = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply(U_d_mu, mu=mu_dual)
+        else:
+            assert self.optional_forward_model is None, 'not available for the optional forward model'
+            mu_dual = mu
+            fine_coarse_fine = not isinstance(self.fine_prolongation, IdentityOperator)
+            dual_operator, dual_rhs = operator, self._build_dual_model(U, mu, fine_coarse_fine=fine_coarse_fine).rhs
+            k_term = self.output_functional_dict['d_u_bilinear_part'].apply(U_d_mu, mu=mu)
+        rhs = dual_operator.range.empty()
+        for key, l in components:
+            rhs.append(dual_rhs.d_mu(key, l).as_range_array(mu_dual)
+                       - dual_operator.d_mu(key, l).apply(P, mu=mu_dual))
+        rhs += k_term
+        P_d_mu = self._solve_block(dual_operator, rhs, mu_dual, pool)
+        return self._cache(mu, 'sensitivities', (U_d_mu, P_d_mu), U=U, P=P)
+
+    def _solve_block(self, operator, rhs, mu, pool=None):
+        if pool is None or len(pool) == 1 or len(rhs) == 1:
+            return self._apply_inverse(operator, rhs, mu)
+        operator = operator.assemble(mu)
+        chunks = [chunk for chunk in np.array_split(np.arange(len(rhs)), len(pool)) if len(chunk)]
+        solution = operator.source.empty()
+        for block in pool.map(_apply_inverse, [rhs[chunk] for chunk in chunks], operator=operator):
+            solution.append(block)
+        return solution
+
+    def _solve_model(self, model, mu):
+        if self.solver is not None and model.operator is self.primal_model.operator:
+            return self._apply_inverse(model.operator, model.rhs.as_range_array(mu), mu)
+        return model.solve(mu)
+
+    def _apply_inverse(self, operator, V, mu):
+        # primal and dual problems of the FOM (and their sensitivities) share the operator, thus they are all solved
+        # with the solver backend (which e.g. caches the LU decomposition or the AMG hierarchy)
+        if self.solver is None or operator is not self.primal_model.operator or operator.solver_options is not None:
+            return operator.apply_inverse(V, mu=mu)
+        assemble = lambda mu_: operator.assemble(mu_).matrix
+        return operator.source.from_numpy(self.solver.solve(assemble, V.to_numpy().T, mu).T)
+
     def solve_auxiliary_dual_problem(self, mu, U=None):
         assert self.dual_model is not None, 'this is only a ROM method'
+        Z = self._cached(mu, 'Z', U=U)
+        if Z is not None:
+            return Z
         if U is None:
             U = self.solve(mu)
-        mu = self._add_primal_to_parameter(mu, U)
-        rhs_operator_1 = self.output_functional_dict['dual_primal_projected_op'].apply(U, mu=mu)
-        rhs_operator_2 = self.output_functional_dict['dual_projected_rhs'].as_range_array(mu)
+        mu_with_U = self._add_primal_to_parameter(mu, U)
+        rhs_operator_1 = self.output_functional_dict['dual_primal_projected_op'].apply(U, mu=mu_with_U)
+        rhs_operator_2 = self.output_functional_dict['dual_projected_rhs'].as_range_array(mu_with_U)
 
         rhs_operator = rhs_operator_1 - rhs_operator_2
-        Z = self.dual_model.operator.apply_inverse(rhs_operator, mu=mu)
-        return Z
+        Z = self.dual_model.operator.apply_inverse(rhs_operator, mu=mu_with_U)
+        return self._cache(mu, 'Z', Z, U=U)
 
     def solve_auxiliary_primal_problem(self, mu, Z=None, U=None, P=None):
         assert self.dual_model is not None, 'this is only a ROM method'
+        W = self._cached(mu, 'W', U=U, P=P, Z=Z)
+        if W is not None:
+            return W
         if U is None:
             U = self.solve(mu)
         if P is None:
             P = self.solve_dual(mu, U)
         if Z is None:
             Z = self.solve_auxiliary_dual_problem(mu, U)
-        mu = self._add_primal_to_parameter(mu, U)
-        mu = self._add_dual_to_parameter(mu, P)
+        mu_with_UP = self._add_dual_to_parameter(self._add_primal_to_parameter(mu, U), P)
 
-        rhs_operator_1 = self.output_functional_dict['dual_primal_projected_op'].apply_adjoint(P, mu=mu)
-        rhs_operator_2 = self.output_functional_dict['primal_projected_dual_rhs'].as_range_array(mu)
-        rhs_operator_3 = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply_adjoint(Z, mu=mu)
+        rhs_operator_1 = self.output_functional_dict['dual_primal_projected_op'].apply_adjoint(P, mu=mu_with_UP)
+        rhs_operator_2 = self.output_functional_dict['primal_projected_dual_rhs'].as_range_array(mu_with_UP)
+        rhs_operator_3 = self.output_functional_dict['dual_projected_d_u_bilinear_part'].apply_adjoint(
+            Z, mu=mu_with_UP)
 
         rhs_operator = rhs_operator_2 - rhs_operator_1 - rhs_operator_3
-        W = self.primal_model.operator.apply_inverse(rhs_operator, mu=mu)
-        return W
+        W = self.primal_model.operator.apply_inverse(rhs_operator, mu=mu_with_UP)
+        return self._cache(mu, 'W', W, U=U, P=P, Z=Z)
 
     def output_functional_hat(self, mu, U=None, P=None, **kwargs):
+        J = self._cached(mu, 'J', U=U, P=P, kwargs=kwargs)
+        if J is not None:
+            return J
         if U is None:
             U = self.solve(mu=mu, **kwargs)
         constant_part = self.output_functional_dict['output_coefficient']
@@ -238,7 +350,8 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
             residual_lhs = self.output_functional_dict['dual_primal_projected_op'].apply2(P, U, mu=mu)[0, 0]
             residual_rhs = self.output_functional_dict['dual_projected_rhs'].apply_adjoint(P, mu=mu).to_numpy()[0, 0]
             correction_term = residual_rhs - residual_lhs
-        return constant_part(mu) + linear_part + bilinear_part + correction_term
+        J = constant_part(mu) + linear_part + bilinear_part + correction_term
+        return self._cache(mu, 'J', J, U=U, P=P, kwargs=kwargs)
 
     def corrected_output_functional_hat(self, mu, u=None, p=None, **kwargs):
         if u is None:
@@ -322,21 +435,52 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         if adjoint_approach is None:
             if self.dual_model is not None:
                 adjoint_approach = self.adjoint_approach
+        name = 'adjoint_gradient' if adjoint_approach else 'gradient'
+        gradient = self._cached(mu, name, U=U, P=P, kwargs=kwargs)
+        if gradient is not None:
+            return gradient
         gradient = []
         if U is None:
             U = self.solve(mu=mu, **kwargs)
         if P is None:
             P = self.solve_dual(mu=mu, U=U, **kwargs)
+        if self.gradient_tensors is not None and self.dual_model is not None:
+            # output_functional_hat_d_mu also uses the adjoint approach of the model
+            adjoint_approach = adjoint_approach or self.adjoint_approach
         if adjoint_approach:
             Z = self.solve_auxiliary_dual_problem(mu, U=U)
             W = self.solve_auxiliary_primal_problem(mu, Z=Z, U=U, P=P)
-        for (key, size) in sorted(self.primal_model.parameters.items()):
-            for l in range(size):
-                if adjoint_approach:
-                    gradient.append(self.adjoint_corrected_output_functional_hat_d_mu(key, l, mu, U, P, Z, W))
-                else:
-                    gradient.append(self.output_functional_hat_d_mu(key, l, mu, U, P))
-        gradient = np.array(gradient)
+        else:
+            Z, W = None, None
+        if self.gradient_tensors is not None and self.dual_model is not None:
+            gradient = self._output_functional_hat_gradient_from_tensors(mu, U, P, Z, W)
+        else:
+            for (key, size) in sorted(self.primal_model.parameters.items()):
+                for l in range(size):
+                    if adjoint_approach:
+                        gradient.append(self.adjoint_corrected_output_functional_hat_d_mu(key, l, mu, U, P, Z, W))
+                    else:
+                        gradient.append(self.output_functional_hat_d_mu(key, l, mu, U, P))
+            gradient = np.array(gradient)
+        return self._cache(mu, name, gradient, U=U, P=P, kwargs=kwargs)
+
+    def _output_functional_hat_gradient_from_tensors(self, mu, U, P, Z=None, W=None):
+        # all components of (adjoint_corrected_)output_functional_hat_d_mu at once with the AffineTensors of the ROM
+        tensors = self.gradient_tensors
+        u, p = U.to_numpy()[0], P.to_numpy()[0]
+        output_coefficient = self.output_functional_dict['output_coefficient']
+        gradient = np.array([output_coefficient.d_mu(key, l).evaluate(mu)
+                             for (key, size) in sorted(self.primal_model.parameters.items()) for l in range(size)],
+                            dtype=float)
+        gradient -= tensors['dual_primal_projected_op'].d_mu_apply2(mu, p, u)
+        gradient += tensors['dual_projected_rhs'].d_mu_apply_adjoint(mu, p)
+        if Z is not None:
+            # auxiliary problems
+            mu = self._add_dual_to_parameter(self._add_primal_to_parameter(mu, U), P)
+            z, w = Z.to_numpy()[0], W.to_numpy()[0]
+            w_term = tensors['primal_rhs'].d_mu_apply_adjoint(mu, w) - tensors['primal_operator'].d_mu_apply2(mu, w, u)
+            z_term = tensors['dual_operator'].d_mu_apply2(mu, z, p) - tensors['dual_rhs'].d_mu_apply_adjoint(mu, z)
+            gradient += w_term + z_term
         return gradient
 
     def output_functional_hat_gradient_adjoint(self, mu, **kwargs):
@@ -350,8 +494,8 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         return self.uncorrected_output_functional_hessian_operator(mu, eta, U=U, P=P, printing=printing)
 
     def extract_hessian_parts(self, mu, U=None, P=None, extract_sensitivities=True):
-        mu_tuple = tuple(mu.to_numpy())
-        if mu_tuple not in self.hessian_parts:
+        parts_dict = self.hessian_parts.get(mu, {})
+        if ('gradient_vector' if extract_sensitivities else 'U') not in parts_dict:
             output_coefficient = self.output_functional_dict['output_coefficient']
             parts_dict = {}
             if U is None:
@@ -362,16 +506,13 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
             P_d_mu_dict = {}
             k = 0
             if extract_sensitivities:
+                U_d_mu, P_d_mu = self.solve_sensitivities(mu, U, P)
                 for (key, size) in sorted(self.primal_model.parameters.items()):
-                    U_d_mu = np.empty(size, dtype=object)
-                    P_d_mu = np.empty(size, dtype=object)
+                    U_d_mu_dict[key] = np.empty(size, dtype=object)
+                    P_d_mu_dict[key] = np.empty(size, dtype=object)
                     for l in range(size):
-                        U_d_mu_ = self.solve_for_u_d_mu(key, l, mu, U)
-                        P_d_mu_ = self.solve_for_p_d_mu(key, l, mu, U, P, U_d_mu_)
-                        U_d_mu[l] = U_d_mu_
-                        P_d_mu[l] = P_d_mu_
-                    U_d_mu_dict[key] = U_d_mu
-                    P_d_mu_dict[key] = P_d_mu
+                        U_d_mu_dict[key][l] = U_d_mu[self.local_index_to_global_index[key][l]]
+                        P_d_mu_dict[key][l] = P_d_mu[self.local_index_to_global_index[key][l]]
                 gradient_operator_1, gradient_operator_2 = [], []
                 gradient_rhs, J_vector  = [], []
                 for (key, size) in sorted(self.primal_model.parameters.items()):
@@ -401,9 +542,7 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
                 parts_dict['second_gradient_vector'] = second_gradient_vector
             else:
                 parts_dict['U'], parts_dict['P'] = U, P
-            self.hessian_parts[mu_tuple] = parts_dict
-        else:
-            parts_dict = self.hessian_parts[mu_tuple]
+            parts_dict = self.hessian_parts.update(mu, **parts_dict)
         if extract_sensitivities:
             gradient_vector = parts_dict['gradient_vector']
             second_gradient_vector = parts_dict['second_gradient_vector']
@@ -449,38 +588,88 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         hessian_application = gradient_rhs - gradient_operator_1 - gradient_operator_2 + J_vector
         return hessian_application
 
+    def output_functional_hessian(self, mu, U=None, P=None):
+        """
+        Dense hessian at mu, i.e. the matrix of output_functional_hessian_operator(mu, .). For ROMs with
+        gradient_tensors and without adjoint_approach, the hessian of the uncorrected functional (as
+        uncorrected_output_functional_hessian_operator) is assembled in one sweep: all primal and dual sensitivities
+        are one dense solve with a block rhs and the hessian is a handful of tensor contractions. Otherwise, the
+        hessian operator is applied to all unit vectors. In particular, the adjoint corrected hessian (which matches
+        the corrected gradient) is never replaced by the uncorrected one.
+        """
+        parts_dict = self.hessian_parts.get(mu, {})
+        if 'hessian' in parts_dict:
+            return parts_dict['hessian']
+        if self.gradient_tensors is None or self.dual_model is None or self.adjoint_approach:
+            hessian = np.column_stack([self.output_functional_hessian_operator(mu, eta, U=U, P=P)
+                                       for eta in np.eye(self.number_of_parameters)])
+            return self.hessian_parts.update(mu, hessian=hessian)['hessian']
+        if U is None:
+            U = self.solve(mu)
+        if P is None:
+            P = self.solve_dual(mu, U)
+        tensors = self.gradient_tensors
+        u, p = U.to_numpy()[0], P.to_numpy()[0]
+        mu_with_U = self._add_primal_to_parameter(mu, U)
+
+        # sensitivities for all parameter components (one per column), see solve_for_u_d_mu and solve_for_p_d_mu
+        rhs = tensors['primal_rhs'].d_mu_vectors(mu) - tensors['primal_operator'].d_mu_apply(mu, u)
+        U_d_mu = np.linalg.solve(tensors['primal_operator'].assemble(mu), rhs.T)
+        rhs = tensors['dual_rhs'].d_mu_vectors(mu_with_U) - tensors['dual_operator'].d_mu_apply(mu_with_U, p)
+        rhs = rhs.T + tensors['dual_projected_d_u_bilinear_part'].assemble(mu_with_U) @ U_d_mu
+        P_d_mu = np.linalg.solve(tensors['dual_operator'].assemble(mu_with_U), rhs)
+
+        projected_op = tensors['dual_primal_projected_op']
+        gradient_rhs = tensors['dual_projected_rhs'].d_mu_vectors(mu) @ P_d_mu
+        gradient_operator_1 = projected_op.d_mu_apply_transpose(mu, p) @ U_d_mu
+        gradient_operator_2 = projected_op.d_mu_apply(mu, u) @ P_d_mu
+        output_coefficient = self.output_functional_dict['output_coefficient']
+        J_vector = [output_coefficient.d_mu(key, l).d_mu(key, l).evaluate(mu)
+                    for (key, size) in sorted(self.primal_model.parameters.items()) for l in range(size)]
+        hessian = gradient_rhs - gradient_operator_1 - gradient_operator_2 + np.diag(np.array(J_vector, dtype=float))
+        return self.hessian_parts.update(mu, hessian=hessian)['hessian']
+
     def estimate_error(self, U, mu):
         estimator = self.estimators['primal']
         if estimator is not None:
+            est = self._cached(mu, 'primal_estimate', U=U)
+            if est is not None:
+                return est
             if self.store_in_tmp:
-                return estimator.estimate_error(U, mu=mu, store_in_tmp=self.store_in_tmp)
+                est = estimator.estimate_error(U, mu=mu, store_in_tmp=self.store_in_tmp)
             else:
-                return estimator.estimate_error(U, mu=mu)
+                est = estimator.estimate_error(U, mu=mu)
+            return self._cache(mu, 'primal_estimate', est, U=U)
         else:
             raise NotImplementedError('Model has no primal estimator.')
 
     def estimate_dual(self, U, P, mu):
         estimator = self.estimators['dual']
         if estimator is not None:
-            if self.dual_model is not None:
-                mu = self._add_primal_to_parameter(mu, U)
+            est = self._cached(mu, 'dual_estimate', U=U, P=P)
+            if est is not None:
+                return est
+            mu_with_U = self._add_primal_to_parameter(mu, U) if self.dual_model is not None else mu
             if self.store_in_tmp:
-                return estimator.estimate_error(U, P, mu=mu, store_in_tmp=self.store_in_tmp)
+                est = estimator.estimate_error(U, P, mu=mu_with_U, store_in_tmp=self.store_in_tmp)
             else:
-                return estimator.estimate_error(U, P, mu=mu)
+                est = estimator.estimate_error(U, P, mu=mu_with_U)
+            return self._cache(mu, 'dual_estimate', est, U=U, P=P)
         else:
             raise NotImplementedError('Model has no estimator for the dual problem.')
 
     def estimate_output_functional_hat(self, U, P, mu):
         estimator = self.estimators['output_functional_hat']
         if estimator is not None:
-            if self.dual_model is not None:
-                mu = self._add_primal_to_parameter(mu, U)
+            est = self._cached(mu, 'J_estimate', U=U, P=P)
+            if est is not None:
+                return est
+            mu_with_U = self._add_primal_to_parameter(mu, U) if self.dual_model is not None else mu
             if self.store_in_tmp:
-                est = estimator.estimate_error(U, P, mu=mu, store_in_tmp=self.store_in_tmp)
+                est = estimator.estimate_error(U, P, mu=mu_with_U, store_in_tmp=self.store_in_tmp)
             else:
-                est = estimator.estimate_error(U, P, mu=mu)
-            return est
+                est = estimator.estimate_error(U, P, mu=mu_with_U)
+            return self._cache(mu, 'J_estimate', est, U=U, P=P)
         else:
             raise NotImplementedError('Model has no estimator for the output functional hat.')
 
@@ -492,8 +681,10 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
             if self._check_input(component, index):
                 if self.dual_model is not None:
                     mu = self._add_primal_to_parameter(mu, U)
-                U_d_mu = self.solve_for_u_d_mu(component=component, index=index, mu=mu, U=U)
-                P_d_mu = self.solve_for_p_d_mu(component=component, index=index, mu=mu, U=U, u_d_mu=U_d_mu, P=P)
+                if U_d_mu is None:
+                    U_d_mu = self.solve_for_u_d_mu(component=component, index=index, mu=mu, U=U)
+                if P_d_mu is None:
+                    P_d_mu = self.solve_for_p_d_mu(component=component, index=index, mu=mu, U=U, u_d_mu=U_d_mu, P=P)
                 return estimator.estimate_error(U, P, mu=mu, U_d_mu=U_d_mu, P_d_mu=P_d_mu)
             else:
                 return 0
@@ -507,9 +698,12 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
             U = self.solve(mu)
         if P is None:
             P = self.solve_dual(mu, U)
+        U_d_mu, P_d_mu = self.solve_sensitivities(mu, U, P)
         for (key, size) in sorted(self.primal_model.parameters.items()):
             for l in range(size):
-                gradient.append(self.estimate_output_functional_hat_d_mu(key, l, U, P, mu))
+                k = self.local_index_to_global_index[key][l]
+                gradient.append(self.estimate_output_functional_hat_d_mu(key, l, U, P, mu,
+                                                                         U_d_mu=U_d_mu[k], P_d_mu=P_d_mu[k]))
         gradient = np.array(gradient)
         return np.linalg.norm(gradient)
 
@@ -569,6 +763,27 @@ class QuadraticPdeoptStationaryModel(StationaryModel):
         else:
             return self._build_dual_model(U, mu)
 
+    def _cached(self, mu, name, kwargs=None, **inputs):
+        # value of the evaluation cache at mu, if it has been computed with the same inputs (e.g. U and P).
+        # Inputs that are None are taken from the cache anyway.
+        if self.evaluation_cache is None or (kwargs and not set(kwargs) <= {'pool'}):
+            return None
+        entry = self.evaluation_cache.get(mu)
+        if entry is None or name not in entry:
+            return None
+        if any(value is not None and value is not entry.get(key) for key, value in inputs.items()):
+            return None
+        return entry[name]
+
+    def _cache(self, mu, name, value, kwargs=None, **inputs):
+        # only values that have been computed from the cached inputs are stored
+        if self.evaluation_cache is None or (kwargs and not set(kwargs) <= {'pool'}):
+            return value
+        entry = self.evaluation_cache.peek(mu, {})
+        if all(value_ is None or value_ is entry.get(key) for key, value_ in inputs.items()):
+            self.evaluation_cache.update(mu, **{name: value})
+        return value
+
     def _add_primal_to_parameter(self, mu, U):
         assert mu is not None
         return mu.with_(basis_coefficients=U.to_numpy()[0])
@@ -614,23 +829,32 @@ def build_initial_basis(opt_fom, mus=None, build_sensitivities=False):
         dont_debug = 1 # set 0 for debugging
         u = opt_fom.solve(mu)
         primal_basis.append(u)
+        p = None
         if i != 1 or dont_debug: #< -- for debuginng
-            dual_basis.append(opt_fom.solve_dual(mu, U=u))
+            p = opt_fom.solve_dual(mu, U=u)
+            dual_basis.append(p)
         dual_basis = gram_schmidt(dual_basis, product=opt_fom.opt_product)
         primal_basis = gram_schmidt(primal_basis, product=opt_fom.opt_product)
         if build_sensitivities:
+            # all sensitivities with one factorization
+            U_d_mu, P_d_mu = opt_fom.solve_sensitivities(mu, U=u, P=p)
             for (key, size) in opt_fom.parameters.items():
                 for l in range(size):
+                    k = opt_fom.local_index_to_global_index[key][l]
                     if key == 'biot' or dont_debug: #< -- for debuginng
                         if i != 2 and i!=3 or dont_debug: #< -- for debuginng
-                            primal_sens_basis[key][l].append(opt_fom.solve_for_u_d_mu(key, l, mu))
+                            primal_sens_basis[key][l].append(U_d_mu[k])
                     else: #< -- for debuginng
                         if i!=3 or dont_debug: #< -- for debuginng
-                            primal_sens_basis[key][l].append(opt_fom.solve_for_u_d_mu(key, l, mu))
-                    dual_sens_basis[key][l].append(opt_fom.solve_for_p_d_mu(key, l, mu))
+                            primal_sens_basis[key][l].append(U_d_mu[k])
+                    dual_sens_basis[key][l].append(P_d_mu[k])
                     primal_sens_basis[key][l] = gram_schmidt(primal_sens_basis[key][l], product=opt_fom.opt_product)
                     dual_sens_basis[key][l] = gram_schmidt(dual_sens_basis[key][l], product=opt_fom.opt_product)
     if build_sensitivities:
         return primal_basis, dual_basis, primal_sens_basis, dual_sens_basis
     else:
         return primal_basis, dual_basis
+
+
+def _apply_inverse(rhs, operator):
+    return operator.apply_inverse(rhs)
@@ -0,0 +1,166 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from scipy.sparse.linalg import splu
+
+try:
+    from sksparse.cholmod import analyze
+    HAVE_CHOLMOD = True
+except ImportError:
+    HAVE_CHOLMOD = False
+
+
+class PatchSaddleSolver:
+    """
+    Solver for the constrained corrector problems of a patch
+
+        A x + I^T lambda = b,    I x = 0
+
+    on the free DoFs, using the Schur complement of the interpolation constraint (as gridlod's
+    schurComplementSolver). The sparsity pattern of A does not depend on the parameter. Therefore the symbolic
+    factorization (fill reducing ordering and elimination tree) is only computed once and every new A is only
+    factorized numerically. CHOLMOD is used if scikit-sparse is available. Otherwise SuperLU is used with a
+    fixed reverse Cuthill-McKee ordering.
+    """
+    def __init__(self, IPatch, free, use_cholmod=True):
+        self.free = free
+        self.size = IPatch.shape[1]
+        self.IFree = sparse.csr_matrix(IPatch)[:, free]
+        self.IFreeT = self.IFree.T.toarray()
+        self.use_cholmod = use_cholmod and HAVE_CHOLMOD
+        self.indptr, self.indices = None, None
+        self.symbolic_factorizations = 0
+
+    def restrict(self, A):
+        A = sparse.csr_matrix(A)[self.free][:, self.free].tocsc()
+        A.sort_indices()
+        return A
+
+    def factorize(self, A):
+        # A is already restricted to the free DoFs, returns a function that solves with A
+        if self.indptr is None or not (np.array_equal(A.indptr, self.indptr)
+                                       and np.array_equal(A.indices, self.indices)):
+            self.indptr, self.indices = A.indptr.copy(), A.indices.copy()
+            self.symbolic_factorizations += 1
+            if self.use_cholmod:
+                self.factor = analyze(A)
+            else:
+                self.permutation = reverse_cuthill_mckee(A, symmetric_mode=True)
+                self.inverse_permutation = np.argsort(self.permutation)
+        if self.use_cholmod:
+            self.factor.cholesky_inplace(A)
+            return self.factor
+        p, p_inv = self.permutation, self.inverse_permutation
+        lu = splu(A[p][:, p].tocsc(), permc_spec='NATURAL')
+        return lambda b: lu.solve(b[p])[p_inv]
+
+    def constrained_solver(self, A, copy=False):
+        """
+        Returns a function that solves the constrained problem for a block of right hand sides (restricted to the
+        free DoFs) with the factorization of A. With copy=True, the factorization is not overwritten by later
+        calls of `factorize`.
+        """
+        solve = self.factorize(A)
+        if copy and self.use_cholmod:
+            solve = solve.copy()
+        Y = solve(self.IFreeT)
+        S = self.IFree @ Y
+
+        def constrained_solve(B):
+            X = solve(B)
+            return X - Y @ np.linalg.solve(S, self.IFree @ X)
+        return constrained_solve
+
+    def solve(self, A, bList):
+        B = np.column_stack([b[self.free] for b in bList])
+        X = self.constrained_solver(self.restrict(A))(B)
+        return self.extend(X)
+
+    def extend(self, X):
+        x = np.zeros((self.size, X.shape[1]))
+        x[self.free] = X
+        return list(x.T)
+
+
+class IterativePatchSolver:
+    """
+    Iterative solver for the constrained corrector problems of one patch along an optimization path.
+
+    Projected CG with a constraint preconditioner, i.e. the exact constrained solve with the matrix of a reference
+    parameter. All iterates stay in the kernel of the interpolation. The solution of the last call is the initial
+    guess and the reference factorization is recycled until CG needs more than `refactorize_iterations`
+    iterations. The iteration is stopped if the preconditioned residual is below `tolerance` relative to the
+    energy norm of the iterate.
+    """
+    def __init__(self, saddle_solver, tolerance, max_iterations=50, refactorize_iterations=15):
+        self.saddle_solver = saddle_solver
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.refactorize_iterations = refactorize_iterations
+        self.preconditioner = None
+        self.X = None
+        # only summary statistics, the solver lives for the whole optimization
+        self.solves = 0
+        self.total_iterations = 0
+
+    def solve(self, A, bList):
+        A = self.saddle_solver.restrict(A)
+        B = np.column_stack([b[self.saddle_solver.free] for b in bList])
+        if self.preconditioner is None or self.X is None or self.X.shape != B.shape:
+            self.preconditioner = self.saddle_solver.constrained_solver(A, copy=True)
+            X, iterations, converged = self.preconditioner(B), 0, True
+        else:
+            X, iterations, converged = projected_pcg(A, B, self.preconditioner, self.X.copy(), self.tolerance,
+                                                     self.max_iterations)
+            if not converged or iterations > self.refactorize_iterations:
+                self.preconditioner = self.saddle_solver.constrained_solver(A, copy=True)
+                if not converged:
+                    X = self.preconditioner(B)
+        self.solves += 1
+        self.total_iterations += iterations
+        self.X = X
+        return self.saddle_solver.extend(X)
+
+
+def projected_pcg(A, B, precondition, X, tolerance, max_iterations):
+    """
+    CG for all columns of B at once, where `precondition` maps into the constrained subspace.
+    Returns the solution, the number of iterations and whether all columns converged.
+    """
+    AX = A @ X
+    R = B - AX
+    Z = precondition(R)
+    P = Z.copy()
+    rz = np.einsum('ij,ij->j', R, Z)
+    for iteration in range(max_iterations + 1):
+        energy = np.einsum('ij,ij->j', X, AX)
+        active = np.sqrt(np.abs(rz)) > tolerance * np.sqrt(np.abs(energy))
+        if not np.any(active) or iteration == max_iterations:
+            return X, iteration, not np.any(active)
+        AP = A @ P
+        pAp = np.einsum('ij,ij->j', P, AP)
+        alpha = np.divide(rz, pAp, out=np.zeros_like(rz), where=active & (pAp != 0))
+        X += alpha * P
+        AX += alpha * AP
+        R -= alpha * AP
+        Z = precondition(R)
+        rz_new = np.einsum('ij,ij->j', R, Z)
+        beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=active & (rz != 0))
+        P = Z + beta * P
+        rz = rz_new
@@ -0,0 +1,303 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import dill
+import json
+import os
+import numpy as np
+
+
+class PatchStore:
+    """
+    Versioned on-disk store for the patch reductors and ROMs of the RBLOD reductor (store_in_tmp).
+
+    The patch model of a reductor is written with version 0 and kept for all later versions. All bases of a
+    reductor are append-only, so every new version only writes the vectors that have been added since the last one.
+    If a basis got shorter, the new version starts a new chunk set (`resets` in the manifest), the chunks of a
+    pinned or held version are kept. The projected operators of the reductor (`_last_rom`) are not stored, the next
+    `reduce` projects them again, which an extension needs anyway. The remaining state of the reductor, the
+    optimized ROM and its error residual are written in full per version. Their size only depends on the reduced
+    dimension, not on the fine patch. All files are written atomically and the manifest `red_{T}.json` is replaced
+    last, so a crash never leaves a half-written version behind.
+
+    All readers in pdeopt use the load methods. Only the estimators of the optimized ROMs read the error residual
+    of the current version by name (`estimate_error(mu, store_in_tmp=dir)`), so it is also linked to `err_res_{T}`.
+
+    Files for patch T:
+        fom_{T}                         patch model of the reductor
+        basis_{T}.{name}.{version}.npy  vectors that have been appended to basis `name` in `version`
+        red_{T}.{version}               reductor without its patch model, bases and projected operators
+        rom_{T}.{version}               optimized ROM and its reduced_patch_system
+        err_res_{T}.{version}           error residual of the optimized ROM
+        err_res_{T}                     error residual of the current version
+        red_{T}.json                    manifest
+    """
+    def __init__(self, dir='tmp', keep_versions=1):
+        assert keep_versions >= 1
+        self.dir = dir
+        self.keep_versions = keep_versions
+
+    def manifest(self, T):
+        path = f'{self.dir}/red_{T}.json'
+        if not os.path.exists(path):
+            return dict(version=-1, chunks=[], lengths={})
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def version(self, T):
+        return self.manifest(T)['version']
+
+    def write(self, T, reductor, rom, error_residual=None, system=None):
+        """
+        Store a new version of the patch, `system` is the reduced_patch_system of the ROM. Returns False if nothing
+        changed since the last version.
+        """
+        manifest = self.manifest(T)
+        arrays = _tracked_arrays(reductor)
+        lengths = manifest['lengths']
+        if manifest['version'] >= 0 and all(len(va) == lengths.get(name, 0) for name, va in arrays.items()):
+            return False
+        version = manifest['version'] + 1
+        obsolete = []
+        if any(len(va) < lengths.get(name, 0) for name, va in arrays.items()):
+            # the bases have not only been extended, we start from scratch with a new chunk set
+            manifest, obsolete = self._reset(T, manifest, version)
+            lengths = manifest['lengths']
+
+        if version == 0:
+            # the patch model of an older store (e.g. of another problem) must not be reused
+            self._dump(f'{self.dir}/fom_{T}', reductor.fom)
+        for name, va in arrays.items():
+            new_vectors = va.to_numpy()[lengths.get(name, 0):]
+            if len(new_vectors):
+                self._save_array(f'{self.dir}/basis_{T}.{name}.{version}.npy', new_vectors)
+                manifest['chunks'].append([name, version, len(new_vectors)])
+            lengths[name] = len(va)
+
+        references = _model_references(reductor.fom)
+        references.update({id(va): f'basis:{name}' for name, va in arrays.items()})
+        if getattr(reductor, '_last_rom', None) is not None:
+            references[id(reductor._last_rom)] = 'last_rom'
+        spaces = {name: va.space for name, va in arrays.items()}
+        self._dump(f'{self.dir}/red_{T}.{version}', spaces, reductor, references=references)
+        self._dump(f'{self.dir}/rom_{T}.{version}', rom, system)
+        if error_residual is not None:
+            self._dump(f'{self.dir}/err_res_{T}.{version}', error_residual)
+
+        manifest.update(version=version, lengths=lengths)
+        self._write_manifest(T, manifest)
+        self._link_error_residual(T, version)
+        for path in obsolete:
+            _remove_file(path)
+        self._prune(T, version)
+        return True
+
+    def load_reductor(self, T):
+        manifest = self.manifest(T)
+        version = manifest['version']
+        assert version >= 0, f'patch {T} is not in the store'
+        with open(f'{self.dir}/fom_{T}', 'rb') as f:
+            fom = dill.load(f)
+        objects = {tag: obj for obj, tag in zip(*_model_objects(fom))}
+        objects['last_rom'] = None
+        first = _first_version(manifest, version)
+        with open(f'{self.dir}/red_{T}.{version}', 'rb') as f:
+            spaces = dill.load(f)
+            for name, space in spaces.items():
+                chunks = [np.load(f'{self.dir}/basis_{T}.{name_}.{v}.npy')
+                          for name_, v, _ in manifest['chunks'] if name_ == name and first <= v <= version]
+                vectors = np.concatenate(chunks) if chunks else np.zeros((0, space.dim))
+                objects[f'basis:{name}'] = space.from_numpy(vectors)
+            return _StoreUnpickler(f, objects).load()
+
+    def load_rom(self, T):
+        with open(f'{self.dir}/rom_{T}.{self.version(T)}', 'rb') as f:
+            return dill.load(f)
+
+    def load_rom_system(self, T):
+        with open(f'{self.dir}/rom_{T}.{self.version(T)}', 'rb') as f:
+            dill.load(f)
+            return dill.load(f)
+
+    def load_error_residual(self, T):
+        path = f'{self.dir}/err_res_{T}.{self.version(T)}'
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return dill.load(f)
+
+    def rollback(self, T, version):
+        """
+        Go back to an older version of the patch, all newer data is removed.
+        """
+        manifest = self.manifest(T)
+        if manifest['version'] <= version:
+            return
+        assert os.path.exists(f'{self.dir}/red_{T}.{version}'), f'version {version} of patch {T} has been pruned'
+        for name, v, _ in manifest['chunks']:
+            if v > version:
+                os.remove(f'{self.dir}/basis_{T}.{name}.{v}.npy')
+        chunks = [chunk for chunk in manifest['chunks'] if chunk[1] <= version]
+        resets = [reset for reset in manifest.get('resets', []) if reset <= version]
+        lengths = {}
+        for name, v, length in chunks:
+            if v >= max([0] + resets):
+                lengths[name] = lengths.get(name, 0) + length
+        self._write_manifest(T, dict(version=version, chunks=chunks, lengths=lengths, resets=resets,
+                                     pinned=manifest.get('pinned'), held=manifest.get('held')))
+        self._link_error_residual(T, version)
+        for v in range(version + 1, manifest['version'] + 1):
+            self._remove_version(T, v)
+
+    def remove(self, T):
+        manifest = self.manifest(T)
+        for name, v, _ in manifest['chunks']:
+            _remove_file(f'{self.dir}/basis_{T}.{name}.{v}.npy')
+        for v in range(manifest['version'] + 1):
+            self._remove_version(T, v)
+        _remove_file(f'{self.dir}/err_res_{T}')
+        _remove_file(f'{self.dir}/fom_{T}')
+        _remove_file(f'{self.dir}/red_{T}.json')
+
+    def pin(self, T, version=None):
+        """
+        Protect a version (default: the current one) from pruning, e.g. because a checkpoint refers to it.
+        Only one version per patch can be pinned.
+        """
+        manifest = self.manifest(T)
+        manifest['pinned'] = manifest['version'] if version is None else version
+        self._write_manifest(T, manifest)
+        return manifest['pinned']
+
+    def hold(self, T):
+        """
+        Protect the current version from pruning until `release`, independent of the pinned version, e.g. to
+        roll back a speculative enrichment. Returns the held version.
+        """
+        manifest = self.manifest(T)
+        manifest['held'] = manifest['version']
+        self._write_manifest(T, manifest)
+        return manifest['held']
+
+    def release(self, T):
+        manifest = self.manifest(T)
+        if manifest.pop('held', None) is not None:
+            self._write_manifest(T, manifest)
+
+    def _reset(self, T, manifest, version):
+        # all older versions become obsolete, except for the pinned and the held version (e.g. of a checkpoint).
+        # The obsolete files are only removed after the new manifest has been written.
+        protected = [v for v in (manifest.get('pinned'), manifest.get('held')) if v is not None and v >= 0]
+        chunks, obsolete = [], []
+        for chunk in manifest['chunks']:
+            name, v, _ = chunk
+            if any(_first_version(manifest, p) <= v <= p for p in protected):
+                chunks.append(chunk)
+            else:
+                obsolete.append(f'{self.dir}/basis_{T}.{name}.{v}.npy')
+        for v in range(manifest['version'] + 1):
+            if v not in protected:
+                obsolete.extend(f'{self.dir}/{name}_{T}.{v}' for name in ('red', 'rom', 'err_res'))
+        manifest.update(chunks=chunks, lengths={}, resets=manifest.get('resets', []) + [version])
+        return manifest, obsolete
+
+    def _prune(self, T, version):
+        manifest = self.manifest(T)
+        protected = (manifest.get('pinned'), manifest.get('held'))
+        for old_version in range(version - self.keep_versions + 1):
+            if old_version not in protected and os.path.exists(f'{self.dir}/red_{T}.{old_version}'):
+                self._remove_version(T, old_version)
+
+    def _remove_version(self, T, version):
+        for name in ('red', 'rom', 'err_res'):
+            _remove_file(f'{self.dir}/{name}_{T}.{version}')
+
+    def _link_error_residual(self, T, version):
+        path = f'{self.dir}/err_res_{T}.{version}'
+        if os.path.exists(path):
+            _remove_file(f'{self.dir}/err_res_{T}.tmp')
+            os.link(path, f'{self.dir}/err_res_{T}.tmp')
+            os.replace(f'{self.dir}/err_res_{T}.tmp', f'{self.dir}/err_res_{T}')
+        else:
+            _remove_file(f'{self.dir}/err_res_{T}')
+
+    def _write_manifest(self, T, manifest):
+        tmp_path = f'{self.dir}/red_{T}.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, f'{self.dir}/red_{T}.json')
+
+    def _save_array(self, path, array):
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    def _dump(self, path, *objs, references=None):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            for obj in objs:
+                _StorePickler(f, references or {}).dump(obj)
+        os.replace(tmp_path, path)
+
+
+class _StorePickler(dill.Pickler):
+    # objects that are stored elsewhere are only written as a reference
+    def __init__(self, file, references):
+        super().__init__(file)
+        self.references = references
+
+    def persistent_id(self, obj):
+        return self.references.get(id(obj))
+
+
+class _StoreUnpickler(dill.Unpickler):
+    def __init__(self, file, objects):
+        super().__init__(file)
+        self.objects = objects
+
+    def persistent_load(self, tag):
+        return self.objects[tag]
+
+
+def _first_version(manifest, version):
+    # first version of the chunk set that `version` belongs to
+    return max([0] + [reset for reset in manifest.get('resets', []) if reset <= version])
+
+def _tracked_arrays(reductor):
+    arrays = {f'bases_{key}': basis for key, basis in reductor.bases.items()}
+    residual_reductor = getattr(reductor, 'residual_reductor', None)
+    residual_range = getattr(residual_reductor, 'residual_range', False)
+    if residual_range is not False and residual_range is not None:
+        arrays['residual_range'] = residual_range
+    return arrays
+
+def _model_objects(fom):
+    objects, tags = [fom], ['fom']
+    for name in ('operator', 'rhs', 'output_functional'):
+        if getattr(fom, name, None) is not None:
+            objects.append(getattr(fom, name))
+            tags.append(f'fom:{name}')
+    for name, product in (getattr(fom, 'products', None) or {}).items():
+        objects.append(product)
+        tags.append(f'fom:products:{name}')
+    return objects, tags
+
+def _model_references(fom):
+    return {id(obj): tag for obj, tag in zip(*_model_objects(fom))}
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
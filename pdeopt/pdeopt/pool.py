@@ -0,0 +1,275 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import dill
+import io
+import os
+import threading
+import uuid
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from pymor.parallel.dummy import DummyPool
+from pymor.parallel.interface import RemoteObject
+
+
+class SharedMemoryPool:
+    """
+    Single node replacement for pymor's MPIPool, based on concurrent.futures.
+
+    Every worker is its own single process executor, such that `map` sends the same contiguous chunks of the
+    arguments to the same workers as pymor's pools (the per process caches of the patch computations and the
+    PatchScheduler rely on this). Functions, arguments and results are serialized with dill.
+
+    Long-lived data (e.g. the gridlod model with its patch coefficients and patch descriptors) can be registered
+    with `share(obj)`: all numpy arrays in obj of at least `shared_memory_threshold` bytes are placed in
+    multiprocessing.shared_memory once. Whenever such an array is part of the arguments, the workers attach to it
+    as a read-only array without copying. All other arrays (e.g. per call right hand sides) are pickled as usual.
+    `unshare(obj)` releases the segments on the master and on the workers. As for pymor's pools, `push(obj)` sends
+    an object to all workers once, the returned RemoteObject can be passed as a keyword argument.
+
+    When the 'spawn' start method is used (default on macOS and Windows), the pool has to be created under
+    `if __name__ == '__main__':`.
+    """
+    def __init__(self, max_workers=None, shared_memory_threshold=2**20):
+        self.max_workers = max_workers or os.cpu_count()
+        self.shared_memory_threshold = shared_memory_threshold
+        self._executors = [ProcessPoolExecutor(max_workers=1) for _ in range(self.max_workers)]
+        # id(array) -> (array, SharedMemory) of the registered arrays, the array is kept alive such that its id is
+        # not reused
+        self._shared = {}
+
+    def __len__(self):
+        return self.max_workers
+
+    def __reduce__(self):
+        # the pool cannot be sent to the workers, there it is only a serial pool
+        return DummyPool, ()
+
+    def apply(self, function, *args, **kwargs):
+        payload = self._dumps((function, args, _map_kwargs(kwargs)))
+        futures = [executor.submit(_apply, payload) for executor in self._executors]
+        return [dill.loads(future.result()) for future in futures]
+
+    def apply_only(self, function, worker, *args, **kwargs):
+        payload = self._dumps((function, args, _map_kwargs(kwargs)))
+        return dill.loads(self._executors[worker].submit(_apply, payload).result())
+
+    def push(self, obj):
+        key = uuid.uuid4().hex
+        self.apply(_push, key, obj)
+        return _SharedMemoryRemoteObject(self, key)
+
+    def map(self, function, *args, **kwargs):
+        assert len(set(len(arg) for arg in args)) == 1
+        kwargs = _map_kwargs(kwargs)
+        length = len(args[0])
+        # same chunks as pymor.parallel.basic._split_into_chunks
+        chunk_size = length // self.max_workers + (1 if length % self.max_workers > 0 else 0)
+        futures = []
+        for worker, start in enumerate(range(0, length, chunk_size)):
+            chunk = [list(arg[start:start + chunk_size]) for arg in args]
+            payload = self._dumps((function, chunk, kwargs))
+            futures.append(self._executors[worker].submit(_map, payload))
+        return [result for future in futures for result in dill.loads(future.result())]
+
+    def share(self, obj):
+        _SharedMemoryPickler(_NullFile(), self, register=True).dump(obj)
+
+    def unshare(self, obj):
+        arrays = _RegisteredArrays(self)
+        arrays.dump(obj)
+        self._release([id(array) for array in arrays.arrays])
+
+    def clear_shared_memory(self):
+        self._release(list(self._shared.keys()))
+
+    def _release(self, ids):
+        names = [self._shared[i][1].name for i in ids if i in self._shared]
+        if names:
+            try:
+                self.apply(_detach, names)
+            except Exception:
+                pass
+        for i in ids:
+            if i in self._shared:
+                _, shm = self._shared.pop(i)
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self):
+        self.clear_shared_memory()
+        for executor in self._executors:
+            executor.shutdown()
+
+    def __del__(self):
+        try:
+            self.shutdown()
+        except Exception:
+            pass
+
+    def _dumps(self, obj):
+        f = io.BytesIO()
+        _SharedMemoryPickler(f, self).dump(obj)
+        return f.getvalue()
+
+    def _share(self, array):
+        if id(array) not in self._shared:
+            shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            self._shared[id(array)] = (array, shm)
+        return self._shared[id(array)][1].name
+
+
+class _SharedMemoryRemoteObject(RemoteObject):
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    def _remove(self):
+        try:
+            self.pool.apply(_remove_pushed, self.key)
+        except Exception:
+            # the pool has already been shut down
+            pass
+
+
+class _Pushed:
+    # reference to a pushed object in the arguments that are sent to the workers
+    def __init__(self, key):
+        self.key = key
+
+def _map_kwargs(kwargs):
+    return {k: _Pushed(v.key) if isinstance(v, _SharedMemoryRemoteObject) else v for k, v in kwargs.items()}
+
+
+class SerializedPool:
+    """
+    Wraps a pool such that it can be used from several threads of the master (e.g. the speculative enrichment of
+    the TR method): the calls of the pool are serialized with a lock, since pymor's pools (e.g. MPIPool) are not
+    thread-safe. Each call still uses all workers.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.pool)
+
+    def __bool__(self):
+        return bool(self.pool)
+
+    def __reduce__(self):
+        return SerializedPool, (self.pool,)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.pool, name)
+        if not callable(attribute):
+            return attribute
+
+        def serialized(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return serialized
+
+
+class _SharedMemoryPickler(dill.Pickler):
+    # registered arrays are only sent as a reference to their segment, with register=True all large arrays are
+    # registered
+    def __init__(self, file, pool, register=False):
+        super().__init__(file)
+        self.pool = pool
+        self.register = register
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray:
+            return None
+        if self.register and obj.dtype != object and obj.nbytes >= self.pool.shared_memory_threshold:
+            self.pool._share(obj)
+        if id(obj) in self.pool._shared and self.pool._shared[id(obj)][0] is obj:
+            return ('shm', self.pool._shared[id(obj)][1].name, obj.shape, obj.dtype.str)
+        return None
+
+
+class _RegisteredArrays(dill.Pickler):
+    # collects the registered arrays in an object
+    def __init__(self, pool):
+        super().__init__(_NullFile())
+        self.pool = pool
+        self.arrays = []
+
+    def persistent_id(self, obj):
+        if type(obj) is np.ndarray and id(obj) in self.pool._shared and self.pool._shared[id(obj)][0] is obj:
+            self.arrays.append(obj)
+            return 'shm'
+        return None
+
+
+class _NullFile:
+    # the pickle of `share` and `unshare` is only needed to walk through the object
+    def write(self, data):
+        return len(data)
+
+
+class _SharedMemoryUnpickler(dill.Unpickler):
+    def persistent_load(self, pid):
+        _, name, shape, dtype = pid
+        if name not in _attached:
+            shm = shared_memory.SharedMemory(name=name)
+            # the segment belongs to the master process, the workers must not unlink it on exit
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            _attached[name] = shm
+        array = np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+        array.flags.writeable = False
+        return array
+
+
+# shared memory segments that this worker is attached to
+_attached = {}
+
+# key -> object, the pushed objects on this worker
+_pushed = {}
+
+def _push(key, obj):
+    _pushed[key] = obj
+
+def _remove_pushed(key):
+    _pushed.pop(key, None)
+
+def _worker_kwargs(kwargs):
+    return {k: _pushed[v.key] if isinstance(v, _Pushed) else v for k, v in kwargs.items()}
+
+def _detach(names):
+    for name in names:
+        if name in _attached:
+            # arrays that still use the buffer keep the mapping alive
+            try:
+                _attached.pop(name).close()
+            except BufferError:
+                pass
+
+def _loads(payload):
+    return _SharedMemoryUnpickler(io.BytesIO(payload)).load()
+
+def _apply(payload):
+    function, args, kwargs = _loads(payload)
+    return dill.dumps(function(*args, **_worker_kwargs(kwargs)))
+
+def _map(payload):
+    function, chunk, kwargs = _loads(payload)
+    kwargs = _worker_kwargs(kwargs)
+    return dill.dumps([function(*a, **kwargs) for a in zip(*chunk)])
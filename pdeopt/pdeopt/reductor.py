@@ -16,18 +16,23 @@
 
 import numpy as np
 import time
+import types
+from numbers import Number
+from copy import deepcopy
 
 from pymor.core.base import ImmutableObject
 from pymor.algorithms.projection import project
 from pymor.algorithms.gram_schmidt import gram_schmidt
+from pymor.algorithms.to_matrix import to_matrix
 from pymor.operators.constructions import VectorOperator, LincombOperator
 from pymor.reductors.basic import ProjectionBasedReductor
 from pymor.reductors.coercive import CoerciveRBReductor, SimpleCoerciveRBReductor
 from pymor.reductors.basic import StationaryRBReductor
-from pymor.parameters.functionals import ExpressionParameterFunctional
+from pymor.parameters.functionals import ExpressionParameterFunctional, ParameterFunctional
 from pymor.parameters.functionals import BaseMaxThetaParameterFunctional
 from pymor.parameters.functionals import MaxThetaParameterFunctional
 from pymor.operators.constructions import IdentityOperator
+from pymor.vectorarrays.interface import VectorArray
 
 
 class QuadraticPdeoptStationaryCoerciveReductor(CoerciveRBReductor):
@@ -128,6 +133,10 @@ class QuadraticPdeoptStationaryCoerciveReductor(CoerciveRBReductor):
         self.cont_a = MaxThetaParameterFunctional(self.primal_fom.operator.coefficients, mu_bar)
         self.time_for_enrichment = 0
 
+    def snapshot(self):
+        # new version of the reductor that can be extended without changing this one
+        return snapshot_reductor(self)
+
     def reduce(self):
         assert self.RBPrimal is not None, 'I can not reduce without a RB basis'
         return super().reduce()
@@ -162,7 +171,23 @@ class QuadraticPdeoptStationaryCoerciveReductor(CoerciveRBReductor):
                               projected_hessian=projected_hessian,
                               separated_bases=self.separated_bases, fom=self.fom,
                               is_rom=True,
-                              coarse_projection=None)
+                              coarse_projection=None,
+                              gradient_tensors=self.build_gradient_tensors())
+
+    def build_gradient_tensors(self):
+        # dense affine components of all reduced operators of the gradient and the hessian, see AffineTensor
+        operators = {'dual_primal_projected_op': self.projected_output['dual_primal_projected_op'],
+                     'dual_projected_rhs': self.projected_output['dual_projected_rhs'],
+                     'primal_operator': self.primal_rom.operator, 'primal_rhs': self.primal_rom.rhs,
+                     'dual_operator': self.dual_rom.operator, 'dual_rhs': self.dual_rom.rhs,
+                     'dual_projected_d_u_bilinear_part':
+                         self.projected_output['dual_projected_d_u_bilinear_part']}
+        parameters = self.fom.primal_model.parameters
+        try:
+            return {name: AffineTensor(op, parameters) for name, op in operators.items()}
+        except NotImplementedError:
+            # the model uses the per-component gradient and hessian
+            return None
 
     def extend_bases(self, mu, printing=True, U = None, P = None, **kwargs):
         tic = time.perf_counter()
@@ -447,6 +472,60 @@ class QuadraticPdeoptStationaryCoerciveReductor(CoerciveRBReductor):
     def _reduce_to_primal_subbasis(self, dim):
         raise NotImplementedError
 
+class AffineTensor(ImmutableObject):
+    """
+    Dense tensor of the affine components of a reduced operator (or rhs) sum_q theta_q(mu) A_q, where
+    tensor[q] = A_q. With the derivatives of the coefficients w.r.t. all parameter components, d_mu(...).apply2 and
+    d_mu(...).apply_adjoint for all components are one matrix product. Raises NotImplementedError if the operator is
+    not of this form, i.e. if a component is parametric or a coefficient is neither a number nor a ParameterFunctional.
+    """
+    def __init__(self, operator, parameters):
+        if isinstance(operator, LincombOperator):
+            operators, coefficients = operator.operators, operator.coefficients
+        else:
+            operators, coefficients = [operator], [1.]
+        if any(op.parametric for op in operators):
+            raise NotImplementedError('the components of the operator are parametric')
+        if not all(isinstance(c, (Number, ParameterFunctional)) for c in coefficients):
+            raise NotImplementedError('the coefficients of the operator are not supported')
+        self.tensor = np.array([to_matrix(op, format='dense') for op in operators])
+        self.coefficients = tuple(coefficients)
+        # the derivative functionals are built once, None for constant coefficients
+        self.derivatives = [[c.d_mu(key, l) if isinstance(c, ParameterFunctional) else None for c in coefficients]
+                            for (key, size) in sorted(parameters.items()) for l in range(size)]
+
+    def coefficients_at(self, mu):
+        return np.array([float(c.evaluate(mu)) if isinstance(c, ParameterFunctional) else float(c)
+                         for c in self.coefficients])
+
+    def d_mu_coefficients(self, mu):
+        return np.array([[0. if d is None else float(d.evaluate(mu)) for d in derivatives]
+                         for derivatives in self.derivatives])
+
+    def assemble(self, mu):
+        return np.tensordot(self.coefficients_at(mu), self.tensor, axes=1)
+
+    def d_mu_apply(self, mu, u):
+        # d_mu A u for all parameter components (one per row)
+        return self.d_mu_coefficients(mu) @ np.einsum('qij,j->qi', self.tensor, u)
+
+    def d_mu_apply_transpose(self, mu, v):
+        # d_mu A^T v for all parameter components (one per row)
+        return self.d_mu_coefficients(mu) @ np.einsum('qij,i->qj', self.tensor, v)
+
+    def d_mu_vectors(self, mu):
+        # the operator is a rhs: d_mu of the rhs vector for all parameter components (one per row)
+        return self.d_mu_coefficients(mu) @ self.tensor[:, :, 0]
+
+    def d_mu_apply2(self, mu, v, u):
+        # v^T d_mu A u for all parameter components
+        return self.d_mu_coefficients(mu) @ (np.einsum('qij,j->qi', self.tensor, u) @ v)
+
+    def d_mu_apply_adjoint(self, mu, v):
+        # the operator is a rhs, i.e. A_q has one column
+        return self.d_mu_coefficients(mu) @ (self.tensor[:, :, 0] @ v)
+
+
 class NonAssembledRBReductor(StationaryRBReductor):
     def __init__(self, fom, RB=None, product=None, coercivity_estimator=None,
                  check_orthonormality=None, check_tol=None):
@@ -478,4 +557,36 @@ class non_assembled_estimator(ImmutableObject):
         riesz = self.product.apply_inverse(self.fom.operator.apply(U, mu) - self.fom.rhs.as_vector(mu))
         sqrt = self.product.apply2(riesz,riesz)
         output = np.sqrt(sqrt)
-        return output
\ No newline at end of file
+        return output
+
+def snapshot_reductor(reductor):
+    """
+    Copy of a reductor that shares everything with the original reductor that cannot change: all immutable pymor
+    objects (models, operators, ROMs, ...) and functions are not copied at all and the VectorArrays (bases,
+    residual ranges) are copied with VectorArray.copy(), which only copies the data when the array is changed.
+    Only the remaining (small) mutable state, e.g. the dicts of the bases and the residual reductors, is
+    deep-copied. In contrast to deepcopy, extending the snapshot thus only costs what is actually extended.
+    """
+    memo = {}
+    _prepare_snapshot_memo(reductor, memo, set())
+    return deepcopy(reductor, memo)
+
+def _prepare_snapshot_memo(obj, memo, visited):
+    if id(obj) in memo or id(obj) in visited:
+        return
+    if isinstance(obj, ImmutableObject):
+        memo[id(obj)] = obj
+    elif isinstance(obj, VectorArray):
+        memo[id(obj)] = obj.copy()
+    elif isinstance(obj, (type, types.FunctionType, types.MethodType, types.ModuleType, np.ndarray)):
+        return
+    else:
+        visited.add(id(obj))
+        if isinstance(obj, dict):
+            children = obj.values()
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            children = obj
+        else:
+            children = getattr(obj, '__dict__', {}).values()
+        for child in children:
+            _prepare_snapshot_memo(child, memo, visited)
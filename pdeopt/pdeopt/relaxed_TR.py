@@ -17,13 +17,17 @@
 from pdeopt.TR import solve_optimization_subproblem_NewtonMethod
 from pdeopt.TR import solve_optimization_subproblem_BFGS
 from pdeopt.TR import enrichment_step, projection_onto_range
+from pdeopt.TR import TR_CHECKPOINT_STATE, store_TR_checkpoint
+from pdeopt.checkpoint import load_checkpoint, checkpoint_exists
 from pdeopt.RBLOD_reductor import QuadraticPdeoptStationaryCoerciveLODReductor
 
 import time
 import numpy as np
 
 def Relaxed_TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None, extension_params=None, opt_fom=None,
-                         return_opt_rom=False, pool=None, mesh_adaptive=False, skip_estimator=True):
+                         return_opt_rom=False, pool=None, mesh_adaptive=False, skip_estimator=True,
+                         checkpoint=None, resume=False, checkpoint_fom=None):
+    # for checkpoint, resume and checkpoint_fom, see TR_algorithm
     if TR_parameters is None:
         assert 0
     else:
@@ -70,6 +74,14 @@ def Relaxed_TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None,
         if 'return_data_dict' not in extension_params:
             extension_params['return_data_dict'] = False
 
+    if checkpoint is not None and checkpoint_fom is None:
+        assert reductor is not None, 'checkpoint_fom is needed for checkpoints without a reductor'
+        checkpoint_fom = reductor.fom
+    resuming = resume and checkpoint_exists(checkpoint)
+    if resuming:
+        state, reductor, opt_rom = load_checkpoint(checkpoint, checkpoint_fom, pool)
+        mu_k = state['mu_k']
+
     if 'FOC_tolerance' not in TR_parameters:
         TR_parameters['FOC_tolerance'] = TR_parameters['sub_tolerance']
 
@@ -124,14 +136,23 @@ def Relaxed_TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None,
     point_rejected = False
     additional_criteria = 0
     model_has_been_enriched = False
-    J_k = opt_rom.output_functional_hat(mu_k, pool=pool)
-    print("Starting value of the cost: {}".format(J_k))
-    if mesh_adaptive:
-        gradient = opt_rom.output_functional_hat_gradient(mu_k)
-        mu_box = opt_rom.primal_model.parameters.parse(mu_k.to_numpy() - gradient)
-        first_order_criticity = mu_k.to_numpy() - projection_onto_range(parameter_space, mu_box).to_numpy()
-        normgrad = np.linalg.norm(first_order_criticity)
-        print("Starting First order critical condition: {}".format(normgrad))
+    if resuming:
+        (k, mu_k, J_k, Js, FOCs, times, j_list, times_est_evaluations, J_estimator, mu_est, all_mus, mu_list,
+         JFE_list, total_subproblem_time, normgrad, _, _, additional_criteria, u, p, j) = \
+            [state[name] for name in TR_CHECKPOINT_STATE]
+        TR_parameters.update(state['TR_parameters'])
+        original_radius = state['original_radius']
+        tic = time.time() - state['elapsed']
+        print(f'resuming from checkpoint at iteration {k} with cost {J_k}')
+    else:
+        J_k = opt_rom.output_functional_hat(mu_k, pool=pool)
+        print("Starting value of the cost: {}".format(J_k))
+        if mesh_adaptive:
+            gradient = opt_rom.output_functional_hat_gradient(mu_k)
+            mu_box = opt_rom.primal_model.parameters.parse(mu_k.to_numpy() - gradient)
+            first_order_criticity = mu_k.to_numpy() - projection_onto_range(parameter_space, mu_box).to_numpy()
+            normgrad = np.linalg.norm(first_order_criticity)
+            print("Starting First order critical condition: {}".format(normgrad))
     print("******************************* \n")
     while k < TR_parameters['max_iterations']:
         if k > 2 and Js[-1] == Js[-2]:
@@ -181,9 +202,14 @@ def Relaxed_TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None,
                 if (eps_cond_ks[k] < 100) or (eps_TR_ks[k] < 100):
                     # to be implemented ! 
                     reductor = reductor.with_(reductor_type='coercive')
+                KmsijT, corT = None, None
                 if not skip_estimator:
                     print('checking global termination before expensive local enrichment')
-                    u = reductor.fom.optional_forward_model.solve(mu_kp1, pool=pool)
+                    # the correctors are reused for the enrichment
+                    KmsijT, corT = reductor.fom.optional_forward_model.solve_for_correctors(mu_kp1, pool=pool,
+                                                                                            compute_correctors=True)
+                    u = reductor.fom.optional_forward_model.solve(mu_kp1, KmsijT=KmsijT, correctorsListT=corT,
+                                                                  pool=pool)
                     p = reductor.fom.solve_dual(mu_kp1, U=u, pool=pool)
                     gradient = reductor.fom.output_functional_hat_gradient(mu_kp1, U=u, P=p)
                     mu_box = opt_rom.primal_model.parameters.parse(mu_kp1.to_numpy() - gradient)
@@ -194,7 +220,8 @@ def Relaxed_TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None,
                 if normgrad <= TR_parameters['FOC_tolerance']:
                     pass
                 else:
-                    opt_rom, reductor, KmsijT, corT = enrichment_step(mu_kp1, reductor, pool=pool)
+                    opt_rom, reductor, KmsijT, corT = enrichment_step(mu_kp1, reductor, pool=pool, corT=corT,
+                                                                      KmsijT=KmsijT)
                     u = reductor.fom.solve(mu_kp1, KmsijT=KmsijT, correctorsListT=corT, pool=pool)
                     p = reductor.fom.solve_dual(mu_kp1, U=u, KmsijT=KmsijT, correctorsListT=corT, pool=pool)
             else:
@@ -295,6 +322,15 @@ def Relaxed_TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters=None,
             k = k + 1
             # update radius
             TR_parameters['radius'] = eps_TR_ks[k] + original_radius
+            if checkpoint is not None:
+                # the relaxed TR method does not use estimate_gradient and old_gradient
+                state = dict(k=k, mu_k=mu_k, J_k=J_k, Js=Js, FOCs=FOCs, times=times, j_list=j_list,
+                             times_est_evaluations=times_est_evaluations, J_estimator=J_estimator, mu_est=mu_est,
+                             all_mus=all_mus, mu_list=mu_list, JFE_list=JFE_list,
+                             total_subproblem_time=total_subproblem_time, normgrad=normgrad,
+                             estimate_gradient=None, old_gradient=None, additional_criteria=additional_criteria,
+                             u=u, p=p, j=j, original_radius=original_radius)
+                store_TR_checkpoint(checkpoint, state, TR_parameters, tic, reductor, opt_rom, checkpoint_fom, pool)
         print("******************************* \n")
 
 
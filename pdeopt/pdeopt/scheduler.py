@@ -0,0 +1,150 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import numpy as np
+import time
+
+
+class PatchScheduler:
+    """
+    Largest processing time first (LPT) scheduling of patch tasks on a pymor pool.
+
+    The patch computations keep per process caches (e.g. the affine patch matrices and the iterative patch
+    solvers), so a patch should always be computed on the same worker. In the first round of every phase, the
+    patches are assigned to the workers with LPT: the most expensive remaining patch goes to the least loaded
+    worker. This assignment is pinned for all later rounds of the phase. It is only computed again if the load of
+    the most loaded worker exceeds `imbalance_threshold` times the average load. Then `evict(patches)` is called on
+    all workers for the patches that have moved, such that their previous owners free the caches of these patches.
+
+    pool.map always sends equally sized contiguous chunks of the arguments to the workers. The arguments are
+    reordered and padded such that the chunks are exactly the assignments, and the results are returned in the
+    original order.
+
+    The cost of a patch in a phase is its measured time from the last round of that phase. If no time is known
+    yet, the number of fine DoFs of the patch is used instead.
+
+    For a parallel pool, the function of a phase is pushed to the workers once (pool.push) and only sent again if
+    the function or the pool of the phase changes. Bound methods (e.g. of the GridlodModel) are therefore not
+    pickled on every call.
+    """
+    def __init__(self, patchT, imbalance_threshold=1.5, evict=None):
+        self.sizes = np.array([patch.len_fine for patch in patchT], dtype=float)
+        self.imbalance_threshold = imbalance_threshold
+        self.evict = evict
+        self.timings = {}
+        self.assignments = {}
+        # phase -> (pool, function, RemoteObject of the function)
+        self.remote_functions = {}
+
+    def __getstate__(self):
+        # the pools and the remote functions stay on the master
+        state = self.__dict__.copy()
+        state['remote_functions'] = {}
+        return state
+
+    def costs(self, phase, patches):
+        sizes = self.sizes[patches]
+        if phase not in self.timings:
+            return sizes
+        timings = self.timings[phase][patches]
+        known = ~np.isnan(timings)
+        if np.all(known):
+            return timings
+        if not np.any(known):
+            return sizes
+        # unknown patches are estimated with the average time per fine DoF
+        return np.where(known, timings, np.sum(timings[known]) / np.sum(sizes[known]) * sizes)
+
+    def assign(self, costs, workers):
+        loads = np.zeros(workers)
+        assignment = np.zeros(len(costs), dtype=int)
+        for i in np.argsort(-costs, kind='stable'):
+            w = np.argmin(loads)
+            assignment[i] = w
+            loads[w] += costs[i]
+        return assignment
+
+    def imbalance(self, phase, assignment, workers):
+        loads = np.bincount(assignment, weights=self.costs(phase, np.arange(len(self.sizes))), minlength=workers)
+        return np.max(loads) / np.mean(loads) if np.mean(loads) > 0 else 1.
+
+    def assignment(self, pool, phase, workers):
+        assignment = self.assignments.get(phase)
+        if assignment is not None and (len(assignment) != len(self.sizes) or np.max(assignment) >= workers):
+            assignment = None
+        if assignment is None:
+            assignment = self.assign(self.costs(phase, np.arange(len(self.sizes))), workers)
+        elif self.imbalance(phase, assignment, workers) > self.imbalance_threshold:
+            new_assignment = self.assign(self.costs(phase, np.arange(len(self.sizes))), workers)
+            moved = np.flatnonzero(new_assignment != assignment)
+            if self.evict is not None and len(moved):
+                # the workers do not know their index, the new owners do not have these patches cached anyway
+                pool.apply(self.evict, [int(T) for T in moved])
+            assignment = new_assignment
+        self.assignments[phase] = assignment
+        return assignment
+
+    def map(self, pool, phase, function, *args, patches=None, **kwargs):
+        """
+        Same as pool.map(function, *args, **kwargs), where args are per patch. `patches` are the indices of the
+        patches of the arguments if these are not all patches.
+        """
+        n = len(args[0])
+        if n == 0:
+            return []
+        patches = np.arange(n) if patches is None else np.asarray(patches, dtype=int)
+        workers = len(pool)
+        if workers > 1 and n > 1:
+            assignment = self.assignment(pool, phase, workers)[patches]
+            chunks = [list(np.flatnonzero(assignment == w)) for w in range(workers)]
+            chunk_size = max(len(chunk) for chunk in chunks)
+            # None pads the chunks to the same size, these entries are skipped
+            order = [chunk[j] if j < len(chunk) else None for chunk in chunks for j in range(chunk_size)]
+        else:
+            order = list(range(n))
+        results = pool.map(_timed_call, [i is not None for i in order],
+                           *[[arg[i] if i is not None else None for i in order] for arg in args],
+                           timed_function=self.remote_function(pool, phase, function), **kwargs)
+
+        timings = self.timings.setdefault(phase, np.full(len(self.sizes), np.nan))
+        outputs = [None for _ in range(n)]
+        for i, (result, elapsed) in zip(order, results):
+            if i is None:
+                continue
+            outputs[i] = result
+            timings[patches[i]] = elapsed
+        return outputs
+
+    def remote_function(self, pool, phase, function):
+        if not pool:
+            # DummyPool: push would copy the function (and the model of a bound method)
+            return function
+        remote = self.remote_functions.get(phase)
+        if remote is not None and remote[0] is pool and remote[1] == function:
+            return remote[2]
+        if remote is not None and remote[0] is pool:
+            remote[2].remove()
+        remote = pool.push(function)
+        self.remote_functions[phase] = (pool, function, remote)
+        return remote
+
+
+def _timed_call(active, *args, timed_function=None, **kwargs):
+    if not active:
+        return None, 0.
+    tic = time.perf_counter()
+    result = timed_function(*args, **kwargs)
+    return result, time.perf_counter() - tic
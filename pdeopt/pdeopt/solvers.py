@@ -0,0 +1,228 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+"""
+Solver backends for the FEM systems of the full order models.
+
+A backend is used as `backend.solve(assemble, B, mu)`, where `assemble(mu)` returns the (sparse) system matrix for
+a parameter and B holds the right hand sides as columns. The matrix is only assembled if the backend needs it.
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu
+
+from pymor.core.exceptions import InversionError
+
+from pdeopt.tools import ParameterCache
+
+try:
+    import pyamg
+    HAVE_PYAMG = True
+except ImportError:
+    HAVE_PYAMG = False
+
+
+class DirectSolver:
+    """
+    Sparse LU decomposition (SuperLU) of the matrix. Primal and dual problems (and their sensitivities) share the
+    matrix, thus the decomposition is cached for the last `cache_size` parameters.
+    """
+    def __init__(self, cache_size=1, cache_memory=None):
+        self.factorizations = ParameterCache(max_entries=cache_size, max_bytes=cache_memory)
+
+    def solve(self, assemble, B, mu):
+        factorization = self.factorizations.get(mu)
+        if factorization is None:
+            factorization = self.factorizations.put(mu, splu(sparse.csc_matrix(assemble(mu))))
+        return factorization.solve(B)
+
+
+class PreconditionedCGSolver:
+    """
+    CG with a preconditioner that is built once with the matrix at `reference_mu` (e.g. mu_bar, default: the
+    parameter of the first solve) and reused for all parameters, such that memory and setup time do not depend on
+    the number of solves. The number of CG iterations of the first solve with a preconditioner is the reference. If
+    a later solve needs more than `rebuild_factor` times as many iterations (or does not converge), the
+    preconditioner is rebuilt with the matrix of that parameter. If CG does not converge with the rebuilt
+    preconditioner either, an InversionError is raised.
+
+    Dirichlet rows (rows with only one entry, as assembled by pymor) are eliminated before CG, since the system
+    with these rows is not symmetric. Subclasses implement `build(A, free, mu)`, which sets `self.preconditioner`
+    for the matrix A at mu on the free DoFs `free`.
+    """
+    def __init__(self, reference_mu=None, tolerance=1e-10, max_iterations=1000, rebuild_factor=2.):
+        self.reference_mu = reference_mu
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.rebuild_factor = rebuild_factor
+        self.preconditioner = None
+        self.reference_iterations = None
+        self.preconditioners = 0
+        self.iterations = []
+
+    def rebuild(self, A, free, mu):
+        self.build(A, free, mu)
+        self.reference_iterations = None
+        self.preconditioners += 1
+
+    def solve(self, assemble, B, mu):
+        A = sparse.csr_matrix(assemble(mu))
+        B = B.reshape((B.shape[0], -1))
+        free, fixed = dirichlet_split(A)
+        AFree = A[free][:, free].tocsr()
+        X = np.zeros((A.shape[0], B.shape[1]))
+        X[fixed] = B[fixed] / A.diagonal()[fixed][:, np.newaxis]
+        BFree = B[free] - A[free][:, fixed] @ X[fixed]
+
+        if self.preconditioner is None:
+            if self.reference_mu is None:
+                self.rebuild(AFree, free, mu)
+            else:
+                self.rebuild(dirichlet_restrict(sparse.csr_matrix(assemble(self.reference_mu))), free,
+                             self.reference_mu)
+        XFree, iterations, converged = pcg(AFree, BFree, self.preconditioner, self.tolerance, self.max_iterations)
+        if not converged:
+            self.rebuild(AFree, free, mu)
+            XFree, iterations, converged = pcg(AFree, BFree, self.preconditioner, self.tolerance,
+                                               self.max_iterations)
+            if not converged:
+                raise InversionError(f'CG did not converge in {self.max_iterations} iterations '
+                                     f'(tolerance {self.tolerance}) for mu: {mu}')
+        elif self.reference_iterations is None:
+            self.reference_iterations = max(iterations, 1)
+        elif iterations > self.rebuild_factor * self.reference_iterations:
+            # only the next solves profit from the new preconditioner
+            self.rebuild(AFree, free, mu)
+        self.iterations.append(iterations)
+        X[free] = XFree
+        return X
+
+
+class AMGSolver(PreconditionedCGSolver):
+    """
+    CG preconditioned with a V-cycle of a smoothed aggregation AMG hierarchy (pyamg), see PreconditionedCGSolver.
+    """
+    def __init__(self, reference_mu=None, tolerance=1e-10, max_iterations=1000, rebuild_factor=2., **amg_options):
+        assert HAVE_PYAMG, 'pyamg is not installed'
+        super().__init__(reference_mu, tolerance, max_iterations, rebuild_factor)
+        self.amg_options = amg_options
+
+    def build(self, A, free, mu):
+        self.hierarchy = pyamg.smoothed_aggregation_solver(A, symmetry='symmetric', **self.amg_options)
+        self.preconditioner = self.hierarchy.aspreconditioner(cycle='V').matmat
+
+
+class LODSchwarzSolver(PreconditionedCGSolver):
+    """
+    CG preconditioned with a two-level additive Schwarz method, see PreconditionedCGSolver. The coarse space is
+    the LOD multiscale space of a GridlodModel (coarse basis minus correctors at the reference parameter). The
+    subdomains are the gridlod patches, with zero boundary values on the patch boundary inside of the domain:
+
+        M^{-1} r = Phi (Phi^T A Phi)^{-1} Phi^T r + sum_T R_T^T A_T^{-1} R_T r
+
+    The LOD basis is only computed once (with `pool`). A rebuild only recomputes the coarse matrix and the
+    factorizations of the patch matrices. The gridlod model needs the same fine grid and DoF numbering as the FEM
+    model (as in discretize_gridlod).
+    """
+    def __init__(self, gridlod_model, reference_mu=None, tolerance=1e-10, max_iterations=1000, rebuild_factor=2.,
+                 pool=None):
+        super().__init__(reference_mu, tolerance, max_iterations, rebuild_factor)
+        self.gridlod_model = gridlod_model
+        self.pool = pool
+        self.basis = None
+
+    def build(self, A, free, mu):
+        if self.basis is None:
+            basis = sparse.csr_matrix(self.gridlod_model.multiscale_basis(mu, pool=self.pool))
+            self.basis = sparse.csr_matrix(basis[free][:, self.gridlod_model.free])
+            global_to_free = -np.ones(basis.shape[0], dtype=np.int64)
+            global_to_free[free] = np.arange(len(free))
+            self.subdomains = []
+            for indices in self.gridlod_model.patch_fine_indices():
+                indices = global_to_free[indices]
+                self.subdomains.append(indices[indices >= 0])
+            # the pool is not needed anymore and should not be kept in the model
+            self.pool = None
+        self.coarse_factorization = splu(sparse.csc_matrix(self.basis.T @ A @ self.basis))
+        self.local_factorizations = [splu(sparse.csc_matrix(A[indices][:, indices])) for indices in self.subdomains]
+        self.preconditioner = self.precondition
+
+    def precondition(self, R):
+        Z = self.basis @ self.coarse_factorization.solve(self.basis.T @ R)
+        for indices, factorization in zip(self.subdomains, self.local_factorizations):
+            Z[indices] += factorization.solve(R[indices])
+        return Z
+
+
+def pcg(A, B, precondition, tolerance, max_iterations):
+    """
+    CG for all columns of B at once. A column has converged if its residual is below `tolerance` relative to the
+    column of B. Returns the solution, the number of iterations and whether all columns converged.
+    """
+    X = np.zeros(B.shape)
+    R = B.copy()
+    Z = precondition(R)
+    P = Z.copy()
+    rz = np.einsum('ij,ij->j', R, Z)
+    norms = np.linalg.norm(B, axis=0)
+    for iteration in range(max_iterations + 1):
+        active = np.linalg.norm(R, axis=0) > tolerance * norms
+        if not np.any(active) or iteration == max_iterations:
+            return X, iteration, not np.any(active)
+        AP = A @ P
+        pAp = np.einsum('ij,ij->j', P, AP)
+        alpha = np.divide(rz, pAp, out=np.zeros_like(rz), where=active & (pAp != 0))
+        X += alpha * P
+        R -= alpha * AP
+        Z = precondition(R)
+        rz_new = np.einsum('ij,ij->j', R, Z)
+        beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=active & (rz != 0))
+        P = Z + beta * P
+        rz = rz_new
+
+def dirichlet_split(A):
+    fixed = np.where(np.diff(A.indptr) == 1)[0]
+    free = np.setdiff1d(np.arange(A.shape[0]), fixed)
+    return free, fixed
+
+def dirichlet_restrict(A):
+    free, _ = dirichlet_split(A)
+    return A[free][:, free].tocsr()
+
+def solve_model(model, mu, backend=None):
+    # model.solve(mu) for a pymor StationaryModel with a numpy matrix operator, solved with the backend
+    if backend is None:
+        return model.solve(mu)
+    assemble = lambda mu_: model.operator.assemble(mu_).matrix
+    B = model.rhs.as_range_array(mu).to_numpy().T
+    return model.solution_space.from_numpy(backend.solve(assemble, B, mu).T)
+
+def build_solver_backend(backend, reference_mu=None):
+    """
+    Returns the backend for 'direct' or 'amg'. None and backend objects are returned as they are, only the reference
+    parameter of a PreconditionedCGSolver is set if it does not have one.
+    """
+    if isinstance(backend, PreconditionedCGSolver) and backend.reference_mu is None:
+        backend.reference_mu = reference_mu
+    if backend is None or not isinstance(backend, str):
+        return backend
+    if backend == 'direct':
+        return DirectSolver()
+    elif backend == 'amg':
+        return AMGSolver(reference_mu=reference_mu)
+    else:
+        assert 0, f'unknown solver backend {backend}'
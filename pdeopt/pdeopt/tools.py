@@ -1,4 +1,77 @@
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import io
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+
+class SpeculativeCounts:
+    """
+    Evaluations that are counted in the current thread while this is active (`with counts:`) are only recorded.
+    They are added to the counters with `apply`, i.e. only if the speculative result is used. The same holds for
+    the output (print) of the thread, which is buffered and written by the thread that calls `apply`.
+    """
+    def __init__(self):
+        self.calls = []
+        self.output = io.StringIO()
+
+    def __enter__(self):
+        _install_thread_stdout()
+        _speculation.counts = self
+        return self
+
+    def __exit__(self, *exc):
+        _speculation.counts = None
+
+    def apply(self):
+        for counter, args, kwargs in self.calls:
+            counter.count(*args, **kwargs)
+        self.calls = []
+        sys.stdout.write(self.output.getvalue())
+        self.output = io.StringIO()
+
+
+class _ThreadStdout:
+    # sys.stdout that writes to the output buffer of the active SpeculativeCounts of the current thread
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def _target(self):
+        counts = getattr(_speculation, 'counts', None)
+        return self.stdout if counts is None else counts.output
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+def _install_thread_stdout():
+    with _counter_lock:
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+
+# per thread: the active SpeculativeCounts
+_speculation = threading.local()
+_counter_lock = threading.Lock()
+
+def _counted(count):
+    @wraps(count)
+    def speculative_count(self, *args, **kwargs):
+        counts = getattr(_speculation, 'counts', None)
+        if counts is not None:
+            counts.calls.append((self, args, kwargs))
+            return
+        with _counter_lock:
+            count(self, *args, **kwargs)
+    return speculative_count
+
 
 class LODEvaluationCounter:
     def __init__(self):
@@ -57,6 +130,7 @@ class LODEvaluationCounter:
                         local_ROM=self.local_ROM_counter,
                         two_scale_ROM=self.two_scale_ROM_counter)
 
+    @_counted
     def count(self, is_rom=False, coarse=False, two_scale=False):
         if two_scale:
             self.two_scale_ROM_counter += 1
@@ -104,6 +178,7 @@ class EvaluationCounter:
         if return_dict:
             return dict(FEM=self.FOM_counter, RB=self.ROM_counter)
 
+    @_counted
     def count(self, is_rom=False):
         if is_rom:
             self.ROM_counter += 1
@@ -113,6 +188,140 @@ class EvaluationCounter:
             # print(f"*****************FEM SOLVE : {self.FOM_counter}")
 
 
+def _locked(method):
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class ParameterCache:
+    """
+    LRU cache keyed on the parameter vector, bounded by number of entries and (optionally) by bytes.
+    The cache can be used from several threads (e.g. the speculative enrichment of the TR algorithm).
+    """
+    def __init__(self, max_entries=10, max_bytes=None):
+        assert max_entries is None or max_entries > 0
+        self._lock = threading.RLock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(mu):
+        if hasattr(mu, 'to_numpy'):
+            mu = mu.to_numpy()
+        return tuple(np.asarray(mu, dtype=float).ravel())
+
+    def __contains__(self, mu):
+        return self.key(mu) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @_locked
+    def get(self, mu, default=None):
+        key = self.key(mu)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return default
+
+    @_locked
+    def peek(self, mu, default=None):
+        # same as get, but neither counted nor moved to the end
+        return self._entries.get(self.key(mu), default)
+
+    @_locked
+    def pop(self, mu, default=None):
+        key = self.key(mu)
+        if key not in self._entries:
+            return default
+        self.nbytes -= self._sizes.pop(key)
+        return self._entries.pop(key)
+
+    @_locked
+    def update(self, mu, **values):
+        # add values to the dict entry of mu
+        entry = dict(self.peek(mu, {}), **values)
+        return self.put(mu, entry)
+
+    @_locked
+    def put(self, mu, value):
+        key = self.key(mu)
+        if key in self._entries:
+            self.nbytes -= self._sizes[key]
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._sizes[key] = estimate_nbytes(value)
+        self.nbytes += self._sizes[key]
+        self._evict()
+        return value
+
+    def _evict(self):
+        # the most recent entry is always kept, even if it exceeds the memory budget on its own
+        while len(self._entries) > 1 and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key, _ = self._entries.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+            self.evictions += 1
+
+    @_locked
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def __getstate__(self):
+        # the cache is local to the process that fills it, do not communicate the entries
+        state = self.__dict__.copy()
+        state['_entries'], state['_sizes'], state['nbytes'] = OrderedDict(), {}, 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def print_result(self, return_dict=False):
+        print(f"\nCache hits:       {self.hits}")
+        print(f"Cache misses:     {self.misses}")
+        print(f"Cache evictions:  {self.evictions}")
+        print(f"Cache entries:    {len(self)} ({self.nbytes / 1024 ** 2:.1f} MB)\n")
+        if return_dict:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        entries=len(self), nbytes=self.nbytes)
+
+
+def estimate_nbytes(obj):
+    if obj is None:
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if scipy.sparse.issparse(obj):
+        obj = obj.tocsc() if not hasattr(obj, 'indptr') else obj
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in obj)
+    if isinstance(obj, scipy.sparse.linalg.SuperLU):
+        # obj.L and obj.U would be new copies of the factors, nnz is the number of entries in both
+        return 12 * obj.nnz
+    if hasattr(obj, 'to_numpy'):
+        return obj.to_numpy().nbytes
+    return getattr(obj, 'nbytes', 0)
+
+
 def print_RB_result(dict):
     print(f"FEM solves:   {dict['FEM']}")
     print(f"RB solves:    {dict['RB']}")
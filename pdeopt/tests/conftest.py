@@ -0,0 +1,60 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def thermal_block_opt_problem():
+    # small version of the FEM setting of scripts/minimal_test.py
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('pymor')
+    pytest.importorskip('gridlod')
+    from pymor.parameters.functionals import MinThetaParameterFunctional
+    from pdeopt.problems import large_thermal_block
+    from pdeopt.discretizer import discretize_quadratic_NCD_pdeopt_stationary_cg
+
+    diameter, coarse_elements = np.sqrt(2)/8, 2
+    problem, world, aFine_constructor, _, _, _ = large_thermal_block(
+        diameter, coarse_elements, blocks=(2, 2), return_fine=True, high_conductivity=4., low_conductivity=1.2,
+        rhs_value=10., first_factor=1, second_factor=2, min_diffusivity=1.)
+    mu_d = problem.parameter_space.sample_randomly(1, seed=23)[0]
+    weights = {'sigma_u': 100, 'diffusion': 0.001, 'low_diffusion': 0.001}
+    opt_fom, _, mu_bar = discretize_quadratic_NCD_pdeopt_stationary_cg(problem, diameter, weights,
+                                                                       mu_for_u_d=mu_d, mu_for_tikhonov=mu_d,
+                                                                       coarse_functional_grid_size=coarse_elements)
+    return dict(fom=opt_fom, mu_bar=mu_bar, parameter_space=problem.parameter_space, problem=problem,
+                diameter=diameter, coarse_elements=coarse_elements, world=world, aFine_constructor=aFine_constructor,
+                coercivity_estimator=MinThetaParameterFunctional(opt_fom.primal_model.operator.coefficients, mu_bar))
+
+
+@pytest.fixture(scope='session')
+def reduce_opt_fom(thermal_block_opt_problem):
+    # returns the ROM and the reductor for the initial bases at `mus`
+    from pdeopt.model import build_initial_basis
+    from pdeopt.reductor import QuadraticPdeoptStationaryCoerciveReductor
+
+    def reduce(mus, adjoint_approach=True):
+        fom = thermal_block_opt_problem['fom'].with_(use_corrected_functional=adjoint_approach,
+                                                     adjoint_approach=adjoint_approach)
+        RBbasis, dual_RBbasis = build_initial_basis(fom, mus, build_sensitivities=False)
+        reductor = QuadraticPdeoptStationaryCoerciveReductor(
+            fom, RBbasis, dual_RBbasis, opt_product=fom.opt_product,
+            coercivity_estimator=thermal_block_opt_problem['coercivity_estimator'],
+            reductor_type='simple_coercive', mu_bar=thermal_block_opt_problem['mu_bar'])
+        return reductor.reduce(), reductor
+
+    return reduce
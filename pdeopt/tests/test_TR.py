@@ -0,0 +1,57 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import shutil
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+def _run_TR(opt_rom, reductor, parameter_space, mu_start, **kwargs):
+    from pdeopt.TR import TR_algorithm
+    TR_parameters = {'radius': 0.1, 'FOC_tolerance': 1e-8, 'sub_tolerance': 1e-8, 'max_iterations': 6,
+                     'max_iterations_subproblem': 100, 'starting_parameter': mu_start, 'opt_method': 'BFGSMethod',
+                     'control_mu': False}
+    extension_params = {'Enlarge_radius': True, 'timings': True, 'return_data_dict': False}
+    mus, _, Js, FOCs = TR_algorithm(opt_rom, reductor, parameter_space, TR_parameters, extension_params, **kwargs)
+    return np.array([mu.to_numpy() for mu in mus]), np.array(Js), np.array(FOCs)
+
+
+def test_resume_from_checkpoint(thermal_block_opt_problem, reduce_opt_fom, tmp_path, monkeypatch):
+    import pdeopt.TR
+    from pdeopt.checkpoint import save_checkpoint
+    parameter_space = thermal_block_opt_problem['parameter_space']
+    mu_start = parameter_space.sample_randomly(1, seed=4)[0]
+
+    # keeps the checkpoint of every accepted iterate
+    checkpoints = []
+    def save_and_keep_checkpoint(path, *args, **kwargs):
+        save_checkpoint(path, *args, **kwargs)
+        checkpoints.append(tmp_path / f'checkpoint_{len(checkpoints)}')
+        shutil.copy(path, checkpoints[-1])
+    monkeypatch.setattr(pdeopt.TR, 'save_checkpoint', save_and_keep_checkpoint)
+
+    opt_rom, reductor = reduce_opt_fom([mu_start])
+    reference = _run_TR(opt_rom, reductor, parameter_space, mu_start, checkpoint=str(tmp_path / 'checkpoint'))
+    assert len(checkpoints) >= 2
+
+    # the first accepted iterate is taken from the checkpoint, the ROM and the reductor as well
+    _, reductor = reduce_opt_fom([mu_start])
+    resumed = _run_TR(None, None, parameter_space, mu_start, checkpoint=str(checkpoints[0]), resume=True,
+                      checkpoint_fom=reductor.fom)
+    for reference_values, resumed_values in zip(reference, resumed):
+        assert np.array_equal(reference_values, resumed_values)
@@ -0,0 +1,42 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymor')
+pytest.importorskip('gridlod')
+pytest.importorskip('rblod')
+
+from gridlod import pglod, util
+from gridlod.world import World, Patch
+
+from pdeopt.gridlod_model import prepare_free_stiffness_pattern, assemble_free_stiffness_matrix
+
+
+@pytest.mark.parametrize('boundaryConditions', [np.array([[0, 0], [0, 0]]), np.array([[0, 1], [1, 0]])])
+@pytest.mark.parametrize('k', [1, 2])
+def test_free_stiffness_matrix(boundaryConditions, k):
+    world = World(np.array([5, 3]), np.array([2, 2]), boundaryConditions)
+    patchT = [Patch(world, k, T) for T in range(world.NtCoarse)]
+    free = np.setdiff1d(np.arange(world.NpCoarse), util.boundarypIndexMap(world.NWorldCoarse, boundaryConditions == 0))
+    rng = np.random.default_rng(0)
+    KmsijT = [rng.random((patch.NpCoarse, 4)) for patch in patchT]
+
+    KFree = assemble_free_stiffness_matrix(prepare_free_stiffness_pattern(world, patchT, free), KmsijT)
+    KFull = pglod.assembleMsStiffnessMatrix(world, patchT, KmsijT)
+    assert KFree.format == 'csc' and KFree.has_sorted_indices
+    assert np.allclose(KFree.toarray(), KFull.toarray()[np.ix_(free, free)])
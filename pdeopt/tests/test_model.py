@@ -0,0 +1,38 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+def test_dense_hessian_matches_finite_differences(thermal_block_opt_problem, reduce_opt_fom):
+    parameter_space = thermal_block_opt_problem['parameter_space']
+    # the one-sweep hessian is only used without the adjoint approach
+    rom, _ = reduce_opt_fom(parameter_space.sample_randomly(2, seed=1), adjoint_approach=False)
+    assert rom.gradient_tensors is not None
+    parameters = rom.primal_model.parameters
+    h = 1e-5
+    for mu in parameter_space.sample_randomly(2, seed=3):
+        hessian = rom.output_functional_hessian(mu)
+        # central differences of the gradient, one column per parameter component
+        columns = []
+        for eta in np.eye(rom.number_of_parameters):
+            gradient_plus = rom.output_functional_hat_gradient(parameters.parse(mu.to_numpy() + h * eta))
+            gradient_minus = rom.output_functional_hat_gradient(parameters.parse(mu.to_numpy() - h * eta))
+            columns.append((gradient_plus - gradient_minus) / (2 * h))
+        finite_differences = np.column_stack(columns)
+        assert np.allclose(hessian, finite_differences, rtol=1e-4, atol=1e-6 * np.max(np.abs(hessian)))
@@ -0,0 +1,131 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymor')
+
+from pymor.analyticalproblems.thermalblock import thermal_block_problem
+from pymor.discretizers.builtin import discretize_stationary_cg
+from pymor.reductors.coercive import CoerciveRBReductor
+
+from pdeopt.patch_store import PatchStore
+
+
+@pytest.fixture(scope='module')
+def fom_and_snapshots():
+    fom, _ = discretize_stationary_cg(thermal_block_problem((2, 2)), diameter=1/4)
+    mus = fom.parameters.space(0.1, 1).sample_randomly(3, seed=7)
+    return fom, [fom.solve(mu) for mu in mus]
+
+
+def _extended_reductor(fom, snapshots):
+    reductor = CoerciveRBReductor(fom)
+    for U in snapshots:
+        reductor.extend_basis(U)
+    return reductor
+
+
+def _basis(store, T):
+    return store.load_reductor(T).bases['RB'].to_numpy()
+
+
+def test_write_and_load(fom_and_snapshots, tmp_path):
+    fom, snapshots = fom_and_snapshots
+    store = PatchStore(str(tmp_path), keep_versions=2)
+    reductor = _extended_reductor(fom, snapshots[:1])
+    rom = reductor.reduce()
+    assert store.write(0, reductor, rom, error_residual=np.ones(3), system={'operator': np.eye(1)})
+    # nothing changed
+    assert not store.write(0, reductor, rom)
+
+    reductor.extend_basis(snapshots[1])
+    assert store.write(0, reductor, reductor.reduce())
+    assert store.version(0) == 1
+    # only the new vector is written in version 1
+    assert [chunk for chunk in store.manifest(0)['chunks'] if chunk[0] == 'bases_RB'] == \
+        [['bases_RB', 0, 1], ['bases_RB', 1, 1]]
+
+    loaded = store.load_reductor(0)
+    assert loaded.fom is not fom and loaded.fom.parameters == fom.parameters
+    assert loaded._last_rom is None
+    assert np.array_equal(loaded.bases['RB'].to_numpy(), reductor.bases['RB'].to_numpy())
+    # the projected operators are computed again
+    assert loaded.reduce().solution_space.dim == 2
+    assert store.load_rom(0).solution_space.dim == 2
+    assert store.load_rom_system(0) is None
+    # the error residual of version 0 is not linked anymore
+    assert store.load_error_residual(0) is None and not os.path.exists(tmp_path / 'err_res_0')
+
+
+def test_rollback_and_prune(fom_and_snapshots, tmp_path):
+    fom, snapshots = fom_and_snapshots
+    store = PatchStore(str(tmp_path), keep_versions=2)
+    reductor = CoerciveRBReductor(fom)
+    for i, U in enumerate(snapshots):
+        reductor.extend_basis(U)
+        store.write(0, reductor, None, error_residual=np.full(2, i))
+    # only the last two versions are kept
+    assert not os.path.exists(tmp_path / 'red_0.0')
+    assert os.path.exists(tmp_path / 'red_0.1') and os.path.exists(tmp_path / 'red_0.2')
+    assert np.array_equal(store.load_error_residual(0), np.full(2, 2))
+
+    store.rollback(0, 1)
+    assert store.version(0) == 1
+    assert np.array_equal(_basis(store, 0), reductor.bases['RB'].to_numpy()[:2])
+    assert not os.path.exists(tmp_path / 'basis_0.bases_RB.2.npy')
+    # the error residual of the current version is linked for the estimators of the ROMs
+    with open(tmp_path / 'err_res_0', 'rb') as f, open(tmp_path / 'err_res_0.1', 'rb') as g:
+        assert f.read() == g.read()
+    with pytest.raises(AssertionError):
+        store.rollback(0, 0)
+
+    # a shorter basis starts a new chunk set
+    del reductor.bases['RB'][1:]
+    store.write(0, reductor, None)
+    assert store.manifest(0)['resets'] == [2]
+    assert np.array_equal(_basis(store, 0), reductor.bases['RB'].to_numpy())
+
+    store.remove(0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_pinned_and_held_versions_are_kept(fom_and_snapshots, tmp_path):
+    fom, snapshots = fom_and_snapshots
+    store = PatchStore(str(tmp_path), keep_versions=1)
+    reductor = CoerciveRBReductor(fom)
+    reductor.extend_basis(snapshots[0])
+    store.write(0, reductor, None)
+    assert store.pin(0) == 0
+    reductor.extend_basis(snapshots[1])
+    store.write(0, reductor, None)
+    assert store.hold(0) == 1
+    reductor.extend_basis(snapshots[2])
+    store.write(0, reductor, None)
+    assert all(os.path.exists(tmp_path / f'red_0.{v}') for v in range(3))
+
+    # the pinned and the held version survive a reset of the basis
+    del reductor.bases['RB'][1:]
+    store.write(0, reductor, None)
+    assert os.path.exists(tmp_path / 'red_0.0') and os.path.exists(tmp_path / 'red_0.1')
+    assert not os.path.exists(tmp_path / 'red_0.2')
+    store.release(0)
+    store.rollback(0, 0)
+    assert np.array_equal(_basis(store, 0), _extended_reductor(fom, snapshots[:1]).bases['RB'].to_numpy())
+    assert not os.path.exists(tmp_path / 'red_0.1')
@@ -0,0 +1,76 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import os
+from multiprocessing import shared_memory
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('dill')
+pytest.importorskip('pymor')
+
+from pdeopt.pool import SharedMemoryPool
+
+
+@pytest.fixture
+def pool():
+    pool = SharedMemoryPool(max_workers=2, shared_memory_threshold=1024)
+    yield pool
+    pool.shutdown()
+
+
+def _worker(_):
+    return os.getpid()
+
+def _summary(array, offset=0):
+    # sum and whether the array is a read-only view of a shared segment
+    return float(np.sum(array)) + offset, not array.flags.writeable
+
+def _scaled(array, factor=None):
+    return factor * array
+
+
+def test_map_uses_the_chunks_of_pymor(pool):
+    pids = pool.map(_worker, list(range(5)))
+    # chunks of size 3 and 2, one per worker
+    assert len(set(pids[:3])) == 1 and len(set(pids[3:])) == 1 and pids[0] != pids[3]
+    assert pool.map(_summary, [np.ones(3), np.ones(4)], offset=1) == [(4., False), (5., False)]
+
+
+def test_share_and_unshare(pool):
+    large, small = np.arange(1000.), np.arange(10.)
+    data = {'large': large, 'small': small}
+    pool.share(data)
+    assert list(pool._shared) == [id(large)]
+    name = pool._shared[id(large)][1].name
+    assert pool.map(_summary, [large, small]) == [(np.sum(large), True), (np.sum(small), False)]
+    # other arrays with the same content are not shared
+    assert pool.apply(_summary, large.copy()) == [(np.sum(large), False)] * 2
+
+    pool.unshare(data)
+    assert pool._shared == {}
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+    assert pool.apply_only(_summary, 1, large) == (np.sum(large), False)
+
+
+def test_push(pool):
+    factor = pool.push(np.full(3, 2.))
+    assert all(np.array_equal(result, np.full(3, 2.)) for result in pool.map(_scaled, [np.ones(3)] * 3,
+                                                                            factor=factor))
+    factor.remove()
+    assert factor.removed
@@ -0,0 +1,39 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.mark.parametrize('adjoint_approach', [True, False])
+def test_gradient_from_affine_tensors(thermal_block_opt_problem, reduce_opt_fom, adjoint_approach):
+    parameter_space = thermal_block_opt_problem['parameter_space']
+    rom, _ = reduce_opt_fom(parameter_space.sample_randomly(2, seed=1), adjoint_approach)
+    assert rom.gradient_tensors is not None
+    # the same ROM with the gradient from output_functional_hat_d_mu per parameter component
+    reference_rom = rom.with_(gradient_tensors=None)
+    for mu in parameter_space.sample_randomly(3, seed=2):
+        assert np.allclose(rom.output_functional_hat_gradient(mu), reference_rom.output_functional_hat_gradient(mu),
+                           rtol=1e-8, atol=1e-10)
+
+
+def test_affine_tensor_rejects_parametric_components(thermal_block_opt_problem):
+    from pymor.operators.constructions import LincombOperator
+    from pdeopt.reductor import AffineTensor
+    operator = thermal_block_opt_problem['fom'].primal_model.operator
+    with pytest.raises(NotImplementedError):
+        AffineTensor(LincombOperator([operator], [1.]), operator.parameters)
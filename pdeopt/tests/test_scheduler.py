@@ -0,0 +1,117 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymor')
+
+from pymor.parallel.dummy import DummyPool
+
+from pdeopt.scheduler import PatchScheduler
+
+
+class ChunkedPool(DummyPool):
+    # evaluates in this process, but splits the arguments of map into the chunks of a pool with `workers` workers
+    def __init__(self, workers):
+        self.workers = workers
+        self.chunks = []
+        self.pushed = []
+        self.applied = []
+
+    def __len__(self):
+        return self.workers
+
+    def __bool__(self):
+        return True
+
+    def push(self, obj):
+        self.pushed.append(obj)
+        return super().push(obj)
+
+    def apply(self, function, *args, **kwargs):
+        self.applied.append(args)
+        return [super(ChunkedPool, self).apply(function, *args, **kwargs)[0] for _ in range(self.workers)]
+
+    def map(self, function, *args, **kwargs):
+        length = len(args[0])
+        chunk_size = length // self.workers + (1 if length % self.workers > 0 else 0)
+        self.chunks = [args[1][start:start + chunk_size] for start in range(0, length, chunk_size)]
+        return super().map(function, *args, **kwargs)
+
+
+def _patches(sizes):
+    return [SimpleNamespace(len_fine=size) for size in sizes]
+
+def _square(T, offset=0):
+    return T**2 + offset
+
+
+def test_lpt_assignment():
+    scheduler = PatchScheduler(_patches([1, 1, 1]))
+    costs = np.array([7., 5., 4., 3., 2., 2.])
+    assignment = scheduler.assign(costs, 2)
+    loads = np.bincount(assignment, weights=costs, minlength=2)
+    # LPT: 7 + 3 + 2 and 5 + 4 + 2
+    assert sorted(loads) == [11., 12.]
+    assert assignment[0] != assignment[1]
+
+
+def test_map_keeps_order_and_sends_the_assignments_as_chunks():
+    sizes = [10, 80, 20, 30, 90, 40, 50]
+    scheduler = PatchScheduler(_patches(sizes))
+    pool = ChunkedPool(3)
+    patches = list(range(len(sizes)))
+    assert scheduler.map(pool, 'phase', _square, patches, offset=1) == [T**2 + 1 for T in patches]
+    assignment = scheduler.assignments['phase']
+    for w, chunk in enumerate(pool.chunks):
+        assert sorted(T for T in chunk if T is not None) == list(np.flatnonzero(assignment == w))
+    # the costs are now the measured times, the assignment is pinned while it is balanced
+    scheduler.imbalance_threshold = np.inf
+    scheduler.map(pool, 'phase', _square, patches)
+    assert np.all(scheduler.assignments['phase'] == assignment)
+    assert not np.any(np.isnan(scheduler.timings['phase']))
+    # the function is only pushed once per phase
+    assert pool.pushed == [_square]
+
+
+def test_map_of_a_subset_of_patches():
+    scheduler = PatchScheduler(_patches([10, 20, 30, 40]))
+    pool = ChunkedPool(2)
+    assert scheduler.map(pool, 'phase', _square, [1, 3], patches=[1, 3]) == [1, 9]
+    assert np.isnan(scheduler.timings['phase'][0]) and not np.isnan(scheduler.timings['phase'][3])
+
+
+def test_rebalancing_evicts_moved_patches():
+    evicted = []
+    scheduler = PatchScheduler(_patches([10, 10, 10, 10]), imbalance_threshold=1.2, evict=evicted.extend)
+    pool = ChunkedPool(2)
+    scheduler.assignments['phase'] = np.array([0, 0, 0, 1])
+    scheduler.timings['phase'] = np.ones(4)
+    assignment = scheduler.assignment(pool, 'phase', 2)
+    assert np.bincount(assignment).tolist() == [2, 2]
+    moved = list(np.flatnonzero(assignment != np.array([0, 0, 0, 1])))
+    # evict is called on every worker with all moved patches
+    assert pool.applied == [(moved,)]
+    assert evicted == moved * 2
+
+
+def test_map_with_dummy_pool_does_not_push():
+    scheduler = PatchScheduler(_patches([10, 20]))
+    assert scheduler.map(DummyPool(), 'phase', _square, [2, 3]) == [4, 9]
+    assert scheduler.remote_functions == {}
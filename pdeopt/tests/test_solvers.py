@@ -0,0 +1,117 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+pytest.importorskip('pymor')
+
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
+
+from pymor.core.exceptions import InversionError
+
+from pdeopt.solvers import (DirectSolver, AMGSolver, PreconditionedCGSolver, LODSchwarzSolver, HAVE_PYAMG, pcg,
+                            dirichlet_split, dirichlet_restrict)
+
+
+def _poisson(n, mu):
+    # five point stencil plus mass term, the boundary rows are unit rows as assembled by pymor
+    L = sparse.diags([-1., 2., -1.], [-1, 0, 1], shape=(n, n))
+    A = (mu * sparse.kronsum(L, L) + sparse.identity(n * n)).tolil()
+    for i in range(n * n):
+        if i // n in (0, n - 1) or i % n in (0, n - 1):
+            A.rows[i], A.data[i] = [i], [1.]
+    return A.tocsr()
+
+def _rhs(n, columns=2):
+    return np.random.default_rng(0).random((n * n, columns))
+
+
+class _JacobiCGSolver(PreconditionedCGSolver):
+    def build(self, A, free, mu):
+        diagonal = A.diagonal()[:, np.newaxis]
+        self.preconditioner = lambda R: R / diagonal
+
+
+def test_pcg_matches_direct_solve():
+    A, B = _poisson(12, 1.), _rhs(12, 3)
+    free, fixed = dirichlet_split(A)
+    assert len(fixed) == 4 * 11
+    AFree = dirichlet_restrict(A)
+    X, iterations, converged = pcg(AFree, B[free], lambda R: R, 1e-12, 1000)
+    assert converged and 0 < iterations < 1000
+    assert np.allclose(X, spsolve(sparse.csc_matrix(AFree), B[free]), rtol=1e-8, atol=1e-10)
+
+
+def test_direct_solver_reuses_the_factorization():
+    assembled = []
+    def assemble(mu):
+        assembled.append(mu)
+        return _poisson(10, mu)
+    solver, B = DirectSolver(cache_size=2), _rhs(10)
+    for mu in (1., 2., 1.):
+        assert np.allclose(solver.solve(assemble, B, mu), spsolve(sparse.csc_matrix(_poisson(10, mu)), B))
+    assert assembled == [1., 2.]
+
+
+@pytest.mark.parametrize('solver', ['jacobi', 'amg'])
+def test_preconditioned_cg_matches_direct_solve(solver):
+    if solver == 'amg' and not HAVE_PYAMG:
+        pytest.skip('pyamg is not installed')
+    solver = AMGSolver(reference_mu=1.) if solver == 'amg' else _JacobiCGSolver(reference_mu=1.)
+    B = _rhs(16)
+    for mu in (1., 0.5, 2.):
+        X = solver.solve(lambda mu_: _poisson(16, mu_), B, mu)
+        assert np.allclose(X, spsolve(sparse.csc_matrix(_poisson(16, mu)), B), rtol=1e-6, atol=1e-8)
+    # the preconditioner of the reference parameter is reused
+    assert solver.preconditioners == 1 and len(solver.iterations) == 3
+
+
+def test_preconditioned_cg_raises_if_it_does_not_converge():
+    solver = _JacobiCGSolver(max_iterations=2)
+    with pytest.raises(InversionError):
+        solver.solve(lambda mu: _poisson(16, mu), _rhs(16), 1.)
+    # the preconditioner has been rebuilt once before
+    assert solver.preconditioners == 2
+
+
+def test_lod_schwarz_solver_matches_direct_solve(thermal_block_opt_problem):
+    from gridlod import fem, util
+    from pdeopt.discretize_gridlod import discretize_gridlod
+    problem, world = thermal_block_opt_problem['problem'], thermal_block_opt_problem['world']
+    gridlod_model, _, _, _, _ = discretize_gridlod(problem, thermal_block_opt_problem['diameter'],
+                                                   thermal_block_opt_problem['coarse_elements'],
+                                                   aFine_constructor=thermal_block_opt_problem['aFine_constructor'],
+                                                   print_on_ranks=False)
+    fixed = util.boundarypIndexMap(world.NWorldFine, world.boundaryConditions == 0)
+
+    def assemble(mu):
+        # the fine FEM matrix in the numbering of gridlod, with unit rows for the Dirichlet DoFs
+        aFine = problem.diffusion(util.tCoordinates(world.NWorldFine), mu)
+        A = sparse.lil_matrix(fem.assemblePatchMatrix(world.NWorldFine, world.ALocFine, aFine))
+        for i in fixed:
+            A.rows[i], A.data[i] = [i], [1.]
+        return A.tocsr()
+
+    solver = LODSchwarzSolver(gridlod_model, reference_mu=thermal_block_opt_problem['mu_bar'])
+    B = _rhs(world.NWorldFine[0] + 1)
+    for mu in thermal_block_opt_problem['parameter_space'].sample_randomly(2, seed=5):
+        X = solver.solve(assemble, B, mu)
+        assert np.allclose(X, spsolve(sparse.csc_matrix(assemble(mu)), B), rtol=1e-6, atol=1e-8)
+    # the LOD basis is restricted to the free fine and coarse DoFs
+    assert solver.basis.shape == (len(B) - len(fixed), len(gridlod_model.free))
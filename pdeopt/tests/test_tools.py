@@ -0,0 +1,89 @@
+# ~~~
+# This file is part of the PhD-thesis:
+#
+#           "Adaptive Reduced Basis Methods for Multiscale Problems
+#               and Large-scale PDE-constrained Optimization"
+#
+# by: Tim Keil
+#
+#   https://github.com/TiKeil/Supplementary-Material-for-PhD-thesis
+#
+# Copyright 2019-2022 all developers. All rights reserved.
+# License: Licensed as BSD 2-Clause License (http://opensource.org/licenses/BSD-2-Clause)
+# Authors:
+#   Tim Keil
+# ~~~
+
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+
+import numpy as np
+import scipy.sparse as sparse
+
+from pdeopt.tools import ParameterCache, SpeculativeCounts, LODEvaluationCounter, estimate_nbytes
+
+
+def _speculative_run(counts, counter):
+    with counts:
+        print('speculative')
+        counter.count(coarse=True)
+
+
+def test_speculative_counts_are_only_applied_if_used(capsys):
+    counter = LODEvaluationCounter()
+    counts = SpeculativeCounts()
+    ThreadPoolExecutor(max_workers=1).submit(_speculative_run, counts, counter).result()
+    print('master')
+    assert counter.coarse_with_FOM_counter == 0
+    assert capsys.readouterr().out == 'master\n'
+    counts.apply()
+    assert counter.coarse_with_FOM_counter == 1
+    assert capsys.readouterr().out == 'speculative\n'
+
+
+def test_discarded_speculation_is_not_printed(capsys):
+    counter = LODEvaluationCounter()
+    ThreadPoolExecutor(max_workers=1).submit(_speculative_run, SpeculativeCounts(), counter).result()
+    assert counter.coarse_with_FOM_counter == 0
+    assert capsys.readouterr().out == ''
+
+
+def test_parameter_cache_is_lru():
+    cache = ParameterCache(max_entries=2)
+    cache.put([1.], 'a')
+    cache.put([2.], 'b')
+    assert cache.get(np.array([1.])) == 'a'
+    # [2.] is the least recently used entry
+    cache.put([3.], 'c')
+    assert [2.] not in cache and [1.] in cache and [3.] in cache
+    assert cache.get([2.]) is None
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+
+def test_parameter_cache_memory_budget():
+    cache = ParameterCache(max_entries=None, max_bytes=2 * 8 * 100)
+    for i in range(3):
+        cache.put([float(i)], {'U': np.zeros(100)})
+    assert len(cache) == 2 and cache.nbytes == 2 * 8 * 100 and [0.] not in cache
+    # the entry grows beyond the budget, the least recently used entry is evicted
+    matrix = sparse.identity(50, format='csc')
+    cache.update([2.], matrix=matrix)
+    assert [1.] not in cache and set(cache.peek([2.])) == {'U', 'matrix'}
+    assert cache.nbytes == 8 * 100 + estimate_nbytes(matrix) > cache.max_bytes
+    # the most recent entry is kept, even if it exceeds the budget on its own
+    cache.put([4.], np.zeros(1000))
+    assert len(cache) == 1 and [4.] in cache
+    assert cache.pop([4.]) is not None and cache.nbytes == 0
+
+
+def test_parameter_cache_entries_are_not_pickled():
+    cache = ParameterCache(max_entries=3, max_bytes=10**6)
+    cache.put([1.], np.zeros(10))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy) == 0 and copy.nbytes == 0 and copy.max_bytes == 10**6
+    copy.put([1.], np.zeros(10))
@@ -62,6 +62,10 @@ use_FEM = True
 use_fine_mesh = True
 #use_fine_mesh = False
 
+# CG with the LOD two-level Schwarz preconditioner for the FEM solves (needs use_fine_mesh)
+# use_lod_preconditioner = True
+use_lod_preconditioner = False
+
 # skip_estimator = False
 skip_estimator = True
 
@@ -140,13 +144,18 @@ gridlod_opt_fom, data, mu_bar = discretize_quadratic_pdeopt_with_gridlod(
     u_d=u_d, print_on_ranks=print_on_ranks)
 
 if use_FEM:
+    if use_lod_preconditioner:
+        from pdeopt.solvers import LODSchwarzSolver
+        solver_backend = LODSchwarzSolver(gridlod_model, pool=pool)
+    else:
+        solver_backend = None
     opt_fom, data, mu_bar = discretize_quadratic_NCD_pdeopt_stationary_cg(problem,
                                         diameter, weights.copy(),
                                         domain_of_interest=domain_of_interest,
                                         desired_temperature=None,
                                         mu_for_u_d=mu_for_u_d, mu_for_tikhonov=mu_for_tikhonov,
                                         coarse_functional_grid_size=N_coarse,
-                                        u_d=u_d)
+                                        u_d=u_d, solver_backend=solver_backend)
 
     ### counting evaluations in opt_fom
     opt_fom = opt_fom.with_(evaluation_counter=counter)
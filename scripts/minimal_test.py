@@ -35,7 +35,12 @@ def prepare_kernels():
     disable_caching()
 
 use_pool = True
-if use_pool:
+use_shared_memory_pool = False  # <---- single node pool without MPI, e.g. for a laptop
+if use_pool and use_shared_memory_pool:
+    from pdeopt.pool import SharedMemoryPool
+    pool = SharedMemoryPool()
+    store_in_tmp = 'tmp'
+elif use_pool:
     from pymor.parallel.mpi import MPIPool
     pool = MPIPool()
     # store_in_tmp = '/scratch/tmp/t_keil02/lrblod/tmp'
@@ -140,6 +145,11 @@ gridlod_opt_fom, data, mu_bar = discretize_quadratic_pdeopt_with_gridlod(
     coarse_J=coarse_J, use_fine_mesh=use_fine_mesh, aFine_constructor=local_problem_constructer,
     u_d=u_d, print_on_ranks=print_on_ranks)
 
+if use_pool and use_shared_memory_pool:
+    # the patch data of the gridlod models is sent with every patch computation
+    pool.share(gridlod_model)
+    pool.share(gridlod_opt_fom.optional_forward_model)
+
 if use_FEM:
     opt_fom, data, mu_bar = discretize_quadratic_NCD_pdeopt_stationary_cg(problem,
                                         diameter, weights.copy(),